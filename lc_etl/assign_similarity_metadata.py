@@ -24,13 +24,12 @@ The score is calculated by:
 from argparse import ArgumentParser
 from dataclasses import dataclass
 import json
-import glob
 import logging
-from pathlib import Path
 import random
 
 import gensim
 
+from .corpus_store import open_corpus
 from .train_doc2vec import Configuration
 from .utilities import initialize_logger
 
@@ -84,17 +83,14 @@ def sample_words(text):
     return random.sample(words, round(len(words)*FRACTION))
 
 
-def _derive_scores(model, txt_file, base_words):
+def _derive_scores(model, text, base_words):
     """
-    Takes a model, a text file, and a list of base words.
+    Takes a model, the text of a file, and a list of base words.
 
     Returns a dict of {base_word: score}, where score is an integer between 0
     and 100 which represents the average similarity of the text to the given
     word.
     """
-    with open(txt_file, 'r') as f:
-        text = f.read()
-
     words = sample_words(text)
     # This is a list of dicts of the form {base_word: score}.
     raw_scores = [_single_word_score(model, base_words, word) for word in words]
@@ -115,22 +111,6 @@ def _get_base_words(model, options):
     return available_words
 
 
-def _get_meta_metadata(txt_file, options):
-    txt_file = str(txt_file)
-    if 'ocr.txt' in txt_file:
-        # This converts something like `newspaper_dir/lccn/path/to/file` into
-        # `lccn/path/to/file`. This simplifies accessing the metadata, even though
-        # we need the original path to access the fulltext file.
-        txt_path = txt_file.replace('ocr.txt', '').replace(options.newspaper_dir, '').lstrip('/')
-        metadata_path = Path(options.metadata_dir) / txt_path
-        idx = txt_path.split('/')[0]
-    else:
-        idx = txt_file.split('/')[-1]
-        metadata_path = Path(options.metadata_dir) / idx
-
-    return metadata_path, idx
-
-
 def _init_score_ranges(base_words):
     ranges = {}
 
@@ -155,14 +135,18 @@ def _update_score_ranges(score_ranges, scores):
     return score_ranges
 
 
-def _update_metadata(model, options, iterator):
+def _update_metadata(model, options, target_dir, pattern, recursive=True):
     base_words = _get_base_words(model, options)
 
     trivial_scores = { base_word: 0 for base_word in base_words }
 
     score_ranges = _init_score_ranges(base_words)
-    for txt_file in iterator:
-        output_path, idx = _get_meta_metadata(txt_file, options)
+    corpus = open_corpus(target_dir)
+
+    for entry in corpus.entries(pattern, recursive=recursive):
+        txt_file = f'{target_dir}/{entry.doc_id}'
+        output_path = entry.metadata_path(options.metadata_dir)
+        idx = entry.metadata_key
 
         if not output_path.is_file():
             logging.warning(f'Metadata file does not exist at {output_path}')
@@ -171,7 +155,7 @@ def _update_metadata(model, options, iterator):
         logging.info(f'Updating metadata for {txt_file}...')
 
         try:
-            scores = _derive_scores(model, txt_file, base_words)
+            scores = _derive_scores(model, corpus.read(entry.doc_id), base_words)
         except ZeroDivisionError:
             # If len(words) = 0.
             scores = trivial_scores
@@ -210,8 +194,8 @@ def run(base_words, model_path, metadata_dir, newspaper_dir=None,
 
     if newspaper_dir:
         logging.info('Processing newspapers...')
-        _update_metadata(model, options, Path(newspaper_dir).rglob('**/*.txt'))
+        _update_metadata(model, options, newspaper_dir, '**/*.txt')
 
     if results_dir:
         logging.info('Processing non-newspapers...')
-        _update_metadata(model, options, glob.iglob(f'{results_dir}/*'))
+        _update_metadata(model, options, results_dir, '*', recursive=False)
@@ -0,0 +1,96 @@
+# Looks up many loc.gov items at once via the search API, instead of one
+# /item/ request per identifier.
+#
+# Each batch of identifiers becomes a single search, OR-ing the identifiers
+# together, and the results are mapped back to identifiers by their ids. The
+# search API doesn't promise to find everything this way (and may find things
+# we didn't ask for, which we ignore), so we check that every identifier came
+# back, and by default look up the ones that didn't via the item endpoint, one
+# at a time.
+#
+# Note that what comes back from the search are search results, not item
+# JSON; they have most of the same fields, but not all (see
+# fetch_metadata.item_json_from_record). For the fallbacks, it's the item
+# JSON's `item`.
+
+import logging
+from urllib.parse import urlparse, quote_plus
+
+import requests
+
+from .response_cache import cached_get
+from .utilities import http_adapter, TIMEOUT
+
+SEARCH_URL = 'https://www.loc.gov/search/?fo=json&q={query}&c={count}'
+ITEM_URL = 'https://www.loc.gov/item/{identifier}/?fo=json'
+# Keep this low enough that the query string stays a sensible length.
+BATCH_SIZE = 100
+
+
+def extract_identifier(url):
+    """'https://www.loc.gov/item/mal3745600/?fo=json' -> 'mal3745600'.
+    Bare identifiers are returned as-is."""
+    parts = [x for x in urlparse(url).path.split('/') if x]
+    return parts[-1] if parts else ''
+
+
+def _resolve_batch(identifiers):
+    query = quote_plus(' OR '.join(identifiers))
+    # Ask for a few extra rows, since the search may also turn up items that
+    # merely mention our identifiers.
+    url = SEARCH_URL.format(query=query, count=2 * len(identifiers))
+
+    try:
+        response = cached_get(http_adapter(), url, timeout=TIMEOUT)
+        results = response.json()['results']
+    except (requests.exceptions.RequestException, ValueError, KeyError):
+        logging.exception(f'Batch lookup failed for {len(identifiers)} identifiers')
+        return {}
+
+    wanted = set(identifiers)
+    found = {}
+    for result in results:
+        identifier = extract_identifier(result.get('id', ''))
+        if identifier in wanted:
+            found[identifier] = result
+
+    return found
+
+
+def _resolve_item(identifier):
+    url = ITEM_URL.format(identifier=identifier)
+
+    try:
+        return cached_get(http_adapter(), url, timeout=TIMEOUT).json()['item']
+    except (requests.exceptions.RequestException, ValueError, KeyError):
+        logging.exception(f'Item lookup failed for {identifier}')
+        return None
+
+
+def resolve(identifiers, batch_size=BATCH_SIZE, fallback=True):
+    """
+    Returns {identifier: search result} for `identifiers`, using one search
+    per `batch_size` identifiers. Whichever ones the search misses are looked
+    up via the item endpoint (and map to the item JSON's `item`) unless
+    `fallback` is False. Identifiers that weren't found either way are
+    simply absent.
+    """
+    identifiers = list(dict.fromkeys(identifiers))    # dedupe, keep order
+    found = {}
+
+    for i in range(0, len(identifiers), batch_size):
+        found.update(_resolve_batch(identifiers[i:i + batch_size]))
+
+    missing = [identifier for identifier in identifiers if identifier not in found]
+    if identifiers:
+        logging.info(f'Batch lookup found {len(found)} of {len(identifiers)} identifiers')
+    if missing:
+        logging.info(f'Not found by batch lookup: {", ".join(missing)}')
+
+    if fallback:
+        for identifier in missing:
+            item = _resolve_item(identifier)
+            if item is not None:
+                found[identifier] = item
+
+    return found
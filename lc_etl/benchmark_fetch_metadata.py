@@ -0,0 +1,91 @@
+# Measures how fetch_metadata throughput scales with the number of workers,
+# against a local mock of the loc.gov item endpoint, so we can pick a worker
+# count without hammering the real server.
+#
+# The mock answers every item request with the same JSON after a fixed delay
+# (standing in for network + server latency). With a rate limit of R requests
+# per second and latency L, throughput should grow roughly linearly with the
+# number of workers until it reaches R, and then flatten out.
+#
+# Usage:
+# python -m lc_etl.benchmark_fetch_metadata --requests 200 --latency 0.2 --rate 20
+
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from . import fetch_metadata, response_cache, throttle
+
+SAMPLE_ITEM = Path(__file__).parent.parent / 'tests' / 'mal3745600.json'
+
+
+def _make_handler(body, latency):
+    class ItemHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return ItemHandler
+
+
+def benchmark(worker_counts, num_requests, latency, rate):
+    with open(SAMPLE_ITEM, 'rb') as f:
+        body = f.read()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _make_handler(body, latency))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    item_url = f'http://127.0.0.1:{server.server_port}/item/{{identifier}}/?fo=json'
+
+    results = {}
+    try:
+        for workers in worker_counts:
+            identifiers = [f'item{i}' for i in range(num_requests)]
+
+            with tempfile.TemporaryDirectory() as output_dir, \
+                    mock.patch.object(fetch_metadata, 'ITEM_URL', item_url), \
+                    mock.patch.object(fetch_metadata, 'OUTPUT_DIR', output_dir), \
+                    mock.patch.object(fetch_metadata, 'BATCH_LOOKUPS', False), \
+                    mock.patch.object(response_cache, 'ENABLED', False):
+                # Hold the mock server's limiter at `rate`, rather than letting
+                # it adapt.
+                throttle.get_limiter('127.0.0.1').set_rate(rate, max_rate=rate)
+
+                start = time.monotonic()
+                fetch_metadata._inner_fetch(identifiers, overwrite=True, workers=workers)
+                elapsed = time.monotonic() - start
+
+                written = len(list(Path(output_dir).iterdir()))
+
+            results[workers] = written / elapsed
+            print(f'{workers:>3} workers: {results[workers]:7.1f} items/s ({written} written in {elapsed:.1f}s)')
+    finally:
+        server.shutdown()
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.2, help='seconds per mock response')
+    parser.add_argument('--rate', type=float, default=20, help='rate limit, in requests per second')
+    parser.add_argument('--workers', default='1,2,4,8,16')
+    options = parser.parse_args()
+
+    benchmark(
+        [int(x) for x in options.workers.split(',')],
+        options.requests, options.latency, options.rate
+    )
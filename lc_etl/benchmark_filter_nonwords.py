@@ -0,0 +1,74 @@
+# Measures how filter_nonwords_parallel throughput scales with the number of
+# processes, so we can pick --p for a big run from a small one.
+#
+# The corpus is made by copying every file in --source_dir --copies times
+# (the default is the test corpus, which is tiny, so turn --copies up or
+# point it at a sample of the real thing). Each process count filters a
+# fresh copy of it, starting from an empty nonword cache, so no run benefits
+# from the replacements an earlier one worked out.
+#
+# Every worker loads spacy for itself, which takes a second or two, so on a
+# small corpus that's most of what gets measured; the files/s only mean
+# something once the corpus takes a while to get through. Throughput should
+# grow with the number of processes up to about the number of cores.
+#
+# Usage:
+# python -m lc_etl.benchmark_filter_nonwords --model_path MODEL --copies 500 --processes 1,2,4,8
+
+from argparse import ArgumentParser
+import logging
+from pathlib import Path
+import shutil
+import tempfile
+import time
+from unittest import mock
+
+from . import filter_nonwords_parallel, nonword_cache
+from .utilities import initialize_logger
+
+TEST_CORPUS = Path(__file__).parent.parent / 'tests' / 'data' / 'nonwords'
+TEST_MODEL = Path(__file__).parent.parent / 'tests' / 'data' / 'gensim_outputs' / 'test_model'
+
+
+def _make_corpus(source_dir, target_dir, copies):
+    sources = [path for path in Path(source_dir).iterdir() if path.is_file()]
+    for i in range(copies):
+        for path in sources:
+            shutil.copy(path, Path(target_dir) / f'{path.name}-{i}')
+
+
+def benchmark(process_counts, model_path=TEST_MODEL, source_dir=TEST_CORPUS,
+              copies=100):
+    results = {}
+    for processes in process_counts:
+        with tempfile.TemporaryDirectory() as corpus_dir, \
+                tempfile.TemporaryDirectory() as cache_dir, \
+                mock.patch.object(nonword_cache, 'BASE_DIR', cache_dir):
+            _make_corpus(source_dir, corpus_dir, copies)
+
+            start = time.monotonic()
+            files = filter_nonwords_parallel._filter(corpus_dir, model_path, processes)
+            elapsed = time.monotonic() - start
+
+        results[processes] = files / elapsed
+        message = f'{processes:>3} processes: {results[processes]:7.1f} files/s ({files} filtered in {elapsed:.1f}s)'
+        logging.info(message)
+        print(message)
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--model_path', default=str(TEST_MODEL))
+    parser.add_argument('--source_dir', default=str(TEST_CORPUS), help='files to make the corpus from')
+    parser.add_argument('--copies', type=int, default=100, help='copies of each file in the corpus')
+    parser.add_argument('--processes', default='1,2,4')
+    parser.add_argument('--logfile', default='benchmark_filter_nonwords.log')
+    options = parser.parse_args()
+
+    initialize_logger(options.logfile)
+    benchmark(
+        [int(x) for x in options.processes.split(',')],
+        options.model_path, options.source_dir, options.copies
+    )
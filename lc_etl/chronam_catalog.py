@@ -0,0 +1,361 @@
+# A local, indexed copy of the parts of the Chronicling America catalog we care
+# about: which batches exist, which lccns each batch contains, where each
+# batch's OCR tarball lives, and which years each title covers.
+#
+# This replaces the pickles newspapers.py used to keep (lccn_to_batch,
+# reconstruction_era_papers, chronam_batches_needed, chronam_urls_needed).
+# Those could only be rebuilt from scratch, and answering "which batches cover
+# these lccns" meant inverting the whole mapping every time. Here, the
+# questions we ask are indexed lookups, and refreshing only fetches batches we
+# haven't seen before.
+
+import logging
+from pathlib import Path
+import pickle
+import re
+import sqlite3
+import threading
+
+from . import response_cache
+from .response_cache import cached_get
+from .utilities import http_adapter, BASE_DIR, TIMEOUT
+
+CATALOG_PATH = f'{BASE_DIR}/chronam_catalog.db'
+
+BATCHES_URL = 'https://chroniclingamerica.loc.gov/batches.json'
+# (connect, read) timeout for batches.json, whose pages are slow to generate.
+BATCHES_TIMEOUT = (TIMEOUT, 60)
+OCR_URL = 'https://chroniclingamerica.loc.gov/ocr.json'
+# You need all the query parameters, even the blank ones, or the API errors.
+TITLES_URL = ('https://chroniclingamerica.loc.gov/search/titles/results/?city='
+              '&rows=200&terms=&language=English&lccn=&material_type='
+              '&year1={year1}&year2={year2}&labor=&county=&state=&frequency='
+              '&page={page}&ethnicity=&sort=state&format=json')
+
+# The legacy pickles, which we'll import once if they're lying around so that
+# nobody has to re-crawl batches.json from scratch.
+LEGACY_LCCN_TO_BATCH = f'{BASE_DIR}/lccn_to_batch'
+LEGACY_URLS = f'{BASE_DIR}/chronam_urls_needed'
+LEGACY_TITLES = 'reconstruction_era_papers'
+# The legacy titles pickle is the result of a title search for these years.
+LEGACY_TITLE_YEARS = (1863, 1877)
+
+chronam_id = re.compile(r'/lccn/(\w+)/')
+
+
+def _year(value, default):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        # e.g. 'current', or missing altogether.
+        return default
+
+
+class ChronAmCatalog(object):
+    """SQLite-backed catalog of ChronAm batches, lccns and title years."""
+
+    def __init__(self, path=None):
+        super(ChronAmCatalog, self).__init__()
+        self.path = path or CATALOG_PATH
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        self.lock = threading.Lock()
+
+        with self.lock:
+            self.db.executescript('''
+                CREATE TABLE IF NOT EXISTS batches
+                    (name TEXT PRIMARY KEY, ocr_url TEXT);
+                CREATE TABLE IF NOT EXISTS batch_lccns
+                    (batch TEXT, lccn TEXT, PRIMARY KEY (batch, lccn));
+                CREATE INDEX IF NOT EXISTS batch_lccns_lccn ON batch_lccns (lccn);
+                CREATE TABLE IF NOT EXISTS titles
+                    (lccn TEXT PRIMARY KEY, start_year INTEGER, end_year INTEGER);
+                CREATE INDEX IF NOT EXISTS titles_years ON titles (start_year, end_year);
+                CREATE TABLE IF NOT EXISTS title_searches
+                    (year1 INTEGER, year2 INTEGER, PRIMARY KEY (year1, year2));
+                CREATE TABLE IF NOT EXISTS settings
+                    (key TEXT PRIMARY KEY, value TEXT);
+            ''')
+            self.db.commit()
+
+
+    # ~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~ writes ~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~ #
+    def add_batch(self, name, lccns, ocr_url=None):
+        with self.lock:
+            self.db.execute(
+                'INSERT INTO batches VALUES (?, ?) ON CONFLICT(name) DO UPDATE '
+                'SET ocr_url = COALESCE(excluded.ocr_url, ocr_url)',
+                (name, ocr_url)
+            )
+            self.db.executemany(
+                'INSERT OR IGNORE INTO batch_lccns VALUES (?, ?)',
+                [(name, lccn) for lccn in lccns]
+            )
+            self.db.commit()
+
+
+    def set_ocr_urls(self, batch_to_url):
+        with self.lock:
+            self.db.executemany(
+                'UPDATE batches SET ocr_url = ? WHERE name = ?',
+                [(url, name) for name, url in batch_to_url.items()]
+            )
+            self.db.commit()
+
+
+    def add_titles(self, titles):
+        """`titles` is an iterable of (lccn, start_year, end_year)."""
+        with self.lock:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO titles VALUES (?, ?, ?)', list(titles)
+            )
+            self.db.commit()
+
+
+    def add_title_search(self, year1, year2):
+        """Records that we have all the titles for year1 through year2."""
+        with self.lock:
+            self.db.execute(
+                'INSERT OR IGNORE INTO title_searches VALUES (?, ?)', (year1, year2)
+            )
+            self.db.commit()
+
+
+    def set_setting(self, key, value):
+        """A value of None removes the setting."""
+        with self.lock:
+            if value is None:
+                self.db.execute('DELETE FROM settings WHERE key = ?', (key,))
+            else:
+                self.db.execute('INSERT OR REPLACE INTO settings VALUES (?, ?)', (key, value))
+            self.db.commit()
+
+
+    # ~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~ reads ~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~ #
+    def _query(self, sql, params=()):
+        with self.lock:
+            return self.db.execute(sql, params).fetchall()
+
+
+    def known_batches(self):
+        return {row[0] for row in self._query('SELECT name FROM batches')}
+
+
+    def get_setting(self, key):
+        rows = self._query('SELECT value FROM settings WHERE key = ?', (key,))
+        return rows[0][0] if rows else None
+
+
+    def has_title_search(self, year1, year2):
+        return bool(self._query(
+            'SELECT 1 FROM title_searches WHERE year1 <= ? AND year2 >= ?',
+            (year1, year2)
+        ))
+
+
+    def lccns_for_years(self, year1, year2):
+        """All lccns whose publication run overlaps year1 through year2."""
+        return {row[0] for row in self._query(
+            'SELECT lccn FROM titles WHERE start_year <= ? AND end_year >= ?',
+            (year2, year1)
+        )}
+
+
+    def batches_for_lccn(self, lccn):
+        return {row[0] for row in self._query(
+            'SELECT batch FROM batch_lccns WHERE lccn = ?', (lccn,)
+        )}
+
+
+    def lccns_for_batch(self, batch):
+        return {row[0] for row in self._query(
+            'SELECT lccn FROM batch_lccns WHERE batch = ?', (batch,)
+        )}
+
+
+    def batches_for_years(self, year1, year2):
+        """
+        Returns [(batch, ocr_url)] for every batch containing a title that
+        overlaps year1 through year2. ocr_url is None for batches with no OCR
+        tarball.
+        """
+        return self._query(
+            'SELECT DISTINCT b.name, b.ocr_url FROM titles t '
+            'JOIN batch_lccns bl ON bl.lccn = t.lccn '
+            'JOIN batches b ON b.name = bl.batch '
+            'WHERE t.start_year <= ? AND t.end_year >= ? ORDER BY b.name',
+            (year2, year1)
+        )
+
+
+    def lccn_to_batch(self):
+        retval = {}
+        for batch, lccn in self._query('SELECT batch, lccn FROM batch_lccns'):
+            retval.setdefault(lccn, set()).add(batch)
+        return retval
+
+
+    # ~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~ refresh ~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~ #
+    def refresh_batches(self):
+        """
+        Walks batches.json until it reaches a page of batches we already know
+        about. batches.json lists the most recently ingested batches first, so
+        once we've been all the way through it, everything after that point
+        is already in the catalog.
+
+        Until then, we don't stop early, and we keep track of the next page
+        to fetch, so that a crawl that gets interrupted picks up where it left
+        off rather than stopping at the first page it's already seen.
+        Returns the number of new batches.
+
+        These pages can't be cached, so in cache-only mode (see
+        response_cache) this does nothing.
+        """
+        if response_cache.CACHE_ONLY:
+            logging.info('Cache-only mode; not checking batches.json for new batches')
+            return 0
+
+        known = self.known_batches()
+        crawled = self.get_setting('batches_crawled')
+        url = BATCHES_URL if crawled else (self.get_setting('batches_next') or BATCHES_URL)
+        new = 0
+        iteration = 0
+
+        while url:
+            # Don't cache these pages; their contents shift as batches are
+            # ingested.
+            batches = http_adapter().get(url, timeout=BATCHES_TIMEOUT).json()
+            page_new = [b for b in batches['batches'] if b['name'] not in known]
+
+            for batch in page_new:
+                self.add_batch(batch['name'], batch['lccns'])
+            new += len(page_new)
+
+            if crawled and known and not page_new:
+                break
+
+            logging.info(f'{iteration}: {len(page_new)} new batches; about to process {batches.get("next")}')
+            iteration += 1
+            url = batches.get('next')
+            if not crawled:
+                self.set_setting('batches_next', url)
+
+        if not crawled:
+            # Batches ingested while we were crawling are at the front, so
+            # the next refresh will find them.
+            self.set_setting('batches_crawled', '1')
+
+        logging.info(f'{new} new batches added to the catalog')
+        return new
+
+
+    def refresh_ocr_urls(self):
+        # Always revalidate (which is a cheap 304 if nothing's changed), or
+        # batches we've just found in batches.json would have no OCR URL
+        # until the cached copy expired.
+        ocr_available = cached_get(http_adapter(), OCR_URL, ttl=0).json()
+
+        batch_to_url = {}
+        for ocr in ocr_available['ocr']:
+            # The batches just provide a batch name, but in the ocr file they're
+            # listed as batch_name.tar.bz2.
+            batch_to_url[(ocr['name']).split('.')[0]] = ocr['url']
+
+        self.set_ocr_urls(batch_to_url)
+
+
+    def refresh_titles(self, year1, year2):
+        more_to_go = True
+        failed = False
+        page = 1
+
+        while more_to_go:
+            url = TITLES_URL.format(year1=year1, year2=year2, page=page)
+            response = cached_get(http_adapter(), url).json()
+
+            try:
+                # ids are in format "/lccn/(lccn of item)/"
+                self.add_titles([
+                    (chronam_id.match(item['id']).group(1),
+                     _year(item.get('start_year'), year1),
+                     _year(item.get('end_year'), year2))
+                    for item in response['items']
+                ])
+            except Exception:
+                logging.exception(f'Failed to fetch from {url}')
+                failed = True
+
+            logging.info(f'page {page} processed')
+            more_to_go = (response['endIndex'] < response['totalItems'])
+            page += 1
+
+        # Only now do we have the full list; if we'd recorded the search
+        # earlier, a crash partway through would leave it short for good.
+        if not failed:
+            self.add_title_search(year1, year2)
+
+
+    def import_legacy_pickles(self):
+        """Seeds an empty catalog from the old pickle caches, if present."""
+        try:
+            with open(LEGACY_LCCN_TO_BATCH, 'rb') as f:
+                lccn_to_batch = pickle.load(f)
+        except (FileNotFoundError, pickle.UnpicklingError):
+            return
+
+        batch_to_lccns = {}
+        for lccn, batches in lccn_to_batch.items():
+            for batch in batches:
+                batch_to_lccns.setdefault(batch, set()).add(lccn)
+
+        for batch, lccns in batch_to_lccns.items():
+            self.add_batch(batch, lccns)
+        # The old code only ever built lccn_to_batch from a full crawl.
+        self.set_setting('batches_crawled', '1')
+
+        try:
+            with open(LEGACY_URLS, 'rb') as f:
+                urls = pickle.load(f)
+            self.set_ocr_urls({url.split('/')[-1].split('.')[0]: url for url in urls})
+        except (FileNotFoundError, pickle.UnpicklingError):
+            pass
+
+        try:
+            with open(LEGACY_TITLES, 'rb') as f:
+                lccns = pickle.load(f)
+            # We don't know these titles' actual runs, only that they turned
+            # up in a search for these years, so claim exactly that.
+            self.add_titles([(lccn, *LEGACY_TITLE_YEARS) for lccn in lccns])
+            self.add_title_search(*LEGACY_TITLE_YEARS)
+        except (FileNotFoundError, pickle.UnpicklingError):
+            pass
+
+        logging.info(f'Imported {len(batch_to_lccns)} batches from legacy pickles')
+
+
+    def refresh(self, year1, year2):
+        """
+        Brings the catalog up to date enough to answer questions about
+        year1 through year2: new batches, OCR URLs, and (if we've never
+        searched these years) titles.
+        """
+        if not self.known_batches():
+            self.import_legacy_pickles()
+
+        self.refresh_batches()
+        self.refresh_ocr_urls()
+
+        if not self.has_title_search(year1, year2):
+            self.refresh_titles(year1, year2)
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def get_catalog():
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None or _catalog.path != CATALOG_PATH:
+            _catalog = ChronAmCatalog(CATALOG_PATH)
+        return _catalog
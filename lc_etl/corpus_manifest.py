@@ -0,0 +1,272 @@
+# A persistent list of what's in a corpus, so that stages don't each have to
+# rediscover it.
+#
+# Every stage used to walk the whole tree for itself (rglob/iglob plus some
+# regex filtering), and then work out each document's doc2vec tag, metadata
+# path, lccn and date from its path with its own bit of string surgery. A
+# manifest does that once per document: it's a SQLite file with one row per
+# doc id (see corpus_store) holding its tag, lccn, date, year and byte size,
+# indexed by year and lccn, so that a subset like "everything from 1877" is a
+# query rather than a scan.
+#
+# Manifests are opt-in: build_manifest (in corpus_store) makes one for a
+# corpus, after which corpus.entries()/ids() read from it and corpus writes
+# and deletes keep it up to date. Changes made behind the corpus's back (the
+# bulk_scripts, say) need another build_manifest, which only touches the rows
+# that changed. Corpora without a manifest work exactly as they always have.
+#
+# Manifests live under MANIFEST_DIR rather than in the corpus directory, so
+# that nothing which walks the corpus (find, rglob) trips over them.
+
+from dataclasses import dataclass
+import hashlib
+import os
+from pathlib import Path, PurePosixPath
+import re
+import sqlite3
+import threading
+
+# This is BASE_DIR/manifests; we can't import BASE_DIR from utilities, since
+# utilities imports corpus_store, which imports us.
+MANIFEST_DIR = 'lc_etl/data/manifests'
+
+# Commit after this many adds/removes (and on flush/close).
+COMMIT_EVERY = 1000
+# select() reads this many rows at a time.
+SELECT_BATCH = 1000
+
+# 'lccn/yyyy/mm/dd/ed-x/seq-x/ocr.txt'
+newspaper_date = re.compile(r'^\w+/(\d{4})/(\d{2})/(\d{2})/')
+
+
+@dataclass
+class Entry:
+    doc_id: str
+    # The doc2vec tag, which is also where the metadata lives, relative to the
+    # metadata dir: 'lccn/yyyy/mm/dd/ed-x/seq-x' for newspapers, the file name
+    # for everything else.
+    tag: str
+    lccn: str = None
+    date: str = None
+    size: int = None
+
+    @property
+    def year(self):
+        return int(self.date[:4]) if self.date else None
+
+    @property
+    def metadata_key(self):
+        """The key this document's data is under in its metadata file."""
+        return self.lccn or self.tag
+
+    def metadata_path(self, metadata_dir):
+        return Path(metadata_dir) / self.tag
+
+
+def parse_doc_id(doc_id, size=None):
+    if not doc_id.endswith('ocr.txt'):
+        # Everything else is 'identifier'.
+        return Entry(doc_id, doc_id.split('/')[-1], size=size)
+
+    tag = doc_id[:-len('ocr.txt')].rstrip('/')
+    match = newspaper_date.match(doc_id)
+    date = '-'.join(match.groups()) if match else None
+    return Entry(doc_id, tag, tag.split('/')[0], date, size)
+
+
+def matches(entry, pattern='*', year=None, lccn=None):
+    # `pattern` works like Path.rglob(pattern): it has to match the end of
+    # the path.
+    if year is not None and entry.year != year:
+        return False
+    if lccn is not None and entry.lccn != lccn:
+        return False
+    return PurePosixPath(entry.doc_id).match(pattern.removeprefix('**/'))
+
+
+def manifest_path(root):
+    root = Path(root).resolve()
+    digest = hashlib.sha1(str(root).encode('utf-8')).hexdigest()[:12]
+    return Path(MANIFEST_DIR) / f'{root.name}-{digest}.db'
+
+
+def _root_identity(root):
+    # If a corpus directory is deleted and recreated, its manifest describes
+    # something that's gone; this lets us notice.
+    stat = os.stat(root)
+    return f'{stat.st_dev}:{stat.st_ino}'
+
+
+class Manifest(object):
+    """The manifest for the corpus at `root`. Safe to share between threads."""
+
+    def __init__(self, root):
+        super(Manifest, self).__init__()
+        self.root = Path(root)
+        self.path = manifest_path(root)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        self.lock = threading.Lock()
+        self.pending = 0
+
+        with self.lock:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS documents (doc_id TEXT PRIMARY KEY, '
+                'tag TEXT, lccn TEXT, date TEXT, year INTEGER, size INTEGER)'
+            )
+            self.db.execute('CREATE INDEX IF NOT EXISTS documents_year ON documents (year)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS documents_lccn ON documents (lccn)')
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value)'
+            )
+            self.db.commit()
+
+
+    def is_current(self):
+        """Whether this manifest was built for the directory now at root."""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT value FROM settings WHERE key = 'root'"
+            ).fetchone()
+
+        return bool(row) and self.root.is_dir() and row[0] == _root_identity(self.root)
+
+
+    def _put(self, entry):
+        # Called with the lock held.
+        self.db.execute(
+            'INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?, ?)',
+            (entry.doc_id, entry.tag, entry.lccn, entry.date, entry.year, entry.size)
+        )
+
+
+    def sync(self, listing):
+        """
+        Brings the manifest in line with `listing`, an iterable of (doc_id,
+        size) for everything now in the corpus, adding, updating and removing
+        only the rows that need it. Returns (added or changed, removed).
+        """
+        with self.lock:
+            known = dict(self.db.execute('SELECT doc_id, size FROM documents'))
+            changed = 0
+
+            for doc_id, size in listing:
+                if known.pop(doc_id, None) != size:
+                    self._put(parse_doc_id(doc_id, size))
+                    changed += 1
+
+            self.db.executemany(
+                'DELETE FROM documents WHERE doc_id = ?', [(x,) for x in known]
+            )
+            self.db.execute(
+                "INSERT OR REPLACE INTO settings VALUES ('root', ?)",
+                (_root_identity(self.root),)
+            )
+            self.db.commit()
+
+        return changed, len(known)
+
+
+    def add(self, doc_id, size):
+        with self.lock:
+            self._put(parse_doc_id(doc_id, size))
+            self._changed()
+
+
+    def remove(self, doc_id):
+        with self.lock:
+            self.db.execute('DELETE FROM documents WHERE doc_id = ?', (doc_id,))
+            self._changed()
+
+
+    def _changed(self):
+        # Called with the lock held.
+        self.pending += 1
+        if self.pending >= COMMIT_EVERY:
+            self.db.commit()
+            self.pending = 0
+
+
+    def flush(self):
+        with self.lock:
+            self.db.commit()
+            self.pending = 0
+
+
+    def select(self, pattern='*', year=None, lccn=None):
+        """Entries matching `pattern` (as for Path.rglob), and `year` and
+        `lccn` if given, in doc id order.
+
+        This is a generator, reading SELECT_BATCH rows at a time, so that
+        walking a corpus of millions of documents doesn't mean holding all of
+        them in memory. Each batch is a fresh query picking up after the last
+        doc id we saw, rather than one long-lived cursor, so it's fine for
+        callers to write to or delete from the corpus as they go (and for
+        other threads to use the connection in between).
+        """
+        query = 'SELECT doc_id, tag, lccn, date, size FROM documents WHERE doc_id > ?'
+        params = []
+        if year is not None:
+            query += ' AND year = ?'
+            params.append(year)
+        if lccn is not None:
+            query += ' AND lccn = ?'
+            params.append(lccn)
+        query += f' ORDER BY doc_id LIMIT {SELECT_BATCH}'
+
+        last = ''
+        while True:
+            with self.lock:
+                rows = self.db.execute(query, [last] + params).fetchall()
+            if not rows:
+                return
+
+            for row in rows:
+                entry = Entry(*row)
+                if matches(entry, pattern):
+                    yield entry
+
+            last = rows[-1][0]
+
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM documents').fetchone()[0]
+
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+
+def get_manifest(root, create=False):
+    """
+    Returns the shared Manifest for the corpus at `root`, or None if it
+    doesn't have a (current) one and `create` isn't set. A new manifest is
+    empty until someone syncs it.
+    """
+    key = Path(root).resolve()
+
+    with _manifests_lock:
+        if key not in _manifests:
+            if not create and not manifest_path(root).is_file():
+                return None
+            _manifests[key] = Manifest(root)
+        manifest = _manifests[key]
+
+    if create or manifest.is_current():
+        return manifest
+
+    return None
+
+
+def close_manifests():
+    with _manifests_lock:
+        for manifest in _manifests.values():
+            manifest.close()
+        _manifests.clear()
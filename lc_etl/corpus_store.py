@@ -0,0 +1,477 @@
+# One way for every stage to read and write the corpus, whether it lives in a
+# directory tree or in a packed store.
+#
+# The newspaper corpus is millions of tiny `lccn/yyyy/mm/dd/ed-N/seq-N/ocr.txt`
+# files, and every stage used to rglob its way through them, paying for a
+# directory walk, an inode lookup and a small-file open per document. A packed
+# store is a directory holding a few big append-only shard files and a SQLite
+# index of doc id -> (shard, offset, length). Reads are slices of mmapped
+# shards, in shard order when iterating, so a full pass is a handful of
+# sequential reads. Documents can optionally be zstd-compressed (if the
+# zstandard package is installed).
+#
+# Doc ids are paths relative to the corpus root, e.g.
+# `sn78000873/1869/12/30/ed-1/seq-1/ocr.txt` or `mal3745600`, so a store can be
+# exported back to exactly the directory it was imported from:
+#
+# python -m lc_etl.corpus_store import lc_etl/data/newspapers lc_etl/data/newspapers_packed --compress
+# python -m lc_etl.corpus_store export lc_etl/data/newspapers_packed lc_etl/data/newspapers
+# python -m lc_etl.corpus_store manifest lc_etl/data/newspapers
+#
+# Stages call open_corpus(path), which gives them a PackedCorpus if `path` is
+# a packed store and a DirectoryCorpus otherwise, and then use ids(), read(),
+# write() and delete() without caring which they got. If the corpus has a
+# manifest (see corpus_manifest and build_manifest), ids() and entries() come
+# from that rather than from a scan, and can select by year or lccn cheaply.
+#
+# Writes append; rewriting or deleting a document only changes the index, so
+# the old bytes stay in their shard until the store is rebuilt (export and
+# import again).
+
+from argparse import ArgumentParser
+import logging
+import mmap
+from pathlib import Path
+import sqlite3
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .corpus_manifest import get_manifest, close_manifests, matches, parse_doc_id
+
+INDEX_FILE = 'index.db'
+SHARD_NAME = 'shard-{:05}.dat'
+# Start a new shard once the current one is this big.
+SHARD_SIZE = 1024 ** 3
+# Commit the index after this many writes (and on flush/close).
+COMMIT_EVERY = 1000
+
+
+def is_packed(path):
+    return Path(path, INDEX_FILE).is_file()
+
+
+class Corpus(object):
+    """
+    What all corpora have in common. Subclasses supply read(), read_bytes(),
+    _write(), _delete(), and _scan() (which lists the doc ids matching a
+    pattern) and _listing() (which lists (doc id, size) for everything), both
+    the slow way.
+    """
+
+    def __init__(self, root):
+        super(Corpus, self).__init__()
+        self.root = Path(root)
+        self._manifest = None
+        self._manifest_checked = False
+
+
+    @property
+    def manifest(self):
+        """This corpus's manifest, or None if it doesn't have one."""
+        if not self._manifest_checked:
+            self._manifest = get_manifest(self.root)
+            self._manifest_checked = True
+
+        return self._manifest
+
+
+    def entries(self, pattern='*', year=None, lccn=None, recursive=True):
+        """
+        corpus_manifest.Entry objects for the documents matching `pattern`
+        (as for Path.rglob), and `year` and `lccn` if given. Without
+        `recursive`, only documents at the top level (as for Path.glob); the
+        non-newspaper results have always been read that way.
+        """
+        if self.manifest:
+            entries = self.manifest.select(pattern, year, lccn)
+        else:
+            entries = (
+                entry for entry in map(parse_doc_id, self._scan(pattern))
+                if matches(entry, pattern, year, lccn)
+            )
+
+        if recursive:
+            return entries
+        return (entry for entry in entries if '/' not in entry.doc_id)
+
+
+    def ids(self, pattern='*', year=None, lccn=None, recursive=True):
+        for entry in self.entries(pattern, year, lccn, recursive):
+            yield entry.doc_id
+
+
+    def write(self, doc_id, text):
+        size = self._write(doc_id, text)
+        if self.manifest:
+            self.manifest.add(doc_id, size)
+
+
+    def delete(self, doc_id):
+        self._delete(doc_id)
+        if self.manifest:
+            self.manifest.remove(doc_id)
+
+
+    def __iter__(self):
+        for doc_id in self.ids():
+            yield doc_id, self.read(doc_id)
+
+
+    def flush(self):
+        if self.manifest:
+            self.manifest.flush()
+
+
+class DirectoryCorpus(Corpus):
+    """The corpus as plain files under `root`, the way it's always been."""
+
+    def _scan(self, pattern):
+        for path in self.root.rglob(pattern):
+            if path.is_file():
+                yield path.relative_to(self.root).as_posix()
+
+
+    def _listing(self):
+        for doc_id in self._scan('*'):
+            yield doc_id, (self.root / doc_id).stat().st_size
+
+
+    def read_bytes(self, doc_id):
+        try:
+            return (self.root / doc_id).read_bytes()
+        except FileNotFoundError:
+            raise KeyError(doc_id)
+
+
+    def read(self, doc_id):
+        try:
+            with open(self.root / doc_id, 'r') as f:
+                return f.read()
+        except FileNotFoundError:
+            raise KeyError(doc_id)
+
+
+    def _write(self, doc_id, text):
+        path = self.root / doc_id
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if isinstance(text, bytes):
+            path.write_bytes(text)
+        else:
+            with open(path, 'w') as f:
+                f.write(text)
+
+        return path.stat().st_size
+
+
+    def _delete(self, doc_id):
+        # Files may have already been deleted if multiple filters are running
+        # in parallel.
+        (self.root / doc_id).unlink(missing_ok=True)
+
+
+    def __contains__(self, doc_id):
+        return (self.root / doc_id).is_file()
+
+
+    def close(self):
+        self.flush()
+
+
+class PackedCorpus(Corpus):
+    """
+    A packed store at `root` (see the top of this module), created if it
+    doesn't exist. `compress` only matters when the store is created; after
+    that, the store remembers whether it compresses new documents.
+
+    Safe to share between threads; writes are serialized.
+    """
+
+    def __init__(self, root, compress=False):
+        super(PackedCorpus, self).__init__(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(self.root / INDEX_FILE, check_same_thread=False, timeout=30)
+        # shard number: mmap of that shard.
+        self.maps = {}
+        self.writer = None
+        self.pending = 0
+
+        with self.lock:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS documents (doc_id TEXT PRIMARY KEY, '
+                'shard INTEGER, offset INTEGER, length INTEGER, compressed INTEGER)'
+            )
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value)'
+            )
+            self.db.execute(
+                "INSERT OR IGNORE INTO settings VALUES ('compress', ?)", (int(compress),)
+            )
+            self.db.commit()
+
+            self.compress = bool(self.db.execute(
+                "SELECT value FROM settings WHERE key = 'compress'"
+            ).fetchone()[0])
+            self.shard = self.db.execute(
+                'SELECT COALESCE(MAX(shard), 0) FROM documents'
+            ).fetchone()[0]
+
+        if self.compress and zstandard is None:
+            raise ImportError(f'{self.root} is compressed; `pip install zstandard` to use it')
+
+
+    def _shard_path(self, shard):
+        return self.root / SHARD_NAME.format(shard)
+
+
+    def _writer(self):
+        # Called with the lock held.
+        if self.writer and self.writer.tell() >= SHARD_SIZE:
+            self.writer.close()
+            self.writer = None
+            self.shard += 1
+
+        if not self.writer:
+            self.writer = open(self._shard_path(self.shard), 'ab')
+
+        return self.writer
+
+
+    def _map(self, shard, end):
+        # Called with the lock held. Shards grow as we write to them, so remap
+        # any shard that's grown past what we mapped last time.
+        shard_map = self.maps.get(shard)
+        if shard_map is None or len(shard_map) < end:
+            if self.writer and shard == self.shard:
+                self.writer.flush()
+            if shard_map is not None:
+                shard_map.close()
+            with open(self._shard_path(shard), 'rb') as f:
+                shard_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[shard] = shard_map
+
+        return shard_map
+
+
+    def _read_at(self, shard, offset, length, compressed):
+        if not length:
+            return b''
+
+        with self.lock:
+            data = self._map(shard, offset + length)[offset:offset + length]
+
+        if compressed:
+            data = zstandard.ZstdDecompressor().decompress(data)
+
+        return data
+
+
+    def _rows(self, pattern):
+        # In shard order, so that a full pass reads each shard front to back.
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT doc_id, shard, offset, length, compressed FROM documents '
+                'ORDER BY shard, offset'
+            ).fetchall()
+
+        return [row for row in rows if matches(parse_doc_id(row[0]), pattern)]
+
+
+    def _scan(self, pattern):
+        return [row[0] for row in self._rows(pattern)]
+
+
+    def _listing(self):
+        return [(row[0], row[3]) for row in self._rows('*')]
+
+
+    def read_bytes(self, doc_id):
+        with self.lock:
+            row = self.db.execute(
+                'SELECT shard, offset, length, compressed FROM documents WHERE doc_id = ?',
+                (doc_id,)
+            ).fetchone()
+
+        if not row:
+            raise KeyError(doc_id)
+
+        return self._read_at(*row)
+
+
+    def read(self, doc_id):
+        return self.read_bytes(doc_id).decode('utf-8')
+
+
+    def _write(self, doc_id, text):
+        data = text.encode('utf-8') if isinstance(text, str) else text
+        if self.compress:
+            data = zstandard.ZstdCompressor().compress(data)
+
+        with self.lock:
+            writer = self._writer()
+            offset = writer.tell()
+            writer.write(data)
+            self.db.execute(
+                'INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?)',
+                (doc_id, self.shard, offset, len(data), int(self.compress))
+            )
+
+            self._changed()
+
+        return len(data)
+
+
+    def _delete(self, doc_id):
+        with self.lock:
+            self.db.execute('DELETE FROM documents WHERE doc_id = ?', (doc_id,))
+            self._changed()
+
+
+    def _changed(self):
+        # Called with the lock held.
+        self.pending += 1
+        if self.pending >= COMMIT_EVERY:
+            self.flush()
+
+
+    def __contains__(self, doc_id):
+        with self.lock:
+            return self.db.execute(
+                'SELECT 1 FROM documents WHERE doc_id = ?', (doc_id,)
+            ).fetchone() is not None
+
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM documents').fetchone()[0]
+
+
+    def __iter__(self):
+        # Straight through the shards, rather than in the manifest's order.
+        for doc_id, shard, offset, length, compressed in self._rows('*'):
+            yield doc_id, self._read_at(shard, offset, length, compressed).decode('utf-8')
+
+
+    def flush(self):
+        # The shard goes to disk before the index that points into it.
+        with self.lock:
+            if self.writer:
+                self.writer.flush()
+            self.db.commit()
+            self.pending = 0
+
+        super(PackedCorpus, self).flush()
+
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            if self.writer:
+                self.writer.close()
+                self.writer = None
+            for shard_map in self.maps.values():
+                shard_map.close()
+            self.maps.clear()
+            self.db.close()
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def open_corpus(path, packed=None, compress=False):
+    """
+    Returns the corpus at `path`: the shared PackedCorpus if `path` is a
+    packed store (or `packed` is set, in which case one is created if need
+    be), and a DirectoryCorpus otherwise.
+    """
+    if packed is None:
+        packed = is_packed(path)
+
+    if not packed:
+        return DirectoryCorpus(path)
+
+    key = Path(path).resolve()
+    with _stores_lock:
+        if key not in _stores:
+            _stores[key] = PackedCorpus(path, compress)
+        return _stores[key]
+
+
+def close_corpora():
+    with _stores_lock:
+        for store in _stores.values():
+            store.close()
+        _stores.clear()
+
+    close_manifests()
+
+
+def build_manifest(path):
+    """
+    Gives the corpus at `path` a manifest, or brings its existing one up to
+    date with whatever has changed on disk. Returns the manifest.
+    """
+    corpus = open_corpus(path)
+    manifest = get_manifest(corpus.root, create=True)
+    changed, removed = manifest.sync(corpus._listing())
+    corpus._manifest = manifest
+    corpus._manifest_checked = True
+
+    logging.info(f'Manifest for {path}: {len(manifest)} documents ({changed} new or changed, {removed} removed)')
+    return manifest
+
+
+def copy_corpus(source, destination, pattern='*'):
+    """Copies every document in `source` matching `pattern` into
+    `destination` (both corpora) byte for byte. Returns how many it copied."""
+    count = 0
+
+    for doc_id in source.ids(pattern):
+        destination.write(doc_id, source.read_bytes(doc_id))
+        count += 1
+        if count % 10000 == 0:
+            logging.info(f'{count} documents copied')
+
+    destination.flush()
+    return count
+
+
+def import_directory(source_dir, store_path, pattern='*', compress=False):
+    """Packs the files under `source_dir` into the store at `store_path`."""
+    store = open_corpus(store_path, packed=True, compress=compress)
+    count = copy_corpus(DirectoryCorpus(source_dir), store, pattern)
+    logging.info(f'Packed {count} documents from {source_dir} into {store_path}')
+    return count
+
+
+def export_directory(store_path, target_dir, pattern='*'):
+    """Unpacks the store at `store_path` into files under `target_dir`."""
+    count = copy_corpus(open_corpus(store_path, packed=True), DirectoryCorpus(target_dir), pattern)
+    logging.info(f'Unpacked {count} documents from {store_path} into {target_dir}')
+    return count
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('command', choices=['import', 'export', 'manifest'])
+    parser.add_argument('source')
+    parser.add_argument('destination', nargs='?')
+    parser.add_argument('--pattern', default='*', help='only copy files matching this glob')
+    parser.add_argument('--compress', action='store_true', help='zstd-compress a new store')
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    try:
+        if options.command == 'import':
+            import_directory(options.source, options.destination, options.pattern, options.compress)
+        elif options.command == 'export':
+            export_directory(options.source, options.destination, options.pattern)
+        else:
+            build_manifest(options.source)
+    finally:
+        close_corpora()
@@ -0,0 +1,170 @@
+# A record of how far dataset.run has gotten, so that a crawl that dies partway
+# through can pick up where it left off rather than starting from scratch.
+#
+# We record two things:
+# - for each search URL, the last page whose results were completely
+#   processed (and whether that was the final page);
+# - every item whose fulltext we have already dealt with, whether or not it
+#   turned out to have any text, and which source (query, collection, item
+#   list) dealt with it.
+#
+# Items that failed (timeouts, locr errors) are deliberately *not* recorded, so
+# they'll be retried next time.
+#
+# The item list doubles as the dataset-wide index of what we've seen: dataset
+# definitions have lots of overlapping queries, and an item that turned up
+# under one of them shouldn't be fetched again for the next. Items some other
+# source is working on right now are "claimed" in memory, so that sources
+# running side by side don't fetch the same thing either.
+
+from collections import Counter
+from pathlib import Path
+import sqlite3
+import threading
+
+# This is BASE_DIR/crawl_journal.db; as with response_cache, utilities imports
+# us, so we can't import BASE_DIR from it.
+JOURNAL_PATH = 'lc_etl/data/crawl_journal.db'
+
+# SQLite's default limit on variables per statement is 999.
+QUERY_CHUNK_SIZE = 500
+
+_journals = {}
+_journals_lock = threading.Lock()
+
+
+class CrawlJournal(object):
+    """Tracks completed search pages and items in a SQLite file, so that
+    restarted crawls can skip work that's already done."""
+
+    def __init__(self, path=None):
+        super(CrawlJournal, self).__init__()
+        self.path = path or JOURNAL_PATH
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        # Writes are serialized by self.lock, so it's safe to share this
+        # connection between harvesting threads.
+        self.db = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        self.lock = threading.Lock()
+        # item_id: source, for items being harvested right now.
+        self.claims = {}
+        # (source, other source): number of items `source` turned up that a
+        # different source had already harvested or claimed.
+        self.overlaps = Counter()
+
+        with self.lock:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS queries '
+                '(query TEXT PRIMARY KEY, last_page INTEGER, finished INTEGER)'
+            )
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS items (item_id TEXT PRIMARY KEY, source TEXT)'
+            )
+            # Journals from before we tracked sources.
+            columns = [row[1] for row in self.db.execute('PRAGMA table_info(items)')]
+            if 'source' not in columns:
+                self.db.execute('ALTER TABLE items ADD COLUMN source TEXT')
+            self.db.commit()
+
+
+    def last_page(self, query):
+        """Returns (last completed page, whether the query is finished)."""
+        with self.lock:
+            row = self.db.execute(
+                'SELECT last_page, finished FROM queries WHERE query = ?', (query,)
+            ).fetchone()
+
+        if row:
+            return row[0], bool(row[1])
+        else:
+            return 0, False
+
+
+    def complete_page(self, query, page, finished=False):
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO queries VALUES (?, ?, ?)',
+                (query, page, int(finished))
+            )
+            self.db.commit()
+
+
+    def has_item(self, item_id):
+        with self.lock:
+            return bool(self.db.execute(
+                'SELECT 1 FROM items WHERE item_id = ?', (item_id,)
+            ).fetchone())
+
+
+    def complete_items(self, item_ids, source=None):
+        item_ids = list(item_ids)
+        with self.lock:
+            self.db.executemany(
+                'INSERT OR IGNORE INTO items VALUES (?, ?)',
+                [(item_id, source) for item_id in item_ids]
+            )
+            self.db.commit()
+            for item_id in item_ids:
+                self.claims.pop(item_id, None)
+
+
+    def claim_items(self, item_ids, source=None):
+        """
+        Claims for `source` every item in `item_ids` that no source has
+        harvested or claimed yet, and returns {item_id: other source} for the
+        rest (other source is None for items journaled before we tracked
+        sources). Claims last until complete_items or release_items.
+        """
+        item_ids = list(dict.fromkeys(item_ids))
+        seen = {}
+
+        with self.lock:
+            for i in range(0, len(item_ids), QUERY_CHUNK_SIZE):
+                chunk = item_ids[i:i + QUERY_CHUNK_SIZE]
+                seen.update(self.db.execute(
+                    f'SELECT item_id, source FROM items WHERE item_id IN '
+                    f'({", ".join("?" * len(chunk))})', chunk
+                ).fetchall())
+
+            for item_id in item_ids:
+                if item_id in seen:
+                    continue
+                if item_id in self.claims:
+                    seen[item_id] = self.claims[item_id]
+                else:
+                    self.claims[item_id] = source
+
+            for other_source in seen.values():
+                if other_source != source:
+                    self.overlaps[(source, other_source)] += 1
+
+        return seen
+
+
+    def release_items(self, item_ids):
+        """Gives up claims on items we failed to harvest, so that another
+        source may try them."""
+        with self.lock:
+            for item_id in item_ids:
+                self.claims.pop(item_id, None)
+
+
+    def forget_query(self, query):
+        with self.lock:
+            self.db.execute('DELETE FROM queries WHERE query = ?', (query,))
+            self.db.commit()
+
+
+def get_journal(path=None):
+    """Returns the shared journal for `path` (default JOURNAL_PATH)."""
+    path = path or JOURNAL_PATH
+    with _journals_lock:
+        if path not in _journals:
+            _journals[path] = CrawlJournal(path)
+        return _journals[path]
+
+
+def close_journals():
+    with _journals_lock:
+        for journal in _journals.values():
+            journal.db.close()
+        _journals.clear()
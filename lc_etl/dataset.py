@@ -1,61 +1,159 @@
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import importlib
 import logging
 from pathlib import Path
+import time
 
 from locr import Fetcher
 
+from . import response_cache
 from .lc_items import slurp_items
 from .lc_collections import slurp_collections
 from .newspapers import slurp_newspapers
-from .utilities import slurp, initialize_logger, BASE_DIR
+from .utilities import (slurp, initialize_logger, configure_harvest,
+                        log_connection_stats, log_overlaps, in_context,
+                        source_group, SourceGroupFilter, BASE_DIR)
 
 
 def _normalize(dataset_path):
     return Path(dataset_path).parts[-1].replace('.py', '')
 
 
-def run(dataset_path, logfile='dataset.log'):
-    initialize_logger(logfile)
+def _harvest_collections(data_def, refresh):
+    slurp_collections(data_def.collections, refresh=refresh)
 
-    data_def = __import__(
-        f'dataset_definitions.{_normalize(dataset_path)}',
-        fromlist=['collections', 'date_filtered_collections', 'items', 'queries', 'newspapers']
-    )
 
-    try:
-        logging.info('Fetching data from collections...')
-        slurp_collections(data_def.collections)
-    except AttributeError:
-        logging.info('No collections defined.')
+def _harvest_date_filtered_collections(data_def, refresh):
+    slurp_collections(data_def.date_filtered_collections, filter_for_dates=True,
+                      refresh=refresh)
 
-    try:
-        logging.info('Fetching data from date-filtered collections...')
-        slurp_collections(data_def.date_filtered_collections, filter_for_dates=True)
-    except AttributeError:
-        logging.info('No date-filtered collections defined.')
 
-    try:
-        logging.info('Fetching data from queries...')
-        for query in data_def.queries:
-            logging.info(query)
-            slurp(url=query)
-    except AttributeError:
-        logging.info('No queries defined.')
+def _harvest_queries(data_def, refresh):
+    for query in data_def.queries:
+        logging.info(query)
+        slurp(url=query, refresh=refresh)
+
+
+def _harvest_items(data_def, refresh):
+    slurp_items(data_def.items, refresh=refresh)
 
+
+def _harvest_newspapers(data_def, refresh):
+    # Keys are passed straight through, so a definition may set any of
+    # goal_dates, count and download_workers.
+    slurp_newspapers(**data_def.newspapers)
+
+
+# (dataset definition attribute, description, harvester), in the order
+# they've always run in.
+SOURCE_GROUPS = [
+    ('collections', 'collections', _harvest_collections),
+    ('date_filtered_collections', 'date-filtered collections', _harvest_date_filtered_collections),
+    ('queries', 'queries', _harvest_queries),
+    ('items', 'items', _harvest_items),
+    ('newspapers', 'ChronAm', _harvest_newspapers),
+]
+
+
+def _harvest_group(data_def, name, description, harvester, refresh):
+    token = source_group.set(name)
     try:
-        logging.info('Fetching data from items...')
-        slurp_items(data_def.items)
-    except AttributeError:
-        logging.info('No items defined.')
+        if getattr(data_def, name, None) is None:
+            logging.info(f'No {description} defined.')
+            return
+
+        logging.info(f'Fetching data from {description}...')
+        start = time.monotonic()
+        harvester(data_def, refresh)
+        logging.info(f'Finished {description} in {time.monotonic() - start:.0f}s')
+    finally:
+        source_group.reset(token)
+
+
+def _group_logfile(logfile, name):
+    path = Path(logfile)
+    return str(path.with_name(f'{path.stem}.{name}{path.suffix}'))
+
+
+def _harvest_in_parallel(data_def, logfile, refresh):
+    # Each group also gets a log of its own (dataset.queries.log and so on),
+    # since their lines are all interleaved in the main one.
+    handlers = []
+    for name, _, _ in SOURCE_GROUPS:
+        handler = logging.FileHandler(_group_logfile(logfile, name))
+        handler.setFormatter(logging.Formatter("%(asctime)s:%(levelname)s:%(message)s"))
+        handler.addFilter(SourceGroupFilter(name))
+        logging.getLogger().addHandler(handler)
+        handlers.append(handler)
 
     try:
-        logging.info('Fetching data from ChronAm...')
-        if data_def.newspapers.get('goal_dates'):
-            slurp_newspapers(goal_dates=data_def.newspapers['goal_dates'])
-        elif data_def.newspapers.get('count'):
-            slurp_newspapers(count=data_def.newspapers['count'])
-        else:
-            slurp_newspapers()
-    except AttributeError:
-        logging.info('No newspapers defined')
+        with ThreadPoolExecutor(max_workers=len(SOURCE_GROUPS)) as executor:
+            futures = {
+                executor.submit(
+                    in_context(_harvest_group), data_def, name, description, harvester, refresh
+                ): description
+                for name, description, harvester in SOURCE_GROUPS
+            }
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception:
+                    # One group failing shouldn't take the others down with it.
+                    logging.exception(f'Harvesting {futures[future]} failed')
+    finally:
+        for handler in handlers:
+            logging.getLogger().removeHandler(handler)
+            handler.close()
+
+
+def run(dataset_path, logfile='dataset.log', concurrency=None,
+        requests_per_second=None, cache_only=False, refresh=False,
+        save_records=False, parallel=False, quality_gate=False):
+    """
+    Downloads every fulltext described by the given dataset definition.
+
+    `concurrency` and `requests_per_second` tune the fulltext harvester (see
+    utilities.CONCURRENCY and utilities.REQUESTS_PER_SECOND for the defaults);
+    `requests_per_second` is a ceiling the rate may climb to while loc.gov
+    keeps up (see throttle).
+    With `cache_only`, API responses come only from the local response cache
+    (see response_cache); fulltexts themselves are not cached.
+
+    Progress is kept in the crawl journal, so if a run dies, running it again
+    resumes where it stopped. The journal also keeps track of every item any
+    source has harvested, so items turned up by several queries or
+    collections are only fetched once. Pass `refresh=True` to ignore the
+    journal and refetch everything.
+
+    With `save_records`, each harvested item's search result is kept too (see
+    utilities.SAVE_RECORDS), so that fetch_metadata can skip most item calls.
+
+    With `parallel`, the groups of sources (collections, queries, ChronAm and
+    so on; see SOURCE_GROUPS) are harvested side by side rather than one
+    after another. They still share one rate limit per host, so this mostly
+    helps by overlapping ChronAm's big downloads with everyone else's API
+    calls. Each group also logs to a file of its own.
+
+    With `quality_gate`, fulltexts and newspaper pages are scored with
+    filter_ocr's estimator as they come in, and those it would delete are
+    never written (see utilities.QUALITY_GATE). This needs the spacy model,
+    but saves writing (and later rereading) the worst of the corpus.
+    """
+    initialize_logger(logfile)
+    configure_harvest(concurrency, requests_per_second, save_records, quality_gate)
+    response_cache.configure(cache_only=cache_only)
+
+    data_def = __import__(
+        f'dataset_definitions.{_normalize(dataset_path)}',
+        fromlist=[name for name, _, _ in SOURCE_GROUPS]
+    )
+
+    if parallel:
+        _harvest_in_parallel(data_def, logfile, refresh)
+    else:
+        for name, description, harvester in SOURCE_GROUPS:
+            _harvest_group(data_def, name, description, harvester, refresh)
+
+    log_overlaps()
+    log_connection_stats()
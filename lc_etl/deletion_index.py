@@ -0,0 +1,85 @@
+# Finds the dictionary words that are within a few edits of a given word, or
+# that contain it, without looking at the whole dictionary.
+#
+# This is the symmetric delete trick from SymSpell: if two words are within
+# n edits (insertions, deletions, substitutions) of each other, then deleting
+# at most n letters from each of them gives some string in common. So we
+# index every dictionary word under every string you can get by deleting up to
+# max_distance of its letters; looking up a word's own deletes then gives a
+# short list of candidates, which we check with Levenshtein.distance. Deletes
+# are only worth indexing for words short enough to ever be close to a query
+# (see max_query_length), which keeps the index from getting out of hand.
+#
+# For "contains", words are indexed under each pair of adjacent letters they
+# have; a word of two or more letters can only be in the words listed under
+# its rarest pair.
+#
+# filter_nonwords uses this to avoid scoring the whole vocabulary for every
+# nonword; see CandidateFilter there.
+
+from collections import defaultdict
+
+import Levenshtein
+
+MAX_DISTANCE = 2
+
+
+def deletes(word, distance):
+    """`word`, and everything you can get by deleting up to `distance` of its
+    letters."""
+    variants = {word}
+    frontier = {word}
+    for _ in range(distance):
+        frontier = {variant[:i] + variant[i + 1:] for variant in frontier for i in range(len(variant))}
+        variants |= frontier
+    return variants
+
+
+def bigrams(word):
+    return {word[i:i + 2] for i in range(len(word) - 1)}
+
+
+class DeletionIndex(object):
+    """
+    An index of `words`. `max_query_length` is the longest word that will be
+    looked up with within(); by default, no limit.
+    """
+
+    def __init__(self, words, max_distance=MAX_DISTANCE, max_query_length=None):
+        super(DeletionIndex, self).__init__()
+        self.words = list(words)
+        self.max_distance = max_distance
+        self.deletes = defaultdict(list)
+        self.bigrams = defaultdict(list)
+
+        for i, word in enumerate(self.words):
+            # A word can't be within max_distance of anything more than
+            # max_distance letters shorter than it.
+            if max_query_length is None or len(word) <= max_query_length + max_distance:
+                for variant in deletes(word, max_distance):
+                    self.deletes[variant].append(i)
+            for pair in bigrams(word):
+                self.bigrams[pair].append(i)
+
+
+    def within(self, word, distance):
+        """The indexes of the words within `distance` (at most max_distance)
+        edits of `word`."""
+        if distance > self.max_distance:
+            raise ValueError(f'This index only goes up to {self.max_distance} edits')
+
+        candidates = set()
+        for variant in deletes(word, distance):
+            candidates.update(self.deletes.get(variant, ()))
+
+        return {i for i in candidates if Levenshtein.distance(word, self.words[i]) <= distance}
+
+
+    def containing(self, word):
+        """The indexes of the words that contain `word`, which must be at
+        least two letters long."""
+        if len(word) < 2:
+            raise ValueError('Can only look up words of two or more letters')
+
+        postings = [self.bigrams.get(pair, []) for pair in bigrams(word)]
+        return {i for i in min(postings, key=len) if word in self.words[i]}
@@ -5,39 +5,40 @@
 # - count everything over .65
 
 from collections import Counter
-from pathlib import Path
 
 import gensim
 
+from .corpus_store import open_corpus
+from .vector_index import get_index
 
-def _get_doc2vec_tag(txt_path, target_dir):
-    sub_path = txt_path.relative_to(target_dir)
-    return str(sub_path).replace('ocr.txt', '').rstrip('/')
 
-
-def estimate(target_dir, model_path, topn=100, threshold=0.65):
+def estimate(target_dir, model_path, topn=100, threshold=0.65, index=None):
+    """
+    `index` is a kind of vector_index (like 'ivf') to find neighbors with, or
+    None to use gensim's exact search.
+    """
     model = gensim.models.Doc2Vec.load(model_path)
+    docvecs = model.dv
+    if index:
+        docvecs = get_index(model_path, model.dv, 'dv', index)
     count = 0
     stats = []
 
-    for txt_path in Path(target_dir).rglob('**/*'):
+    for entry in open_corpus(target_dir).entries():
         count += 1
 
         # Only sampling every thousandth file to save time.
         if not count % 1000 == 0:
             continue
 
-        if not txt_path.is_file():
-            continue
-
         # .DS_Store or whatever.
-        if txt_path.name.startswith('.'):
+        if entry.doc_id.split('/')[-1].startswith('.'):
             continue
 
-        tag = _get_doc2vec_tag(txt_path, target_dir)
+        tag = entry.tag
 
         try:
-            neighbors = model.docvecs.most_similar(tag, topn=topn)
+            neighbors = docvecs.most_similar(tag, topn=topn)
         except KeyError:
             print(f'Could not find {tag}')
             continue
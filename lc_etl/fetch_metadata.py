@@ -2,16 +2,26 @@
 # requirements stabilize a bit.
 
 from argparse import ArgumentParser
-import glob
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
 import json
 import logging
 from pathlib import Path
 import re
 import shutil
-from time import sleep
-from urllib.parse import urljoin
+import threading
+from urllib.parse import urljoin, quote_plus
 
-from .utilities import http_adapter, make_timestamp, initialize_logger, BASE_DIR
+import requests
+
+from . import batch_resolver, response_cache
+from .corpus_store import open_corpus
+from .response_cache import cached_get
+from . import utilities
+from .utilities import (http_adapter, make_timestamp, initialize_logger,
+                        log_connection_stats, BASE_DIR, TIMEOUT)
+from .throttle import get_limiter
 
 
 # We need this later in zip_csv to write the csv correctly. Don't deviate from
@@ -35,10 +45,45 @@ STATES = {
     'Washington', 'West Virginia', 'Wisconsin', 'Wyoming'
 }
 
+ITEM_URL = 'https://www.loc.gov/item/{identifier}/?fo=json'
+COLLECTIONS_URL = 'https://www.loc.gov/collections/?fo=json&c=500'
+FAILED_CALLS = 'failed_calls.txt'
+
+# Look items up a batch at a time via the search API before falling back to
+# one item request apiece (see batch_resolver). Off by default, since search
+# results aren't quite the same data as item JSON; run(batch=True) turns it
+# on.
+BATCH_LOOKUPS = False
+
+# Item requests are paced by loc.gov's shared, adaptive limiter (see
+# throttle); run(requests_per_second=...) lets it speed up to that.
+rate_limiter = get_limiter('www.loc.gov')
+
+_failed_calls_lock = threading.Lock()
+_collections_lock = threading.Lock()
+_collection_urls = None
+_collection_urls_fetched = False
+
+# The item JSON fields we read. A saved search record (see
+# utilities.SAVE_RECORDS) has to supply all of them, or we go to the item
+# endpoint for whatever it lacks.
+ITEM_FIELDS = [
+    'partof', 'title', 'subjects', 'subject_headings', 'location',
+    'description', 'date', 'url', 'image_url'
+]
+
+
 class NoMetadataFound(Exception):
     pass
 
 
+def record_failed_call(identifier):
+    # Several workers may fail at once; don't let their lines interleave.
+    with _failed_calls_lock:
+        with open(FAILED_CALLS, 'a') as f:
+            f.write(f"{identifier}\n")
+
+
 class BaseMetadataFetcher(object):
     """Parent class containing shared logic for retrieving metadata for both
     ChronAm and regular LOC items. Logic specific to one object type belongs
@@ -111,10 +156,10 @@ class BaseMetadataFetcher(object):
             # lot of times.
             item_json = self.cache[self.identifier]
         else:
-            with self.http as h:
-                response = h.get(f'https://www.loc.gov/item/{self.identifier}/?fo=json')
-            sleep(0.5)  # rate limits
             try:
+                # With cache_only, this raises CacheMiss for anything we never
+                # cached, which counts as a failed call like any other.
+                response = cached_get(self.http, ITEM_URL.format(identifier=self.identifier))
                 # Pages that 404 will return a 404 status code but an actual
                 # parseable JSON body. That body doesn't contain an 'item' key,
                 # so the way it's currently structured (28 December 2021), it
@@ -124,15 +169,14 @@ class BaseMetadataFetcher(object):
                 assert response.status_code == 200
                 item_json = response.json()['item']
                 self.cache[self.identifier] = item_json
-            except (AssertionError, KeyError, json.decoder.JSONDecodeError):
-                with open('failed_calls.txt', 'a') as f:
-                    f.write(f"{self.identifier}\n")
+            except (response_cache.CacheMiss, AssertionError, KeyError,
+                    json.decoder.JSONDecodeError):
+                record_failed_call(self.identifier)
 
         try:
             self.json = item_json
         except NameError:
-            with open('failed_calls.txt', 'a') as f:
-                f.write(f"{self.identifier}\n")
+            record_failed_call(self.identifier)
             raise NoMetadataFound
 
 
@@ -171,9 +215,14 @@ class ChronAmMetadataFetcher(BaseMetadataFetcher):
         return cls.newspaper_pattern.search(idx).group(1).strip()
 
 
+    @classmethod
+    def path_for(cls, idx):
+        before, after = idx.split(cls.extract_identifier(idx))
+        return idx.replace(before, '').replace('ocr.txt', '')
+
+
     def extract_path(self):
-        before, after = self.idx.split(self.extract_identifier(self.idx))
-        return self.idx.replace(before, '').replace('ocr.txt', '')
+        return self.path_for(self.idx)
 
 
     def add_newspaper_info(self):
@@ -214,6 +263,103 @@ class ChronAmMetadataFetcher(BaseMetadataFetcher):
         return {self.identifier: self.metadata}
 
 
+    def fan_out(self, indices):
+        """
+        Once this fetcher has fetched and parsed its lccn's item metadata,
+        yields (idx, result) for every page in `indices` (which must share
+        that lccn), filling in only the per-page fields. This lets us handle
+        a whole newspaper run with one request and one parse.
+        """
+        base_metadata = self.metadata
+
+        for idx in indices:
+            self.idx = idx
+            self.metadata = dict(base_metadata)
+            self.add_newspaper_info()
+            yield idx, {self.identifier: self.metadata}
+
+        self.metadata = base_metadata
+
+
+def collection_urls():
+    """
+    Returns {collection title: collection URL} for every loc.gov collection,
+    with lowercased titles (as they appear in search results' partof), or
+    None if we couldn't get the whole list. Fetched at most once per run.
+    """
+    global _collection_urls, _collection_urls_fetched
+
+    with _collections_lock:
+        if not _collection_urls_fetched:
+            _collection_urls_fetched = True
+            urls = {}
+            url = COLLECTIONS_URL
+            try:
+                while url:
+                    response = cached_get(http_adapter(), url, timeout=TIMEOUT).json()
+                    for result in response['results']:
+                        urls[result['title'].lower()] = result['url']
+                    url = response['pagination']['next']
+                _collection_urls = urls
+            except (requests.exceptions.RequestException, ValueError, KeyError):
+                # A partial list would make us quietly drop collections, so
+                # have none at all.
+                logging.exception("Couldn't list collections")
+
+        return _collection_urls
+
+
+def _record_path(identifier):
+    return Path(utilities.RECORDS_DIR) / f'{identifier}.json'
+
+
+def _is_item_json(record):
+    # Search results have partof as a list of names; the item endpoint (and
+    # so lc_items, which saves what it gets from there) has dicts with URLs.
+    partof = record.get('partof')
+    return bool(partof) and all(isinstance(x, dict) for x in partof)
+
+
+def item_json_from_record(record):
+    """
+    Translates a record saved by utilities.save_record into as much of the
+    item endpoint's JSON as it can support. Returns (item_json, missing),
+    where `missing` lists the ITEM_FIELDS the record couldn't supply; those
+    are left out rather than guessed at.
+    """
+    if _is_item_json(record):
+        # Whatever it lacks, the item endpoint would lack too.
+        return record, []
+
+    item_json = {
+        key: record[key] for key in
+        ['title', 'location', 'description', 'date', 'url', 'image_url',
+         'subject_headings']
+        if key in record
+    }
+
+    # Search results have their subjects as bare strings, so rebuild the
+    # subject-search links the item endpoint gives us.
+    if 'subject' in record:
+        item_json['subjects'] = [
+            {subject: f'https://www.loc.gov/search/?fa=subject:{quote_plus(subject)}&fo=json'}
+            for subject in record['subject']
+        ]
+
+    # get_collections needs URLs to tell collections from divisions, and
+    # search results only have names, so look them up in the collections
+    # list. Anything that isn't there isn't a collection.
+    if 'partof' in record:
+        collections = collection_urls()
+        if collections is not None:
+            item_json['partof'] = [
+                {'title': name, 'url': collections[name]}
+                for name in record['partof'] if name in collections
+            ]
+
+    return item_json, [field for field in ITEM_FIELDS if field not in item_json]
+
+
 class ItemMetadataFetcher(BaseMetadataFetcher):
     """Contains logic for retriving metadata which is specific to ordinary LOC
     objects."""
@@ -224,6 +370,30 @@ class ItemMetadataFetcher(BaseMetadataFetcher):
         self.idx = idx
 
 
+    def load_record(self):
+        try:
+            with open(_record_path(self.identifier)) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            return None
+
+
+    def set_item_json(self):
+        record = self.load_record()
+        if record is None:
+            return super(ItemMetadataFetcher, self).set_item_json()
+
+        item_json, missing = item_json_from_record(record)
+
+        if missing:
+            logging.info(f'Search record for {self.identifier} lacks {missing}; fetching item')
+            super(ItemMetadataFetcher, self).set_item_json()
+            # Prefer the record's values for everything it does have.
+            self.json = {**self.json, **item_json}
+        else:
+            self.json = item_json
+
+
     def add_results_info(self):
         self.metadata['date'] = self.json.get('date')            # YYYY or YYYY-MM-DD
         self.metadata['year'] = self.metadata['date'][:4]
@@ -256,88 +426,222 @@ class ItemMetadataFetcher(BaseMetadataFetcher):
 # write file
 # TODO
 #   - find out what kinds of date results I can get and standardize them
-#   - can I batch API calls for efficiency?
 #   - register handlers for the columns somewhere so you can DRY out initialize_csv and the item loop
 #   - why is chronam date not matching
 
 
-def _inner_fetch(identifiers, overwrite):
+def _fetch_one(idx, cache, overwrite):
+    idx = idx.strip()
+    logging.info(f'Processing {idx}...')
+
+    if BaseMetadataFetcher.is_chronam(idx):
+        fetcher = ChronAmMetadataFetcher(cache, idx)
+    else:
+        fetcher = ItemMetadataFetcher(cache, idx)
+
+    idx_path = fetcher.extract_path()
+
+    # ChronAm identifiers are whole directory structures, with the lccn for
+    # the entire newspaper run at the top, followed by subdirectories for
+    # dates and editions. We want to preserve this whole structure so that
+    # different images from the same newspaper can have different metadata.
+    # This means we need to ensure that the whole filepath exists, even
+    # though we don't know how long it is.
+    output_path = Path(OUTPUT_DIR) / idx_path
+
+    # If we have already downloaded this metadata, don't bother doing
+    # it again.
+    if Path(output_path).is_file() and not overwrite:
+        logging.info(f'{output_path} found, not fetching')
+        return
+
+    try:
+        logging.info(f'Downloading new data for {idx}')
+        result = fetcher.fetch()
+    except:
+        logging.exception(f"Couldn't get metadata for {idx}")
+        return
+
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with output_path.open('w') as f:
+        json.dump(result, f)
+
+
+def _with_batch_lookups(identifiers, overwrite):
+    """
+    Yields `identifiers` unchanged, but first looks each batch of them up via
+    batch_resolver, and saves whatever it finds as search records for
+    ItemMetadataFetcher to use.
+    """
+    identifiers = iter(identifiers)
+
+    while True:
+        batch = list(islice(identifiers, batch_resolver.BATCH_SIZE))
+        if not batch:
+            return
+
+        wanted = []
+        for idx in batch:
+            idx = idx.strip()
+            if BaseMetadataFetcher.is_chronam(idx):
+                continue
+            identifier = ItemMetadataFetcher.extract_identifier(idx)
+            if _record_path(identifier).is_file():
+                continue
+            if (Path(OUTPUT_DIR) / identifier).is_file() and not overwrite:
+                continue
+            wanted.append(identifier)
+
+        if wanted:
+            # Whatever the search misses, ItemMetadataFetcher gets from the
+            # item endpoint itself, under our rate limiter.
+            for result in batch_resolver.resolve(wanted, fallback=False).values():
+                utilities.save_record(result)
+
+        yield from batch
+
+
+def _inner_fetch(identifiers, overwrite, workers=1):
     """
-    Takes an iterable of LC identifiers and fetches their metadata.
+    Takes an iterable of LC identifiers and fetches their metadata. With more
+    than one worker, that many identifiers are handled at once; the shared
+    rate_limiter still governs how often we actually hit the server.
     """
     cache = {}
 
-    for idx in identifiers:
-        results_metadata = {}
-        idx = idx.strip()
-        logging.info(f'Processing {idx}...')
+    if BATCH_LOOKUPS:
+        identifiers = _with_batch_lookups(identifiers, overwrite)
 
-        if BaseMetadataFetcher.is_chronam(idx):
-            fetcher = ChronAmMetadataFetcher(cache, idx)
-        else:
-            fetcher = ItemMetadataFetcher(cache, idx)
-
-        idx_path = fetcher.extract_path()
-
-        # ChronAm identifiers are whole directory structures, with the lccn for
-        # the entire newspaper run at the top, followed by subdirectories for
-        # dates and editions. We want to preserve this whole structure so that
-        # different images from the same newspaper can have different metadata.
-        # This means we need to ensure that the whole filepath exists, even
-        # though we don't know how long it is.
-        output_path = Path(OUTPUT_DIR) / idx_path
-
-        # If we have already downloaded this metadata, don't bother doing
-        # it again.
-        if Path(output_path).is_file() and not overwrite:
-            logging.info(f'{output_path} found, not fetching')
-            continue
+    if workers <= 1:
+        for idx in identifiers:
+            _fetch_one(idx, cache, overwrite)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # identifiers may be a glob over a million files, so only keep a
+        # couple of identifiers per worker queued up, rather than submitting
+        # everything at once.
+        in_flight = set()
+        for idx in identifiers:
+            if len(in_flight) >= 2 * workers:
+                _, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            in_flight.add(executor.submit(_fetch_one, idx, cache, overwrite))
 
-        try:
-            logging.info(f'Downloading new data for {idx}')
-            result = fetcher.fetch()
-        except:
-            logging.exception(f"Couldn't get metadata for {idx}")
-            continue
 
+def _fetch_lccn(lccn, indices, overwrite):
+    """
+    Fetches metadata for every page of one ChronAm title, which all share the
+    lccn's item record, and writes one file per page.
+    """
+    output_paths = {
+        idx: Path(OUTPUT_DIR) / ChronAmMetadataFetcher.path_for(idx)
+        for idx in indices
+    }
+
+    if not overwrite:
+        output_paths = {
+            idx: path for idx, path in output_paths.items() if not path.is_file()
+        }
+        if not output_paths:
+            logging.info(f'All {len(indices)} pages of {lccn} found, not fetching')
+            return
+
+    logging.info(f'Downloading new data for {lccn} ({len(output_paths)} pages)')
+    fetcher = ChronAmMetadataFetcher({}, next(iter(output_paths)))
+
+    try:
+        # This is BaseMetadataFetcher.fetch, without the per-page part.
+        fetcher.set_identifier()
+        fetcher.set_item_json()
+        fetcher.parse_item_metadata()
+    except:
+        logging.exception(f"Couldn't get metadata for {lccn}")
+        return
+
+    for idx, result in fetcher.fan_out(list(output_paths)):
+        output_path = output_paths[idx]
         output_path.parent.mkdir(parents=True, exist_ok=True)
         with output_path.open('w') as f:
             json.dump(result, f)
 
 
-def _fetch(identifiers, newspaper_dir, results_dir, overwrite):
+def _fetch_grouped(identifiers, overwrite, workers=1):
+    """
+    Like _inner_fetch, but for ChronAm pages only: buckets every page by lccn
+    first, so that each lccn's item record is requested and parsed just once
+    no matter how many thousands of pages it has.
+    """
+    by_lccn = defaultdict(list)
+    for idx in identifiers:
+        idx = idx.strip()
+        if not BaseMetadataFetcher.is_chronam(idx):
+            logging.warning(f'{idx} is not a ChronAm page; skipping')
+            continue
+        by_lccn[ChronAmMetadataFetcher.extract_identifier(idx)].append(idx)
+
+    logging.info(f'Found {sum(len(x) for x in by_lccn.values())} pages from {len(by_lccn)} titles')
+
+    if workers <= 1:
+        for lccn, indices in by_lccn.items():
+            _fetch_lccn(lccn, indices, overwrite)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for lccn, indices in by_lccn.items():
+            executor.submit(_fetch_lccn, lccn, indices, overwrite)
+
+
+def _corpus_paths(target_dir, pattern='*', recursive=True):
+    # The fetchers work out identifiers from file paths, so hand them paths
+    # under target_dir, even if the corpus there is packed.
+    for doc_id in open_corpus(target_dir).ids(pattern, recursive=recursive):
+        yield f'{target_dir}/{doc_id}'
+
+
+def _fetch(identifiers, newspaper_dir, results_dir, overwrite, workers=1,
+           grouped=False):
     """
     Fetches metadata for ALL identifiers passed in by any of the following
     options: identifiers, newspaper_dir, results_dir.
     If the same identifier is found in multiple places, it will be cached
     from the first time and not refetched.
+    With `grouped`, newspaper pages are handled a whole lccn at a time (see
+    _fetch_grouped).
     """
 
     if identifiers:
         with open(identifiers, 'r') as identifiers:
             next(identifiers)   # skip header row
 
-            _inner_fetch(identifiers, overwrite)
+            _inner_fetch(identifiers, overwrite, workers)
 
-    # Don't do try/except here! The glob statement will work even if
+    # Don't do try/except here! Listing the corpus will work even if
     # newspaper_dir is None; it will just search your entire computer,
     # from / .
     if newspaper_dir:
-        _inner_fetch(glob.iglob(
-            f'{newspaper_dir}/**/ocr.txt', recursive=True
-        ), overwrite)
+        fetch_function = _fetch_grouped if grouped else _inner_fetch
+        fetch_function(_corpus_paths(newspaper_dir, 'ocr.txt'), overwrite, workers)
 
     if results_dir:
-        _inner_fetch(glob.iglob(f'{results_dir}/*'), overwrite)
+        _inner_fetch(_corpus_paths(results_dir, recursive=False), overwrite, workers)
 
 
 def run(identifiers=None, newspaper_dir=None, results_dir=None,
-        logfile='fetch_metadata.log', overwrite=False):
+        logfile='fetch_metadata.log', overwrite=False, cache_only=False,
+        workers=1, requests_per_second=None, grouped=False, batch=False):
+    global BATCH_LOOKUPS
 
     if not any([identifiers, newspaper_dir, results_dir]):
         print('Must provide at least one source of identifiers')
         import sys; sys.exit()
 
     initialize_logger(logfile)
-
-    _fetch(identifiers, newspaper_dir, results_dir, overwrite)
+    # With cache_only, identifiers whose item JSON was never cached will fail
+    # (and be logged to failed_calls.txt) rather than going to the network.
+    response_cache.configure(cache_only=cache_only)
+    if requests_per_second is not None:
+        rate_limiter.probe_up_to(requests_per_second)
+    BATCH_LOOKUPS = batch
+
+    _fetch(identifiers, newspaper_dir, results_dir, overwrite, workers, grouped)
+    log_connection_stats()
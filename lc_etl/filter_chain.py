@@ -0,0 +1,235 @@
+# Runs all the cleaning filters over the corpus in one pass.
+#
+# run_pipeline.py used to run filter_ocr, three bulk_scripts, filter_nonwords
+# and filter_newspaper_locations one after another, each reading and
+# rewriting every file, so the whole corpus crossed the disk six or more
+# times. Here each of those is a step: a callable that takes a document's
+# text (and its corpus_manifest.Entry) and returns the new text, or None to
+# drop the document. run() reads each document once, passes it down the chain
+# in memory, and then writes it once (if it changed) or deletes it (if some
+# step dropped it).
+#
+# Each step only sees the documents its old pass did (see Step.pattern), and
+# newspaper_steps/results_steps put them in the same order as run_pipeline.py
+# did, so the output should be the same as it ever was. (One wrinkle:
+# run_pipeline.py called remove_frontmatter.sh by an absolute path,
+# /lc_etl/bulk_scripts/..., that doesn't exist, so newspaper frontmatter was
+# never actually removed. RemoveFrontmatter is therefore only in the
+# newspaper chain if you ask for it.)
+#
+# Usage:
+# from lc_etl import filter_chain
+# filter_chain.run(target_dir, filter_chain.newspaper_steps(model_path, metadata_dir))
+
+from collections import Counter
+import logging
+import re
+
+from . import filter_newspaper_locations, filter_nonwords, filter_ocr
+from .corpus_manifest import matches
+from .corpus_store import open_corpus
+from .utilities import initialize_logger
+
+# These are the defaults of the bulk_scripts.
+FRONTMATTER_LINES = 10
+ARCHIVAL_NOTES_LINES = 10
+archival_note = re.compile(r'Box [0-9]+\s+Folder [0-9]+')
+transcription_attribution = re.compile(
+    'Transcribed and reviewed by contributors participating in the By The People project at crowd.loc.gov'
+)
+
+
+def drop_lines(text, count):
+    """What `sed "1,{count}d"` does."""
+    return '\n'.join(text.split('\n')[count:])
+
+
+class Step(object):
+    """
+    One filter in a chain. Subclasses define __call__(text, entry), which
+    returns the filtered text, or None if the document should be dropped.
+    Only documents matching `pattern` (as for Path.rglob) are passed in.
+    """
+    pattern = '*'
+
+    def applies_to(self, entry):
+        return matches(entry, self.pattern)
+
+    def close(self):
+        pass
+
+    def __repr__(self):
+        return type(self).__name__
+
+
+class FilterOcr(Step):
+    """filter_ocr: drops documents with too few dictionary words."""
+    pattern = '*.txt'
+
+    def __call__(self, text, entry):
+        return text if filter_ocr.passes_quality(text) else None
+
+
+class RemoveFrontmatter(Step):
+    """bulk_scripts/remove_frontmatter.sh: drops the first few lines."""
+
+    def __init__(self, lines=FRONTMATTER_LINES):
+        super(RemoveFrontmatter, self).__init__()
+        self.lines = lines
+
+    def __call__(self, text, entry):
+        return drop_lines(text, self.lines)
+
+
+class RemoveArchivalNotes(Step):
+    """bulk_scripts/remove_archival_notes_gentle.sh: drops the first few lines
+    of documents that mention a box and folder."""
+
+    def __init__(self, lines=ARCHIVAL_NOTES_LINES):
+        super(RemoveArchivalNotes, self).__init__()
+        self.lines = lines
+
+    def __call__(self, text, entry):
+        if archival_note.search(text):
+            return drop_lines(text, self.lines)
+        return text
+
+
+class RemoveTranscriptionAttribution(Step):
+    """bulk_scripts/remove_transcription_attribution.sh: drops the By The
+    People credit line."""
+
+    def __call__(self, text, entry):
+        return '\n'.join(
+            line for line in text.split('\n')
+            if not transcription_attribution.search(line)
+        )
+
+
+class ReplaceNonwords(Step):
+    """filter_nonwords, sharing its cache of replacements. `index` and
+    `prefilter` are as for filter_nonwords.run."""
+
+    def __init__(self, model_path, index=None, prefilter=False):
+        super(ReplaceNonwords, self).__init__()
+        self.nlp, self.model = filter_nonwords.load_models(model_path, index)
+        self.cache = filter_nonwords.get_cache(model_path)
+        self.derive = None
+        if prefilter:
+            self.derive = filter_nonwords.CandidateFilter(self.model, self.nlp)
+
+    def __call__(self, text, entry):
+        return filter_nonwords.replace_nonwords(
+            text, self.cache, self.model, self.nlp, self.derive
+        )
+
+    def close(self):
+        self.cache.log_stats()
+        self.cache.close()
+
+
+class RemoveLocations(Step):
+    """filter_newspaper_locations: drops title and place words."""
+    pattern = '*.txt'
+
+    def __init__(self, metadata_dir):
+        super(RemoveLocations, self).__init__()
+        self.metadata_dir = metadata_dir
+
+    def __call__(self, text, entry):
+        try:
+            stopwords = filter_newspaper_locations.get_stopwords(
+                entry.metadata_path(self.metadata_dir)
+            )
+        except FileNotFoundError:
+            logging.exception(f'Metadata not found for {entry.doc_id}')
+            return text
+
+        return filter_newspaper_locations.remove_stopwords(text, stopwords)
+
+
+class DropEmpty(Step):
+    """What `find -type f -empty -delete` did at the end."""
+
+    def __call__(self, text, entry):
+        return text or None
+
+
+def newspaper_steps(model_path, metadata_dir, index=None, prefilter=False,
+                    frontmatter=False):
+    """The chain run_pipeline.py runs on newspapers. With `frontmatter`,
+    RemoveFrontmatter too, which run_pipeline.py meant to but never did."""
+    steps = [FilterOcr()]
+    if frontmatter:
+        steps.append(RemoveFrontmatter())
+    steps += [
+        ReplaceNonwords(model_path, index, prefilter),
+        RemoveLocations(metadata_dir),
+        DropEmpty(),
+    ]
+    return steps
+
+
+def results_steps(model_path, index=None, prefilter=False):
+    """The chain run_pipeline.py runs on everything else."""
+    return [
+        FilterOcr(),
+        RemoveArchivalNotes(),
+        RemoveTranscriptionAttribution(),
+        ReplaceNonwords(model_path, index, prefilter),
+        DropEmpty(),
+    ]
+
+
+def filter_corpus(corpus, steps):
+    """
+    Runs every document in `corpus` through `steps` in order. Returns a
+    Counter of documents processed, changed, and dropped (in all, and by
+    each step).
+    """
+    stats = Counter()
+
+    for entry in corpus.entries():
+        doc_id = entry.doc_id
+        try:
+            original = corpus.read(doc_id)
+        except UnicodeDecodeError:
+            logging.exception(f'Could not read {doc_id}')
+            continue
+
+        text = original
+        for step in steps:
+            if not step.applies_to(entry):
+                continue
+
+            text = step(text, entry)
+            if text is None:
+                stats[f'dropped by {step}'] += 1
+                break
+
+        if text is None:
+            corpus.delete(doc_id)
+            stats['dropped'] += 1
+        elif text != original:
+            corpus.write(doc_id, text)
+            stats['changed'] += 1
+
+        stats['processed'] += 1
+        if stats['processed'] % 100 == 0:
+            logging.info(f'{stats["processed"]} documents filtered')
+
+    corpus.flush()
+    return stats
+
+
+def run(target_dir, steps, logfile='filter_chain.log'):
+    initialize_logger(logfile)
+
+    try:
+        stats = filter_corpus(open_corpus(target_dir), steps)
+    finally:
+        for step in steps:
+            step.close()
+
+    logging.info(f'Filtered {target_dir} with {steps}: {dict(stats)}')
+    return stats
@@ -19,14 +19,9 @@ import json
 import logging
 from pathlib import Path
 
+from .corpus_store import open_corpus
 from .utilities import initialize_logger
 
-def _get_metadata_path(metadata_dir, target_dir, target_path):
-    target_path = target_path.relative_to(target_dir)
-    target_string = str(target_path).replace('ocr.txt', '')
-    return Path(metadata_dir) / target_string
-
-
 def _normalize(given_list):
     return [x.lower() for x in given_list]
 
@@ -40,12 +35,11 @@ def run(collections_list, metadata_dir, target_dir, logfile='filter_collection.l
     '''
     initialize_logger(logfile)
     collections_set = set(_normalize(collections_list))
+    corpus = open_corpus(target_dir)
 
-    for target_path in Path(target_dir).rglob('*'):
-        if not target_path.is_file():
-            continue
-
-        metadata_path = _get_metadata_path(metadata_dir, target_dir, target_path)
+    for entry in corpus.entries():
+        target_path = Path(target_dir) / entry.doc_id
+        metadata_path = entry.metadata_path(metadata_dir)
 
         if not metadata_path.is_file():
             logger.warning(f'Metadata not fond at {metadata_path} for {target_path}')
@@ -68,4 +62,6 @@ def run(collections_list, metadata_dir, target_dir, logfile='filter_collection.l
 
         if overlap:
             logging.info(f'Deleting {target_path}')
-            target_path.unlink()
+            corpus.delete(entry.doc_id)
+
+    corpus.flush()
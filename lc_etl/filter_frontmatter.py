@@ -1,7 +1,8 @@
 from argparse import ArgumentParser
+import io
 import logging
-from pathlib import Path
 
+from .corpus_store import open_corpus
 from .utilities import initialize_logger
 
 # This cutoff was determined by:
@@ -24,31 +25,27 @@ CUTOFF = 7
 
 def filter_frontmatter(target_dir, cutoff=CUTOFF):
     """
-    Find all .txt files in the target directory; remove $cutoff lines from the
-    front.
+    Find all .txt files in the target corpus (a directory or packed store;
+    see corpus_store); remove $cutoff lines from the front.
     """
     total_files = 0
+    corpus = open_corpus(target_dir)
 
-    for txt_file in Path(target_dir).rglob('*.txt'):
+    for txt_file in corpus.ids('*.txt'):
         total_files += 1
         if total_files % 100 == 0:
             logging.info(f'{total_files} edited')
 
-        with txt_file.open() as f:
-            text = f.readlines()
+        text = io.StringIO(corpus.read(txt_file)).readlines()
 
         shorter_text = text[CUTOFF:]
 
         if shorter_text:
-            with txt_file.open('w') as f:
-                f.write(' '.join(shorter_text))
+            corpus.write(txt_file, ' '.join(shorter_text))
         else:
-            try:
-                Path(txt_file).unlink()
-            except FileNotFoundError:
-                # File may have already been deleted if multiple filters are
-                # running in parallel.
-                continue
+            corpus.delete(txt_file)
+
+    corpus.flush()
 
 
 def run(target_dir, cutoff=CUTOFF, logfile='filter_frontmatter.log'):
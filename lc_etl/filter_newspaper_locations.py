@@ -49,6 +49,7 @@ import logging
 from pathlib import Path
 import string
 
+from .corpus_store import open_corpus
 from .utilities import initialize_logger
 
 
@@ -74,8 +75,7 @@ def locations(metadata):
     return [normalize(loc) for loc in metadata.get('locations')]
 
 
-def get_stopwords(txt_file, target_dir, metadata_dir):
-    metadata_file = str(txt_file).replace(target_dir, metadata_dir).replace('ocr.txt', '')
+def get_stopwords(metadata_file):
     with Path(metadata_file).open() as f:
         metadata = json.load(f)
 
@@ -86,32 +86,38 @@ def get_stopwords(txt_file, target_dir, metadata_dir):
     return list(set(stopwords))
 
 
+def remove_stopwords(text, stopwords):
+    # This is so slow, but if we do a string replace we'll end up replacing
+    # substrings (e.g. turning "remained" into "red" for newspapers from
+    # Maine). And if we don't normalize, who knows what happens with the
+    # punctuation.
+    filtered_text = normalize(text).split()
+    filtered_text = [word for word in filtered_text if word not in stopwords]
+    return ' '.join(filtered_text)
+
+
 def _filter(target_dir, metadata_dir):
     count = 0
-    for txt_file in Path(target_dir).rglob('**/*.txt'):
+    corpus = open_corpus(target_dir)
+
+    for entry in corpus.entries('**/*.txt'):
+        txt_file = f'{target_dir}/{entry.doc_id}'
         count += 1
         try:
-            stopwords = get_stopwords(txt_file, target_dir, metadata_dir)
+            stopwords = get_stopwords(entry.metadata_path(metadata_dir))
         except FileNotFoundError:
             logging.exception(f'Metadata not found for {txt_file}')
             continue
 
-        with open(txt_file, 'r') as f:
-            text = f.read()
-
-        # This is so slow, but if we do a string replace we'll end up replacing
-        # substrings (e.g. turning "remained" into "red" for newspapers from
-        # Maine). And if we don't normalize, who knows what happens with the
-        # punctuation.
-        filtered_text = normalize(text).split()
-        filtered_text = [word for word in filtered_text if word not in stopwords]
-        filtered_text = ' '.join(filtered_text)
+        text = corpus.read(entry.doc_id)
+        filtered_text = remove_stopwords(text, stopwords)
 
         if count % 100 == 0:
             logging.info(f'{count} documents filtered')
 
-        with open(txt_file, 'w') as f:
-            f.write(filtered_text)
+        corpus.write(entry.doc_id, filtered_text)
+
+    corpus.flush()
 
 
 def run(target_dir, metadata_dir, logfile='filter_newspaper_locations.log'):
@@ -19,8 +19,9 @@
 #   neural net training (4x speedup during trials)
 #
 # It will take almost literally forever to run (multiple days to process a
-# corpus of about 600K newspapers on an m1). It can in theory be parallelized
-# (see filter_nonwords_parallel for an unfinished attempt at this). With a
+# corpus of about 600K newspapers on an m1). filter_nonwords_parallel runs it
+# across several processes, which helps a lot if you have the cores;
+# filter_nonwords_batch works out all the replacements up front, in bulk. With a
 # modest rewrite, it could also be combined with filter_ocr, making it
 # unnecessary to run that script; since it examines every word anyway and
 # compares them to a dictionary, you could readily calculate which documents
@@ -29,50 +30,41 @@
 # than looking at every word.
 
 from argparse import ArgumentParser
+from collections import Counter
 import logging
 from math import floor
-from pathlib import Path
-import sqlite3
 
 import gensim
 import Levenshtein
+import numpy as np
 import spacy
 
-from .utilities import initialize_logger, BASE_DIR
+from .corpus_store import open_corpus
+from .deletion_index import DeletionIndex, MAX_DISTANCE
+from .nonword_cache import cache_path, NonwordCache
+from .utilities import initialize_logger
+from .vector_index import get_index, IndexedVectors
 from .filter_newspaper_locations import normalize
 
 GENSIM_THRESHOLD = 0.6
 LEVENSHTEIN_THRESHOLD = .3
+# How many similar words derive_from_model considers; most_similar's default.
+TOPN = 10
 
-DB_DIR = 'nonword_caches'
-DB_TABLE = 'words'
-DB_NONWORD = 'nonword'
-DB_GOOD_WORD = 'good_word'
 
-
-def lookup_from_cache(db, word):
-    query = db.execute(f"SELECT {DB_GOOD_WORD} FROM {DB_TABLE} WHERE {DB_NONWORD} = '{word}'")
-
-    # We are assuming there is at most one match, based on how we're doing db
-    # writes. (In a better world we'd verify this.)
-    match = query.fetchone()
-
-    if match:
-        # Matches will be one-element tuples. We want only the string.
-        return match[0]
-    else:
-        return None
+def allowable_distance(base_word):
+    # This will be 0 for words of 1 or 2 letters, but those are likely enough
+    # to be garbage anyway that it's fine to let them fail here.
+    return round(LEVENSHTEIN_THRESHOLD * len(base_word))
 
 
 def close_enough(base_word, test_word):
-    # This will be 0 for words of 1 or 2 letters, but those are likely enough
-    # to be garbage anyway that it's fine to let them fail here.
-    allowable_distance = round(LEVENSHTEIN_THRESHOLD * len(base_word))
+    allowable = allowable_distance(base_word)
 
     # Some errors look like single-character replacements; others look like word
     # fragmentation. Either is OK.
     return any([
-        Levenshtein.distance(base_word, test_word) <= allowable_distance,
+        Levenshtein.distance(base_word, test_word) <= allowable,
         base_word in test_word
     ])
 
@@ -93,7 +85,7 @@ def derive_from_model(model, nlp, base_word):
     Levenshtein threshold, similarly.
     """
     try:
-        options = model.wv.most_similar(base_word)
+        options = model.wv.most_similar(base_word, topn=TOPN)
     except Exception as e:
         return None
 
@@ -118,88 +110,158 @@ def derive_from_model(model, nlp, base_word):
         return None
 
 
-def check_for_alternative(db, model, nlp, base_word):
-    cached_word = lookup_from_cache(db, base_word)
+class CandidateFilter(object):
+    """
+    Does what derive_from_model does, with the same results, but mostly
+    without scoring the whole vocabulary.
+
+    Any replacement has to be close_enough to the nonword and in spaCy's
+    vocabulary, so we find those words first (with a DeletionIndex of the
+    model words spaCy knows) and only work out their similarities. If none of
+    them pass GENSIM_THRESHOLD, which is what happens with most garbage,
+    we're done after a handful of dot products. Otherwise the most similar
+    one is the answer, provided most_similar would have ranked it in the top
+    TOPN. Checking that takes one pass over the vocabulary, but there's no
+    sorting.
+
+    Nonwords of one letter, or long enough to be allowed more than
+    MAX_DISTANCE edits, just go to derive_from_model.
+
+    `vectors` are the model's word vectors, normalized; pass them in if you
+    have them (say, mmapped from an 'exact' vector_index) rather than have
+    this make its own copy.
+    """
+
+    def __init__(self, model, nlp, max_distance=MAX_DISTANCE, vectors=None):
+        super(CandidateFilter, self).__init__()
+        self.model = model
+        self.nlp = nlp
+        self.wv = model.wv
+        self.vectors = self.wv.get_normed_vectors() if vectors is None else vectors
+        self.stats = Counter()
+
+        self.max_query_length = max(
+            length for length in range(1, 100)
+            if allowable_distance('x' * length) <= max_distance
+        )
+        self.ids = np.array([
+            i for i, key in enumerate(self.wv.index_to_key) if key in nlp.vocab.strings
+        ], dtype=np.int64)
+        self.index = DeletionIndex(
+            [self.wv.index_to_key[i] for i in self.ids], max_distance, self.max_query_length
+        )
+
+
+    def __call__(self, base_word):
+        if base_word not in self.wv.key_to_index:
+            # most_similar would have raised.
+            return None
+
+        if not 2 <= len(base_word) <= self.max_query_length:
+            self.stats['fallbacks'] += 1
+            return derive_from_model(self.model, self.nlp, base_word)
+
+        self.stats['prefiltered'] += 1
+        position = self.wv.key_to_index[base_word]
+        candidates = self.index.within(base_word, allowable_distance(base_word)) \
+            | self.index.containing(base_word)
+        ids = self.ids[sorted(candidates)]
+        ids = ids[ids != position]
+        if not len(ids):
+            return None
+
+        vector = self.vectors[position]
+        similarities = self.vectors[ids] @ vector
+        best = np.argmax(similarities)
+        if similarities[best] <= GENSIM_THRESHOLD:
+            return None
+
+        # How many words (apart from the nonword itself) most_similar would
+        # have ranked above this one.
+        self.stats['rank checks'] += 1
+        above = np.count_nonzero(self.vectors @ vector > similarities[best]) - 1
+        if above >= TOPN:
+            return None
+
+        return self.wv.index_to_key[ids[best]]
+
+
+def check_for_alternative(cache, model, nlp, base_word, derive=None):
+    """`derive` works out replacements that aren't in the cache; by
+    default, derive_from_model."""
+    derive = derive or (lambda word: derive_from_model(model, nlp, word))
+    return cache.lookup(base_word, derive)
+
 
-    if cached_word:
-        return cached_word
-    else:
-        result = derive_from_model(model, nlp, base_word)
+def get_cache(model_path):
+    return NonwordCache(cache_path(model_path))
 
-        # If we're in this branch of the if statement, this result had not yet
-        # been cached, so let's cache it.
-        if result:
-            # The quote types are important here! If you use single quotes
-            # around the values, the parse will break when the values include
-            # single quotes/apostrophes (such as the word "don't".)
-            db.execute(f'INSERT INTO {DB_TABLE} VALUES ("{base_word}", "{result}")')
 
-        return result
+def replace_nonwords(text, cache, model, nlp, derive=None):
+    return substitute_words(
+        text, nlp, lambda word: check_for_alternative(cache, model, nlp, word, derive)
+    )
 
 
-def get_cache(model_path):
-    # sqlite3 will not create the directory structure if it doesn't exist, so
-    # we need to make sure to do that.
-    db_path = Path(BASE_DIR, DB_DIR)
-    db_path.mkdir(parents=True, exist_ok=True)
-    filename = Path(model_path).with_suffix('.db').name
-    db_name = db_path / filename
+def substitute_words(text, nlp, find_alternative):
+    """
+    Keeps the words of `text` that spaCy knows, and replaces the rest with
+    find_alternative(word), dropping them if that's None.
+    """
+    new_text = []
 
-    if db_name.is_file():
-        db_conn = sqlite3.connect(db_name)
-        db = db_conn.cursor()
-    else:
-        db_conn = sqlite3.connect(db_name)
-        db = db_conn.cursor()
-        db.execute(f"CREATE TABLE {DB_TABLE} ({DB_NONWORD}, {DB_GOOD_WORD})")
+    for word in text.split():
+        word = normalize(word)
+        # Keep things that are actually words. This includes proper nouns
+        # such as place names.
+        if word in nlp.vocab.strings:
+            new_text.append(word)
+        else:
+            alt_word = find_alternative(word)
+            if alt_word:
+                new_text.append(alt_word)
 
-    return db_conn, db
+    return ' '.join(new_text)
 
 
-def _inner_filter(target_dir, db, model, nlp):
+def _inner_filter(target_dir, cache, model, nlp, derive=None):
     files_checked = 0
+    corpus = open_corpus(target_dir)
 
-    for txt_file in Path(target_dir).rglob('*'):
-        if not txt_file.is_file():
-            continue
-
+    for txt_file in corpus.ids():
         try:
-            with open(txt_file, 'r') as f:
-                text = f.read()
+            text = corpus.read(txt_file)
         except UnicodeDecodeError:
             logging.exception(f'Could not read {txt_file}')
             continue
 
-        new_text = []
-
         logging.info(f'Replacing nonwords in {txt_file}')
 
-        for word in text.split():
-            word = normalize(word)
-            # Keep things that are actually words. This includes proper nouns
-            # such as place names.
-            if word in nlp.vocab.strings:
-                new_text.append(word)
-            else:
-                alt_word = check_for_alternative(db, model, nlp, word)
-                if alt_word:
-                    new_text.append(alt_word)
-
-        filtered_text = ' '.join(new_text)
-
-        with open(txt_file, 'w') as f:
-            f.write(filtered_text)
+        filtered_text = replace_nonwords(text, cache, model, nlp, derive)
+        corpus.write(txt_file, filtered_text)
 
         files_checked += 1
         if files_checked % 100 == 0:
             logging.info(f'{files_checked} files edited')
+            cache.log_stats()
+
+    corpus.flush()
+    cache.log_stats()
+
+
+class WordVectors(object):
+    """Just enough of a Doc2Vec model for derive_from_model."""
+
+    def __init__(self, wv):
+        super(WordVectors, self).__init__()
+        self.wv = wv
 
 
-def _filter(target_dir, model_path):
+def load_models(model_path, index=None):
     """
-    This sets up the infrastructure we'll need for filtering, but delegates the
-    actual filtering to _inner_filter. This lets us ensure we've closed the db
-    without making things too hard to read.
+    Returns (nlp, model), or exits if either can't be loaded. With `index` (a
+    kind of vector_index, like 'ivf'), the model's most_similar goes through
+    an index of its word vectors, which is built the first time.
     """
     try:
         nlp = spacy.load("en_core_web_sm")
@@ -213,21 +275,45 @@ def _filter(target_dir, model_path):
         logging.exception('No model provided; cannot continue')
         import sys; sys.exit()
 
-    db_conn, db = get_cache(model_path)
+    if index:
+        model = WordVectors(
+            IndexedVectors(model.wv, get_index(model_path, model.wv, 'wv', index))
+        )
+
+    return nlp, model
+
+
+def _filter(target_dir, model_path, index=None, prefilter=False):
+    """
+    This sets up the infrastructure we'll need for filtering, but delegates the
+    actual filtering to _inner_filter. This lets us ensure we've closed the db
+    without making things too hard to read.
+    """
+    nlp, model = load_models(model_path, index)
+    derive = CandidateFilter(model, nlp) if prefilter else None
+    cache = get_cache(model_path)
 
     try:
-        # I'd sure like to set this up using multiprocessing, but these
-        # arguments are not all picklable, and then we're sad.
-        _inner_filter(target_dir, db, model, nlp)
+        # See filter_nonwords_parallel if you'd like to use more than one core.
+        _inner_filter(target_dir, cache, model, nlp, derive)
     finally:
-        db.close()
-        db_conn.close()
+        cache.close()
+
+    if derive:
+        logging.info(f'Candidate filter: {dict(derive.stats)}')
 
 
-def run(target_dir, model_path, logfile='filter_nonwords.log'):
+def run(target_dir, model_path, logfile='filter_nonwords.log', index=None,
+        prefilter=False):
+    """
+    `index` is a kind of vector_index to look up similar words with, or None
+    to use gensim's (exact, slow) most_similar. With `prefilter`, a
+    CandidateFilter narrows down the options first; it takes a while to build
+    and some memory, but makes most lookups much cheaper.
+    """
     initialize_logger(logfile)
 
-    _filter(target_dir, model_path)
+    _filter(target_dir, model_path, index, prefilter)
 
 # for `canton`, 2-letter changes are common (e.g. 'cautou')
 # >>> model.wv.most_similar('cautou')
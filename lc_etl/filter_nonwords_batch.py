@@ -0,0 +1,194 @@
+# filter_nonwords, resolving the whole corpus's nonwords at once.
+#
+# filter_nonwords works word by word: every nonword it hasn't seen before
+# costs a model.wv.most_similar call, which is a dot product against the whole
+# vocabulary, done one word at a time. But there are far fewer distinct
+# nonwords than there are nonword tokens, and matrix multiplication is much
+# faster in bulk. So this does it in three passes:
+#
+# 1. Read the corpus once and count the distinct nonwords (normalized words
+#    spaCy doesn't know) that the model has vectors for. Anything the model
+#    doesn't know can't be replaced, so it's just dropped, as in
+#    filter_nonwords.
+# 2. Work out replacements for all of them (apart from any already in the
+#    nonword cache) BLOCK_SIZE words at a time: one matrix multiply against
+#    the normalized vectors gives each word's similarity to every word in the
+#    vocabulary, and the same checks as derive_from_model (GENSIM_THRESHOLD,
+#    in spaCy's vocabulary, close_enough) are applied to the top TOPN. This
+#    gives the same answers as most_similar (give or take ties), and the new
+#    ones (including the ones with no replacement) go into the cache.
+# 3. Rewrite each document using the finished table, which is now just a dict
+#    lookup per word.
+#
+# The similarity matrix for a block takes BLOCK_SIZE * (vocabulary size) * 4
+# bytes, so turn BLOCK_SIZE down if memory is tight.
+#
+# Usage:
+# python -m lc_etl.filter_nonwords_batch --target_dir DIR --model_path MODEL
+# or, from Python, filter_nonwords_batch.run(target_dir, model_path)
+
+from argparse import ArgumentParser
+from collections import Counter
+import logging
+
+import numpy as np
+
+from .corpus_store import open_corpus
+from .filter_newspaper_locations import normalize
+from .filter_nonwords import (close_enough, get_cache, load_models,
+                              substitute_words, GENSIM_THRESHOLD, TOPN)
+from .nonword_cache import NO_REPLACEMENT
+from .utilities import initialize_logger
+
+BLOCK_SIZE = 256
+
+
+def collect_nonwords(corpus, model, nlp):
+    """
+    Phase 1: a Counter of the nonwords in `corpus` that `model` has vectors
+    for.
+    """
+    counts = Counter()
+    files_checked = 0
+
+    for doc_id in corpus.ids():
+        try:
+            text = corpus.read(doc_id)
+        except UnicodeDecodeError:
+            logging.exception(f'Could not read {doc_id}')
+            continue
+
+        for word in text.split():
+            word = normalize(word)
+            if word not in nlp.vocab.strings and word in model.wv.key_to_index:
+                counts[word] += 1
+
+        files_checked += 1
+        if files_checked % 1000 == 0:
+            logging.info(f'{files_checked} files scanned; {len(counts)} nonwords so far')
+
+    return counts
+
+
+def resolve_nonwords(model, nlp, words, block_size=BLOCK_SIZE):
+    """
+    Phase 2: returns {word: replacement} for whichever of `words` (which
+    must all be in the model) have one. Equivalent to calling
+    derive_from_model on each.
+    """
+    wv = model.wv
+    vectors = wv.get_normed_vectors()
+    # Which vocabulary words could be replacements at all, as far as spaCy's
+    # concerned. Working this out once saves asking for every candidate.
+    real = np.array([key in nlp.vocab.strings for key in wv.index_to_key])
+    topn = min(TOPN, len(wv) - 1)
+    replacements = {}
+    if topn < 1:
+        return replacements
+
+    words = list(words)
+    for start in range(0, len(words), block_size):
+        block = words[start:start + block_size]
+        indexes = np.array([wv.key_to_index[word] for word in block])
+        rows = np.arange(len(block))
+
+        similarities = vectors[indexes] @ vectors.T
+        # most_similar never suggests the word itself.
+        similarities[rows, indexes] = -np.inf
+
+        # The top `topn` of each row, most similar first.
+        best = np.argpartition(-similarities, topn - 1, axis=1)[:, :topn]
+        order = np.argsort(-similarities[rows[:, None], best], axis=1)
+        best = best[rows[:, None], order]
+        candidates = (similarities[rows[:, None], best] > GENSIM_THRESHOLD) & real[best]
+
+        for row, word in enumerate(block):
+            for index in best[row][candidates[row]]:
+                option = wv.index_to_key[index]
+                if close_enough(word, option):
+                    replacements[word] = option
+                    break
+
+        logging.info(f'{min(start + block_size, len(words))} of {len(words)} nonwords resolved')
+
+    return replacements
+
+
+def build_table(counts, model, nlp, cache):
+    """
+    The full nonword -> replacement table for the nonwords in `counts`,
+    using the cache where possible and adding anything new to it.
+    """
+    table = {}
+    # Most frequent first, so that the replacements that matter most are
+    # in the log earliest.
+    unresolved = []
+    for word, _ in counts.most_common():
+        replacement = cache.get(word)
+        if replacement is None:
+            unresolved.append(word)
+        elif replacement != NO_REPLACEMENT:
+            table[word] = replacement
+
+    logging.info(f'{len(counts)} distinct nonwords; {len(unresolved)} not yet cached')
+
+    new = resolve_nonwords(model, nlp, unresolved)
+    for word in unresolved:
+        cache.put(word, new.get(word, NO_REPLACEMENT))
+    cache.flush()
+
+    table.update(new)
+    return table
+
+
+def rewrite(corpus, table, nlp):
+    """Phase 3: replaces each document's nonwords using `table`."""
+    files_checked = 0
+
+    for doc_id in corpus.ids():
+        try:
+            text = corpus.read(doc_id)
+        except UnicodeDecodeError:
+            logging.exception(f'Could not read {doc_id}')
+            continue
+
+        corpus.write(doc_id, substitute_words(text, nlp, table.get))
+
+        files_checked += 1
+        if files_checked % 1000 == 0:
+            logging.info(f'{files_checked} files edited')
+
+    corpus.flush()
+    return files_checked
+
+
+def _filter(target_dir, model_path):
+    nlp, model = load_models(model_path)
+    cache = get_cache(model_path)
+    corpus = open_corpus(target_dir)
+
+    try:
+        counts = collect_nonwords(corpus, model, nlp)
+        table = build_table(counts, model, nlp, cache)
+    finally:
+        cache.close()
+
+    files_checked = rewrite(corpus, table, nlp)
+    logging.info(f'Replaced {len(table)} of {len(counts)} nonwords in {files_checked} files')
+
+
+def run(target_dir, model_path, logfile='filter_nonwords_batch.log'):
+    """Does what filter_nonwords.run does, in three passes."""
+    initialize_logger(logfile)
+
+    _filter(target_dir, model_path)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--target_dir', help='directory containing files to check', required=True)
+    parser.add_argument('--model_path', help='path to neural net to use for word similarity', required=True)
+    parser.add_argument('--logfile', default="filter_nonwords_batch.log")
+    options = parser.parse_args()
+
+    run(options.target_dir, options.model_path, options.logfile)
@@ -1,252 +1,269 @@
-# This is an unfinished attempt to parallelize filter_nonwords.
+# filter_nonwords, spread across processes.
 #
-# Why was it attempted?
-# 1. filter_nonwords is excruciatingly slow;
-# 2. each document is independent of the others, so in theory they can be
-#    processed in parallel.
+# filter_nonwords is excruciatingly slow (days for ~600K newspapers), and each
+# document is independent of the others, so in theory they can be processed
+# in parallel. An earlier attempt at this ran aground on three things, which
+# are dealt with as follows:
 #
-# Why is it unfinished?
+# 1. Each process needed its own copy of the neural net, which costs lots of
+#    memory plus time to load. But all we need from the model is its word
+#    vectors. The main process saves those once (as a .npy file next to the
+#    nonword cache) and the workers load them with mmap='r', so the operating
+#    system shares one copy of the pages among all of them.
+# 2. SQLite locks up if many processes commit to the same cache. So the
+#    workers only ever read the cache (see nonword_cache); they send the
+#    replacements they work out back to the main process, which is the only
+#    writer and commits them in batches. (Workers also remember their own
+#    replacements, so they don't work out the same word twice while waiting
+#    for the commit.)
+# 3. Splitting up the files with itertools.tee/more_itertools.divide used an
+#    inordinate amount of memory for large corpora. Instead the main process
+#    walks the corpus lazily and hands out small chunks of doc ids through a
+#    queue, keeping only a few chunks in flight; whichever worker is free
+#    takes the next one, so slow documents don't hold anyone else up.
 #
-# Python multiprocessing is hard!
+# Workers read documents themselves and send the filtered text back; the main
+# process does all the writing, so it's safe with packed corpora and keeps
+# the manifest (if any) up to date.
 #
-# Data can only be shared between processes if it's picklable. This means that
-# each process needs its own copy of the neural net ( = lots of memory, plus
-# time to load) and its own database connection. Furthermore, each process needs
-# its own database connection management. If you commit transactions on every
-# word, you will slow down terribly; if you wait to commit transactions too
-# long, you will eventually end up with a locked database. Finally, you need a
-# way to apportion files among processes. The obvious choice of looping through
-# globbed files in the main program and apportioning them one-by-one to
-# processes -- while simplifying database management by letting you do all your
-# commits in the main process -- means having to load the neural net anew for
-# each file (as you spawn processes for them one-by-one), which will obliterate
-# performance benefits from multiprocessing due to the slowness of loading the
-# neural net. itertools.tee() allows you to split an iterator -- thus, for
-# instance, globbing all the files, splitting them into os.cpu_count()
-# iterators, and handing each iterator to a process -- but it also uses an
-# inordinate amount of memory for large corpora.
+# With prefilter, each worker builds its own CandidateFilter. Its vectors are
+# mmapped and shared like the rest, but its DeletionIndex is a plain dict,
+# which can't be, and it takes something like 350 MB per 100,000 words in the
+# model's vocabulary (only counting the ones spaCy knows). So that much again
+# per process; turn --p down if memory is tight.
 #
-# Some of these problems would not apply to multi_threaded_ solutions, but due
-# to the Global Interpreter Lock I'm not hopeful that I could gain much
-# performance improvement that way.
-#
-# I decided I was better off letting the computer process things slowly in the
-# background and using my time on solving different problems. But I leave this
-# code here in case _you_ know how to make it work. Pull requests welcome!
+# Usage:
+# python -m lc_etl.filter_nonwords_parallel --target_dir DIR --model_path MODEL --p 8
+# or, from Python, filter_nonwords_parallel.run(target_dir, model_path, processes=8)
 
 from argparse import ArgumentParser
 import itertools
 import logging
 from math import floor
-from multiprocessing import Pool, log_to_stderr
+import multiprocessing
 import os
 from pathlib import Path
-import sqlite3
+import queue
+import time
 
 import gensim
-import Levenshtein
-import more_itertools
 import spacy
 
-from .utilities import BASE_DIR
-from .filter_newspaper_locations import normalize
-
-GENSIM_THRESHOLD = 0.6
-LEVENSHTEIN_THRESHOLD = .3
-
-DB_DIR = 'nonword_caches'
-DB_TABLE = 'words'
-DB_NONWORD = 'nonword'
-DB_GOOD_WORD = 'good_word'
+from .corpus_store import open_corpus
+from .filter_nonwords import (derive_from_model, load_models, substitute_words,
+                              CandidateFilter, WordVectors)
+from .nonword_cache import cache_path, NonwordCache, NO_REPLACEMENT
+from .vector_index import (get_index, index_path, load_index, IndexedVectors,
+                           BACKENDS)
+from .utilities import initialize_logger
 
+# Doc ids per unit of work. Small enough to balance the load, big enough that
+# passing messages is cheap next to the filtering.
+CHUNK_SIZE = 20
+# How many chunks per worker to keep queued up.
+CHUNKS_IN_FLIGHT = 2
+# How long to wait on the workers before checking that they're still alive.
+WORKER_TIMEOUT = 60
 
-def lookup_from_cache(db, word):
-    query = db.execute(f"SELECT {DB_GOOD_WORD} FROM {DB_TABLE} WHERE {DB_NONWORD} = '{word}'")
-
-    # We are assuming there is at most one match, based on how we're doing db
-    # writes. (In a better world we'd verify this.)
-    match = query.fetchone()
-
-    if match:
-        # Matches will be one-element tuples. We want only the string.
-        return match[0]
-    else:
-        return None
 
+def vectors_path(model_path):
+    return cache_path(model_path).with_suffix('.vectors')
 
-def close_enough(base_word, test_word):
-    # This will be 0 for words of 1 or 2 letters, but those are likely enough
-    # to be garbage anyway that it's fine to let them fail here.
-    allowable_distance = floor(LEVENSHTEIN_THRESHOLD * len(base_word))
 
-    # Some errors look like single-character replacements; others look like word
-    # fragmentation. Either is OK.
-    return any([
-        Levenshtein.distance(base_word, test_word) <= allowable_distance,
-        base_word in test_word
-    ])
-
-
-def derive_from_model(model, nlp, base_word):
+def export_vectors(model, model_path):
     """
-    The goal here is to remove words that are probably OCR errors and replace
-    them with a likely candidate. The hope here is that this will minimize the
-    chances that artifacts specific to particular digitization workflows will
-    artificially group together documents, rather than documents being grouped
-    on the basis of their underlying contents. Doubtless it will sometimes
-    (frequently?) introduce errors, but since it's only substituting words that
-    are fairly similar in meaning, that should only moderately affect downstream
-    clustering.
-
-    The threshold of 0.6 was chosen by looking at various real-world OCR errors
-    and seeing their similarities to the correct word (typically .65-.75). The
-    Levenshtein threshold, similarly.
+    Saves the model's word vectors where workers can mmap them, unless
+    they're already there and newer than the model.
     """
-    try:
-        options = model.wv.most_similar(base_word)
-    except Exception as e:
-        return None
-
-    similar_words = [opt[0] for opt in options if opt[1] > GENSIM_THRESHOLD]
-
-    # This has a side effect that a number of slurs which are common in the
-    # corpus are not in fact part of the NLP corpus here and will be filtered
-    # out. That's clearly a good thing mental-health-wise for me as someone
-    # viewing many examples of this function at work. Whether or not it's a
-    # good thing for accuracy of corpus handling or downstream uses is left as
-    # an exercise for the reader.
-    real_words = [word for word in similar_words if word in nlp.vocab.strings]
-    close_words = [word for word in real_words if close_enough(base_word, word)]
-
-    # As the model returned these in order by similarity, with most-similar
-    # first, and as our list transformations have been order-preserving, the
-    # first word in the list is still the most similar of the surviving options,
-    # so let's go with it.
-    try:
-        return close_words[0]
-    except IndexError:
-        return None
-
-
-def check_for_alternative(db, model, nlp, base_word):
-    cached_word = lookup_from_cache(db, base_word)
-
-    if cached_word:
-        return cached_word
-    else:
-        result = derive_from_model(model, nlp, base_word)
-
-        # If we're in this branch of the if statement, this result had not yet
-        # been cached, so let's cache it.
-        if result:
-            # The quote types are important here! If you use single quotes
-            # around the values, the parse will break when the values include
-            # single quotes/apostrophes (such as the word "don't".)
-            db.execute(f'INSERT INTO {DB_TABLE} VALUES ("{base_word}", "{result}")')
-            db.commit()
-
-        return result
-
-
-def get_cache(model_path):
-    # sqlite3 will not create the directory structure if it doesn't exist, so
-    # we need to make sure to do that.
-    db_path = Path(BASE_DIR, DB_DIR)
-    db_path.mkdir(parents=True, exist_ok=True)
-    filename = Path(model_path).with_suffix('.db').name
-    db_name = db_path / filename
-
-    if db_name.is_file():
-        db = sqlite3.connect(db_name)
-    else:
-        db = sqlite3.connect(db_name)
-        db.execute(f"CREATE TABLE {DB_TABLE} ({DB_NONWORD}, {DB_GOOD_WORD})")
-        db.commit()
+    path = vectors_path(model_path)
+    if path.is_file() and path.stat().st_mtime >= Path(model_path).stat().st_mtime:
+        return path
 
-    return db
+    # `separately` makes sure the vectors go in their own .npy file even when
+    # they're small, since that's what can be mmapped.
+    model.wv.save(str(path), separately=['vectors'])
+    return path
 
 
-def _inner_filter(iterable, db, model, nlp):
-    for txt_file in iterable:
-        with open(txt_file, 'r') as f:
-            text = f.read()
-
-        new_text = []
-
-        for word in text.split():
-            word = normalize(word)
-            # Keep things that are actually words. This includes proper nouns
-            # such as place names.
-            if word in nlp.vocab.strings:
-                new_text.append(word)
-            else:
-                alt_word = check_for_alternative(db, model, nlp, word)
-                if alt_word:
-                    new_text.append(alt_word)
+def num_processes(requested=None):
+    # Default to using half of the processors if the users didn't specify.
+    desired_num = int(requested or 0) or floor(os.cpu_count()/2)
+    # Don't let the user exceed the cpu count.
+    return max(1, min(desired_num, os.cpu_count()))
 
-        filtered_text = ' '.join(new_text)
 
-        with open(txt_file, 'w') as f:
-            f.write(filtered_text)
+def _chunks(iterable, size=CHUNK_SIZE):
+    iterator = iter(iterable)
+    while chunk := list(itertools.islice(iterator, size)):
+        yield chunk
 
 
-def manage_filter(iterable, model_path):
+def _work(tasks, results, target_dir, vectors_file, db_file, index_dir=None,
+          exact_dir=None):
     """
-    This sets up the infrastructure we'll need for filtering, but delegates the
-    actual filtering to _inner_filter. This lets us ensure we've closed the db
-    without making things too hard to read.
-    We need to do this inside of manage_filter because Pool processes can't
-    share data structures; they have to pickle data and send it across at an OS
-    level. However, the model and the db connection aren't picklable. Therefore
-    each process needs its own. This unfortunately increases overall memory
-    usage (carrying around n separate instances of the model isn't cheap), but
-    makes time-to-completion radically shorter.
+    Runs in each worker process. Takes lists of doc ids from `tasks` until it
+    gets None, and puts (filtered documents, new cache entries, cache stats)
+    on `results` for each one. Filtered documents are (doc_id, text) pairs,
+    with a text of None if the document couldn't be read. If there's an
+    `index_dir`, similar words are looked up in that vector_index. If there's
+    an `exact_dir` (an exact vector_index), a CandidateFilter using its
+    vectors narrows down the options first; its DeletionIndex is this
+    worker's own (see above for what that costs).
     """
+    nlp = spacy.load("en_core_web_sm")
+    wv = gensim.models.KeyedVectors.load(str(vectors_file), mmap='r')
+    keys = wv.index_to_key
+    if index_dir:
+        wv = IndexedVectors(wv, load_index(index_dir, keys))
+    model = WordVectors(wv)
+    cache = NonwordCache(db_file, read_only=True)
+    corpus = open_corpus(target_dir)
+
+    if exact_dir:
+        candidate_filter = CandidateFilter(model, nlp, vectors=load_index(exact_dir, keys).vectors)
+    else:
+        candidate_filter = lambda word: derive_from_model(model, nlp, word)
 
-    try:
-        nlp = spacy.load("en_core_web_sm")
-    except OSError:
-        logging.info('The spaCy corpus is not available. `python -m spacy download en_core_web_sm` and try again.')
-        import sys; sys.exit()
-
-    try:
-        model = gensim.models.Doc2Vec.load(model_path)
-    except AttributeError:
-        logging.exception('No model provided; cannot continue')
-        import sys; sys.exit()
+    def derive(word):
+        result = candidate_filter(word)
+        new_words[word] = result or NO_REPLACEMENT
+        return result
 
-    db = get_cache(model_path)
+    def find_alternative(word):
+        return cache.lookup(word, derive)
 
     try:
-        # I'd sure like to set this up using multiprocessing, but these
-        # arguments are not all picklable, and then we're sad.
-        _inner_filter(iterable, db, model, nlp)
-    finally:
-        db.close()
+        while (chunk := tasks.get()) is not None:
+            new_words = {}
+            filtered = []
 
+            for doc_id in chunk:
+                try:
+                    text = corpus.read(doc_id)
+                except UnicodeDecodeError:
+                    filtered.append((doc_id, None))
+                    continue
 
-def num_processes(options):
-    # Default to using half of the processors if the users didn't specify.
-    desired_num = int(options.p) or floor(os.cpu_count()/2)
-    # Don't let the user exceed the cpu count.
-    return min(desired_num, os.cpu_count())
-
-
-def _filter(options):
-    all_files_iterable = Path(options.target_dir).rglob('*.txt')
+                filtered.append((doc_id, substitute_words(text, nlp, find_alternative)))
 
-    num = num_processes(options)
-
-    with Pool(processes=num) as pool:
-        subset_iterables = more_itertools.divide(num, all_files_iterable)
-        # The zip lets us supply 2 arguments to the manage_filter function.
-        # The first will be one of the subset_iterables (distinct for each
-        # process); the second will always be options.model_path.
-        pool.starmap(
-            manage_filter,
-            zip(subset_iterables, itertools.repeat(options.model_path))
+            results.put((filtered, new_words, dict(cache.stats)))
+            cache.stats.clear()
+    finally:
+        cache.close()
+
+
+def _filter(target_dir, model_path, processes, index=None, prefilter=False):
+    # Load everything once up here, so that if something's missing we find out
+    # now rather than from inside the workers.
+    nlp, model = load_models(model_path)
+    vectors_file = export_vectors(model, model_path)
+    index_dir = None
+    if index:
+        # Build it now (if need be), so the workers just have to mmap it.
+        get_index(model_path, model.wv, 'wv', index)
+        index_dir = index_path(model_path, 'wv', index)
+    exact_dir = None
+    if prefilter:
+        # The workers' CandidateFilters share these normalized vectors.
+        get_index(model_path, model.wv, 'wv', 'exact')
+        exact_dir = index_path(model_path, 'wv', 'exact')
+    del nlp, model
+
+    # We only write to the cache (and tally up the workers' stats), so
+    # there's no point in keeping any of it in memory.
+    cache = NonwordCache(cache_path(model_path), memory_size=0)
+
+    # 'spawn' rather than 'fork', so that workers don't inherit our database
+    # connections (or anything else that doesn't survive a fork).
+    context = multiprocessing.get_context('spawn')
+    tasks = context.Queue()
+    results = context.Queue()
+    workers = [
+        context.Process(
+            target=_work,
+            args=(tasks, results, str(target_dir), vectors_file,
+                  cache_path(model_path), index_dir, exact_dir),
+            daemon=True
         )
+        for _ in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+
+    corpus = open_corpus(target_dir)
+    chunks = _chunks(corpus.ids())
+    outstanding = 0
+    for chunk in itertools.islice(chunks, processes * CHUNKS_IN_FLIGHT):
+        tasks.put(chunk)
+        outstanding += 1
+
+    files_checked = 0
+    chunks_done = 0
+    start = time.monotonic()
+
+    try:
+        while outstanding:
+            try:
+                filtered, new_words, stats = results.get(timeout=WORKER_TIMEOUT)
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in workers):
+                    raise RuntimeError('A filter_nonwords worker died; see its output')
+                continue
+
+            outstanding -= 1
+            next_chunk = next(chunks, None)
+            if next_chunk:
+                tasks.put(next_chunk)
+                outstanding += 1
+
+            for doc_id, text in filtered:
+                if text is None:
+                    logging.error(f'Could not read {doc_id}')
+                    continue
+                corpus.write(doc_id, text)
+                files_checked += 1
+
+            # Two workers may well have worked out the same word at once, but
+            # that's fine; the second one just replaces the first.
+            for word, replacement in new_words.items():
+                cache.put(word, replacement)
+            cache.stats.update(stats)
+
+            chunks_done += 1
+            if chunks_done % (100 // CHUNK_SIZE) == 0:
+                logging.info(f'{files_checked} files edited')
+                cache.log_stats()
+                corpus.flush()
+
+        for _ in workers:
+            tasks.put(None)
+        for worker in workers:
+            worker.join()
+    finally:
+        cache.log_stats()
+        cache.close()
+        corpus.flush()
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+
+    elapsed = time.monotonic() - start
+    logging.info(
+        f'Filtered {files_checked} files with {processes} processes in '
+        f'{elapsed:.1f}s ({files_checked / max(elapsed, 1e-9):.1f} files/s)'
+    )
+    return files_checked
+
+
+def run(target_dir, model_path, processes=None, logfile='filter_nonwords_parallel.log',
+        index=None, prefilter=False):
+    """
+    Does what filter_nonwords.run does, with `processes` workers (by default,
+    half the cores).
+    """
+    initialize_logger(logfile)
 
+    return _filter(target_dir, model_path, num_processes(processes), index, prefilter)
 
 
 if __name__ == '__main__':
@@ -254,21 +271,14 @@ if __name__ == '__main__':
     parser.add_argument('--target_dir', help='directory containing files to check', required=True)
     parser.add_argument('--model_path', help='path to neural net to use for word similarity', required=True)
     parser.add_argument('--p', help='processes to run (max is os.cpu_count() regardless of this value)')
-    parser.add_argument('--logfile', default="filter_nonwords_<id>.log")
+    parser.add_argument('--logfile', default="filter_nonwords_parallel.log")
+    parser.add_argument('--index', choices=list(BACKENDS),
+                        help='look up similar words in this kind of vector_index')
+    parser.add_argument('--prefilter', action='store_true',
+                        help='narrow down replacements by spelling first (see '
+                             'filter_nonwords.CandidateFilter); each process builds its own '
+                             'index, about 350 MB per 100,000 words of vocabulary')
     options = parser.parse_args()
 
-    _filter(options)
-
-# for `canton`, 2-letter changes are common (e.g. 'cautou')
-# >>> model.wv.most_similar('cautou')
-# [('mis3', 0.6734908819198608), ('canton', 0.6474270224571228), ('jacksox',
-# 0.6214158535003662), ('3m', 0.6087878942489624), ('cantox', 0.599487841129303),
-# ('jackson', 0.5969511866569519), ('offick', 0.5901390910148621), ('6m',
-# 0.5873024463653564), ('v7', 0.5811986923217773), ('osyka', 0.5809045433998108)]
-
-# >>> model.wv.most_similar('frage')
-# [('suffrage', 0.6635172367095947), ('baldness', 0.5722435712814331), ('fere',
-# 0.5628131628036499), ('fering', 0.5568088293075562), ('rights',
-# 0.5475192666053772), ('aggression', 0.5430271625518799), ('fered',
-# 0.5414115786552429), ('citizenship', 0.5353204607963562), ('disa',
-# 0.5345199108123779), ('inflicted', 0.5147979259490967)]
+    run(options.target_dir, options.model_path, options.p, options.logfile,
+        options.index, options.prefilter)
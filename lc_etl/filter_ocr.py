@@ -33,43 +33,79 @@
 # confident that I was doing the statistics right.
 
 from argparse import ArgumentParser
-from pathlib import Path
 import logging
+import threading
 
 import spacy
 
+from .corpus_store import open_corpus
 from .train_doc2vec import Configuration
 from .utilities import initialize_logger
 
+CUTOFF = 0.57
+WORDS_TO_EXAMINE = 400
+MIN_WORD_LENGTH = 3
 
-def _filter_for_quality(target_dir):
+# Loading the spacy model takes a while, so do it once, on first use.
+_dictionary = None
+_dictionary_lock = threading.Lock()
+
+
+def get_dictionary():
+    global _dictionary
+
+    with _dictionary_lock:
+        if _dictionary is None:
+            _dictionary = set(spacy.load("en_core_web_sm").vocab.strings)
+
+    return _dictionary
+
+
+def score_text(text):
     """
-    Find all .txt files in the target directory; check to see if they have
-    adequate OCR quality; and delete any which do not. Use a probabilistic
-    measure to determine whether we have checked enough words per file.
+    Returns the share of (distinct, long) tokens near the start of `text`
+    which are dictionary words, or None if there are no long tokens at all.
+
+    This is the one place OCR quality gets judged: _filter_for_quality uses it
+    on files already on disk, and the harvesters use it (via
+    utilities.passes_quality_gate) to avoid writing bad files to begin with.
     """
-    cutoff = 0.57
-    words_to_examine = 400
-    min_word_length = 3
+    # Use same tokenization behavior that the training process will use by
+    # default.
+    tokens = set([
+        word for word in Configuration.tokenize(text)[:WORDS_TO_EXAMINE]
+        if len(word) > MIN_WORD_LENGTH
+    ])
+    if not len(tokens):
+        return None
+
+    good_tokens = get_dictionary().intersection(tokens)
+    return len(good_tokens) / len(tokens)
 
+
+def passes_quality(text):
+    score = score_text(text)
+    return score is not None and score >= CUTOFF
+
+
+def _filter_for_quality(target_dir):
+    """
+    Find all .txt files in the target corpus (a directory or packed store;
+    see corpus_store); check to see if they have adequate OCR quality; and
+    delete any which do not.
+    """
     total_files = 0
     good_files = 0
 
-    dictionary = set(spacy.load("en_core_web_sm").vocab.strings)
+    corpus = open_corpus(target_dir)
 
-    for txt_file in Path(target_dir).rglob('*.txt'):
-        with txt_file.open() as f:
-            text = f.read()
+    for txt_file in corpus.ids('*.txt'):
+        text = corpus.read(txt_file)
 
-        # Use same tokenization behavior that the training process will use by
-        # default.
-        tokens = set([
-            word for word in Configuration.tokenize(text)[:words_to_examine]
-            if len(word) > min_word_length
-        ])
-        if not len(tokens):
+        estimator = score_text(text)
+        if estimator is None:
             logging.warning(f'{txt_file} has no long tokens; deleting')
-            Path(txt_file).unlink()
+            corpus.delete(txt_file)
             continue
 
         total_files += 1
@@ -77,19 +113,13 @@ def _filter_for_quality(target_dir):
         if total_files % 100 == 0:
             logging.info(f'{total_files} processed, {good_files} good files found ({round(100*good_files/total_files, 1)}%)')
 
-        good_tokens = dictionary.intersection(tokens)
-        estimator = len(good_tokens) / len(tokens)
-
-        if estimator < cutoff:
-            try:
-                Path(txt_file).unlink()
-            except FileNotFoundError:
-                # File may have already been deleted if multiple filters are
-                # running in parallel.
-                continue
+        if estimator < CUTOFF:
+            corpus.delete(txt_file)
         else:
             good_files += 1
 
+    corpus.flush()
+
     try:
         logging.info(f'{good_files} good files found of {total_files} total files ({round(100*good_files/total_files)} percent)')
     except ZeroDivisionError:
@@ -1,48 +1,23 @@
+from collections import defaultdict
 import logging
-from urllib.parse import urlparse
 
-from locr import Fetcher
-from locr.exceptions import AmbiguousText, ObjectNotOnline
-import requests
+from .utilities import harvest_query
 
-from .utilities import paginate_search, filter_results, filenamify
-
-def slurp_collections(collections, filter_for_dates=False):
-    found = 0
-    total_words = 0
-    total_docs = 0
+def slurp_collections(collections, filter_for_dates=False, concurrency=None,
+                      refresh=False):
+    stats = defaultdict(int)
     for base_url in collections:
         logging.info(f'PROCESSING: {base_url}')
-        last_found = found
-        last_words = total_words
 
         url = f'{base_url}search/?fa=online-format:online+text&fo=json'
         if filter_for_dates:
             url += '&dates=1863/1877'
 
-        for response in paginate_search(url):
-            results = filter_results(response)
-            for result in results:
-                total_docs += 1
-                try:
-                    fetcher = Fetcher(result)
-
-                    try:
-                        text = fetcher.full_text()
-                    except (AmbiguousText, ObjectNotOnline):
-                        logging.exception(f'Could not get text for {url}')
-                        continue
-
-                    if text:
-                        found += 1
-                        total_words += len(text.split(' '))
-
-                        with open(filenamify(result), 'w') as f:
-                            f.write(text)
-                except:
-                    logging.warning(f'WAT: Could not locate text for {result["id"]}')
+        collection_stats = harvest_query(url, base_url, concurrency, refresh)
+        for key, value in collection_stats.items():
+            stats[key] += value
 
         logging.info(f'for collection {base_url}...')
-        logging.info(f'{found-last_found} documents found; {total_words-last_words} words')
+        logging.info(f'{collection_stats["found"]} documents found; {collection_stats["total_words"]} words; {collection_stats["overlap"]} already harvested by other sources')
 
-    logging.info(f'{found} documents found of {total_docs} total; {total_words} total words')
+    logging.info(f'{stats["found"]} documents found of {stats["processed"]} total; {stats["total_words"]} total words')
@@ -1,36 +1,48 @@
+from collections import defaultdict
 import logging
-import subprocess
 
-from locr import Fetcher
-from locr.exceptions import AmbiguousText, ObjectNotOnline
+from . import batch_resolver, fetch_metadata
+from .response_cache import cached_get
+from .utilities import (http_adapter, jsonify, record_subjects, flush_subjects,
+                        harvest_texts)
 
-from .utilities import slurp, http_adapter, jsonify, filenamify, record_subjects
-
-def slurp_items(items):
+def slurp_items(items, concurrency=None, refresh=False, batch=None):
     """
     Takes a list of item URLs and writes the item full_text, if available.
 
     The `fo=json` parameter for the URL is optional; it will be supplied if
-    absent.
+    absent. Items already on disk are skipped unless `refresh` is set.
+
+    With `batch` (which defaults to fetch_metadata.BATCH_LOOKUPS), items are
+    looked up in batches via the search API (see batch_resolver), and only
+    the ones it can't find are requested one at a time. Otherwise, they're
+    all requested one at a time.
     """
     http = http_adapter()
+    results = []
+
+    if batch is None:
+        batch = fetch_metadata.BATCH_LOOKUPS
+
+    found = {}
+    if batch:
+        found = batch_resolver.resolve(
+            batch_resolver.extract_identifier(item) for item in items
+        )
 
     for item in items:
         logging.info(f'PROCESSING: {item}')
-        url = jsonify(item)
-        response = http.get(url).json()
-        result = response['item']
-        try:
-            text = Fetcher(result).full_text()
-        except (AmbiguousText, ObjectNotOnline):
-            logging.exception(f'Could not get text for {url}')
-            continue
-
+        result = found.get(batch_resolver.extract_identifier(item))
+        if result is None:
+            # Not looked up in a batch, or not found that way (it may not
+            # be at an /item/ URL); try it as given.
+            url = jsonify(item)
+            response = cached_get(http, url).json()
+            result = response['item']
         record_subjects(result)
+        results.append(result)
+
+    flush_subjects()
 
-        if text:
-            logging.info(filenamify(result))
-            with open(filenamify(result), 'w') as f:
-                f.write(text)
-        else:
-            logging.warning(f'WAT: Could not locate text for {result["id"]}')
+    stats = harvest_texts(results, defaultdict(int), concurrency, refresh, source='items')
+    logging.info(f'{stats["found"]} texts found of {len(items)} items; {stats["overlap"]} already harvested by other sources')
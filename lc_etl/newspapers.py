@@ -1,14 +1,21 @@
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import os
-import pickle
+from pathlib import Path
+from queue import Full, Queue
 import re
-import requests
-import shutil
-import subprocess
+import tarfile
+import threading
 from time import sleep
 
-from .utilities import http_adapter, check_for_disk_space, BASE_DIR
+import requests
+
+from .chronam_catalog import get_catalog
+from .corpus_store import open_corpus
+from .response_cache import cached_get
+from .throttle import backoff_delay
+from .utilities import (http_adapter, check_for_disk_space, in_context,
+                        passes_quality_gate, BASE_DIR, TIMEOUT)
 
 newspapers_list = ["American Freedman", "Annual Cyclopedia",
     "Atlanta Constitution", "Atlantic Monthly", "Augusta Loyal Georgian",
@@ -31,79 +38,22 @@ newspapers_list = ["American Freedman", "Annual Cyclopedia",
     "Springfield Republican", "The Great Republic (Washington, D.C.)",
     "The Nation", "Tribune Almanac", "Washington Chronicle"]
 
-http = http_adapter()
-
 # ~*~*~*~*~*~*~*~*~*~*~*~*~*~ find ALL the batches ~*~*~*~*~*~*~*~*~*~*~*~*~*~ #
 
 # There's a one-to-many relationship between newspapers and lccns, and a
-# many-to-many relationship between lccns and batches.
-def create_lccn_to_batch():
-    retval = defaultdict(set)
-    batches = http.get('https://chroniclingamerica.loc.gov/batches.json').json()
-    iteration = 0
-
-    while batches.get('next'):
-        for batch in batches['batches']:
-            lccns = batch['lccns']
-            for lccn in lccns:
-                retval[lccn].add(batch['name'])
-        logging.info(f'{iteration}: about to process {batches["next"]}')
-        iteration += 1
-        batches = http.get(batches['next']).json()
-        sleep(0.2)
-
-    return retval
-
-
+# many-to-many relationship between lccns and batches. All of that lives in
+# the ChronAm catalog; see chronam_catalog.
 def get_lccn_to_batch():
-    try:
-        with open(f'{BASE_DIR}/lccn_to_batch', 'rb') as f:
-            lccn_to_batch = pickle.load(f)
-    except:
-        lccn_to_batch = create_lccn_to_batch()
-        with open(f'{BASE_DIR}/lccn_to_batch', 'wb') as f:
-            pickle.dump(lccn_to_batch, f)
-
-    return lccn_to_batch
+    return get_catalog().lccn_to_batch()
 
 
 # ~*~*~*~*~*~*~*~*~*~*~*~*~ get ALL the newspapers ~*~*~*~*~*~*~*~*~*~*~*~*~ #
-def check_all_reconstruction_era_papers():
-    more_to_go = True
-    page = 1
-    chronam_id = re.compile(r'/lccn/(\w+)/')
-    all_lccns = set()
-    while more_to_go == True:
-        # You need all the query parameters, even the blank ones, or the API errors.
-        url = f'https://chroniclingamerica.loc.gov/search/titles/results/?city=&rows=200&terms=&language=English&lccn=&material_type=&year1=1863&year2=1877&labor=&county=&state=&frequency=&page={page}&ethnicity=&sort=state&format=json'
-        response = http.get(url).json()
-
-        try:
-            # ids are in format "/lccn/(lccn of item)"
-            lccns = [chronam_id.match(item['id']).group(1) for item in response['items']]
-            all_lccns.update(lccns)
-        except Exception as e:
-            logging.exception(f'Failed to fetch from {url}')
-
-        logging.info(f'page {page} processed')
-        more_to_go = (response['endIndex'] < response['totalItems'])
-        page += 1
-
-        sleep(0.2)
-
-    return all_lccns
+def get_all_lccns(year1=1863, year2=1877):
+    catalog = get_catalog()
+    if not catalog.has_title_search(year1, year2):
+        catalog.refresh_titles(year1, year2)
 
-
-def get_all_lccns():
-    try:
-        with open('reconstruction_era_papers', 'rb') as f:
-            all_lccns = pickle.load(f)
-    except:
-        all_lccns = check_all_reconstruction_era_papers()
-        with open('reconstruction_era_papers', 'wb') as f:
-            pickle.dump(all_lccns, f)
-
-    return all_lccns
+    return catalog.lccns_for_years(year1, year2)
 
 # For future processing: https://github.com/lmullen/chronam-ocr-debatcher ?
 
@@ -112,16 +62,16 @@ def get_all_lccns():
 def identify_batches_from_titles():
     all_batches_needed = set()
     available_newspapers = set()
-    lccn_to_batch = get_lccn_to_batch()
+    catalog = get_catalog()
     for newspaper in newspapers_list:
         name = newspaper.replace(' ', '+')
-        response = http.get(f'https://chroniclingamerica.loc.gov/suggest/titles/?q={name}')
+        response = cached_get(http_adapter(), f'https://chroniclingamerica.loc.gov/suggest/titles/?q={name}')
         # The structure of the returned content is:
         # [search_term, [matching titles], [their lccns], [their urls]]
         lccns = response.json()[2]
 
         for lccn in lccns:
-            batches = lccn_to_batch[lccn]
+            batches = catalog.batches_for_lccn(lccn)
             if len(batches):
                 available_newspapers.add(newspaper)
                 all_batches_needed.update(batches)
@@ -132,70 +82,50 @@ def identify_batches_from_titles():
     return all_batches_needed
 
 
-def identify_batches_from_lccns():
-    logging.info('mapping lccns to batches...')
-    all_batches_needed = set()
-    available_lccns = set()
-    all_lccns = get_all_lccns()
-    lccn_to_batch = get_lccn_to_batch()
-    for lccn in all_lccns:
-        batches = lccn_to_batch[lccn]
-        if len(batches):
-            available_lccns.add(lccn)
-            all_batches_needed.update(batches)
-
-    logging.info(f'{len(available_lccns)} newspapers found of {len(all_lccns)} original titles')
-    logging.info(f'{len(all_batches_needed)} total batches needed')
-
-    return all_batches_needed
-
-
 # ~*~*~*~*~*~*~*~*~*~*~*~*~ narrow to usable batches ~*~*~*~*~*~*~*~*~*~*~*~*~ #
-def restrict_to_ocred_batches():
-    ocr_available = http.get('https://chroniclingamerica.loc.gov/ocr.json').json()
-
-    batch_to_url = {}
-    for ocr in ocr_available['ocr']:
-        # The batches just provide a batch name, but in the ocr file they're listed
-        # as batch_name.tar.bz2.
-        batch_to_url[(ocr['name']).split('.')[0]] = ocr['url']
+def identify_chronam_downloads(goal_dates=range(1865, 1878)):
+    """
+    Returns the names and OCR tarball URLs of every batch containing a title
+    published during goal_dates, updating the catalog first (which only
+    fetches what it doesn't already know).
+    """
+    year1, year2 = min(goal_dates), max(goal_dates)
+    catalog = get_catalog()
+    catalog.refresh(year1, year2)
 
-    yay = 0
-    boo = 0
     final_batches = []
     final_urls = []
-    for batch in identify_batches_from_lccns():
-        if batch_to_url.get(batch):
-            yay += 1
+    boo = 0
+    for batch, url in catalog.batches_for_years(year1, year2):
+        if url:
             final_batches.append(batch)
-            final_urls.append(batch_to_url[batch])
+            final_urls.append(url)
         else:
             boo += 1
             logging.info(f'not found for {batch}')
 
-    logging.info(f'found {yay}, could not find {boo}')
-
-    return final_batches, final_urls
-
-
-def identify_chronam_downloads():
-    try:
-        with open(f'{BASE_DIR}/chronam_batches_needed', 'rb') as f:
-            final_batches = pickle.load(f)
-        with open(f'{BASE_DIR}/chronam_urls_needed', 'rb') as f:
-            final_urls = pickle.load(f)
-    except:
-        final_batches, final_urls = restrict_to_ocred_batches()
-        with open(f'{BASE_DIR}/chronam_batches_needed', 'wb') as f:
-            pickle.dump(final_batches, f)
-        with open(f'{BASE_DIR}/chronam_urls_needed', 'wb') as f:
-            pickle.dump(final_urls, f)
+    logging.info(f'found {len(final_batches)}, could not find {boo}')
 
     return final_batches, final_urls
 
 # ~*~*~*~*~*~*~*~*~*~*~*~*~ fetch batches ~*~*~*~*~*~*~*~*~*~*~*~*~ #
-tmpzip = f'{BASE_DIR}/tmpzip.zip'
 newspaper_dir = f'{BASE_DIR}/newspapers'
+download_dir = f'{BASE_DIR}/batch_downloads'
+
+DOWNLOAD_ATTEMPTS = 5
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# (connect, read) timeout for batch downloads. The read timeout is how long
+# to wait for each chunk, not the whole tarball.
+DOWNLOAD_TIMEOUT = (TIMEOUT, 60)
+# How many downloaded batches may wait for extraction at once.
+EXTRACT_QUEUE_SIZE = 2
+
+# Batch tarballs contain paths like
+# (prefix/)sn85025202/1865/01/14/ed-1/seq-2/ocr.txt, alongside an ocr.xml we
+# don't want.
+ocr_member = re.compile(
+    r'(?P<lccn>\w+)/(?P<year>\d{4})/\d{2}/\d{2}/ed-\d+/seq-\d+/ocr\.txt$'
+)
 
 def make_newspaper_dir():
     try:
@@ -204,58 +134,210 @@ def make_newspaper_dir():
         pass
 
 
-def get_batch_to_lccn():
-    batch_to_lccn = defaultdict(set)
-    lccn_to_batch = get_lccn_to_batch()
-    for lccn, batchlist in lccn_to_batch.items():
-        # We don't need the list comprehension output -- it's just a quick way to
-        # handle inverting this data structure. We care about the final
-        # batch_to_lccn.
-        [batch_to_lccn[batch].add(lccn) for batch in batchlist]
+def extract_batch(fileobj, goal_dates):
+    """
+    Reads a .tar.bz2 batch from `fileobj` as a stream, and writes only the
+    ocr.txt members for years in goal_dates into newspaper_dir (which may be a
+    packed store; see corpus_store). Nothing else
+    ever touches the disk, so there's nothing to clean up afterward. With
+    utilities.QUALITY_GATE, pages too poorly OCRed to keep aren't written
+    either.
 
-    return batch_to_lccn
+    `fileobj` need not be seekable, so this works directly on an HTTP body.
+    Returns the number of files written.
+    """
+    written = 0
+    low_quality = 0
+    corpus = open_corpus(newspaper_dir)
 
+    with tarfile.open(fileobj=fileobj, mode='r|bz2') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
 
-# The endpoint is exclusive, so this matches dates from 1865 through 1877.
-def slurp_newspapers(goal_dates=range(1865, 1878), count=None):
-    make_newspaper_dir()
-    batch_to_lccn = get_batch_to_lccn()
-    final_batches, final_urls = identify_chronam_downloads()
+            match = ocr_member.search(member.name)
+            if not match or int(match.group('year')) not in goal_dates:
+                continue
 
-    batch_match = re.compile(r'/([\w_]+).tar.bz2')
+            with tar.extractfile(member) as source:
+                text = source.read()
 
-    total = 0
+            if not passes_quality_gate(text.decode('utf-8', errors='replace')):
+                low_quality += 1
+                continue
 
-    for url in final_urls:
-        total += 1
-        # This lets us test with a small number of newspapers.
-        if total > count:
-            break
+            # The regex only admits word characters, digits and dashes, so
+            # this can't escape newspaper_dir.
+            corpus.write(match.group(0), text)
+            written += 1
+
+    corpus.flush()
+
+    if low_quality:
+        logging.info(f'Skipped {low_quality} poorly OCRed pages')
+
+    return written
 
-        logging.info(f'Downloading {url}...')
-        with requests.get(url, stream=True) as r:
-            r.raise_for_status()
-            with open(tmpzip, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    f.write(chunk)
 
-        batch_name = batch_match.search(url).group(1)
-        output_dirs = batch_to_lccn[batch_name]
+class IncompleteDownload(Exception):
+    pass
 
-        logging.info(f'....Extracting {url}')
-        subprocess.call(f'tar -xf {tmpzip} -C {newspaper_dir}', shell=True)
 
-        logging.info(f'....Removing extraneous directories')
-        for output_dir in output_dirs:
-            for subdir in os.listdir(os.path.join(newspaper_dir, output_dir)):
-                if int(subdir) not in goal_dates:
-                    shutil.rmtree(os.path.join(newspaper_dir, output_dir, subdir))
-            # We get everything in both .txt and .xml, but we only want .txt.
-            subprocess.call(f"find {os.path.join(newspaper_dir, output_dir)} -type f -name '*.xml' -delete", shell=True)
+def _expected_size(response, offset):
+    # For a ranged response, Content-Range looks like `bytes 100-999/1000`;
+    # otherwise Content-Length is the whole file.
+    content_range = response.headers.get('Content-Range')
+    if content_range and '/' in content_range:
+        total = content_range.split('/')[-1]
+        return int(total) if total.isdigit() else None
+
+    length = response.headers.get('Content-Length')
+    return int(length) + offset if length else None
+
+
+def download_batch(url):
+    """
+    Downloads a batch tarball into download_dir, resuming any partial download
+    left over from an earlier attempt with an HTTP Range request. The file is
+    only given its final name once its size has been checked against what the
+    server said to expect, so a file without a .part suffix is always complete.
+    Returns the path of the completed file.
+    """
+    output_path = Path(download_dir) / url.split('/')[-1]
+    if output_path.is_file():
+        return output_path
+
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    part_path = output_path.with_name(f'{output_path.name}.part')
+
+    for attempt in range(DOWNLOAD_ATTEMPTS):
+        offset = part_path.stat().st_size if part_path.is_file() else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+
+        try:
+            with http_adapter('batches').get(url, stream=True, headers=headers,
+                                             timeout=DOWNLOAD_TIMEOUT) as r:
+                if r.status_code == 416:
+                    # We already have every byte; we just never got to verify
+                    # and rename the file.
+                    expected = offset
+                else:
+                    r.raise_for_status()
+                    if offset and r.status_code != 206:
+                        # The server ignored our Range header and is sending
+                        # the whole thing, so start over.
+                        offset = 0
+                    expected = _expected_size(r, offset)
+
+                    with part_path.open('ab' if offset else 'wb') as f:
+                        for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                            f.write(chunk)
+
+            actual = part_path.stat().st_size
+            if expected is not None and actual != expected:
+                raise IncompleteDownload(f'{url}: got {actual} of {expected} bytes')
+
+            part_path.rename(output_path)
+            return output_path
+        except (requests.exceptions.RequestException, IncompleteDownload):
+            logging.exception(f'Download attempt {attempt + 1} failed for {url}')
+            sleep(backoff_delay(attempt))
+
+    raise IncompleteDownload(f'Giving up on {url} after {DOWNLOAD_ATTEMPTS} attempts')
+
+
+def _download_into(url, downloaded, stop):
+    if stop.is_set():
+        return
 
-        subprocess.call(f'rm {tmpzip}', shell=True)
+    try:
+        path = download_batch(url)
+    except Exception:
+        logging.exception(f'Could not download {url}')
+        path = None
+
+    # This blocks while the extraction queue is full, which stops this worker
+    # from starting another download until the extractor catches up. That
+    # bounds how many tarballs can be sitting on disk at once. If the
+    # extractor has given up, though, nobody's going to make room.
+    while not stop.is_set():
+        try:
+            downloaded.put((url, path), timeout=1)
+            return
+        except Full:
+            continue
+
+
+def _slurp_in_parallel(urls, goal_dates, workers):
+    downloaded = Queue(maxsize=EXTRACT_QUEUE_SIZE)
+    stop = threading.Event()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for url in urls:
+                executor.submit(in_context(_download_into), url, downloaded, stop)
+
+            # Extract in this thread while the pool keeps downloading.
+            for _ in urls:
+                url, path = downloaded.get()
+                if path is None:
+                    continue
+
+                logging.info(f'....Extracting {url}')
+                try:
+                    with path.open('rb') as f:
+                        written = extract_batch(f, goal_dates)
+                except Exception:
+                    logging.exception(f'Could not extract {url}')
+                    continue
+                path.unlink()
+
+                logging.info(f'....{written} pages extracted from {url}')
+                check_for_disk_space()
+        finally:
+            # However we got here (including check_for_disk_space exiting),
+            # let the download workers go, or leaving this block will wait on
+            # them forever. Anything already downloaded stays in
+            # download_dir for next time.
+            stop.set()
+            executor.shutdown(cancel_futures=True)
+
+
+def _slurp_in_sequence(urls, goal_dates):
+    for url in urls:
+        logging.info(f'Downloading and extracting {url}...')
+        with http_adapter('batches').get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
+            r.raise_for_status()
+            # Undo any transfer encoding, so tarfile sees the raw bz2 stream.
+            r.raw.decode_content = True
+            written = extract_batch(r.raw, goal_dates)
+
+        logging.info(f'....{written} pages extracted from {url}')
         check_for_disk_space()
 
+
+# The endpoint is exclusive, so this matches dates from 1865 through 1877.
+def slurp_newspapers(goal_dates=range(1865, 1878), count=None, download_workers=None):
+    """
+    Downloads ChronAm batches and extracts the OCR for goal_dates.
+
+    By default, each batch is streamed straight from the network into the
+    extractor, one at a time. With `download_workers`, that many batches are
+    downloaded at once (resuming interrupted transfers), while already-finished
+    batches are extracted.
+    """
+    make_newspaper_dir()
+    final_batches, final_urls = identify_chronam_downloads(goal_dates)
+
+    # This lets us test with a small number of newspapers.
+    if count:
+        final_urls = final_urls[:count]
+
+    if download_workers:
+        _slurp_in_parallel(final_urls, goal_dates, download_workers)
+    else:
+        _slurp_in_sequence(final_urls, goal_dates)
+
 # You might want to pick a subset because class imbalance.
 # Also if you're picking a subset to be on par with other things you may need
 # to think about pretrained vectors, for all that they are a problem.
@@ -0,0 +1,212 @@
+# The cache of nonword replacements that filter_nonwords (and its parallel and
+# batch versions) share, one SQLite file per model.
+#
+# It used to be a bare table that we queried once per nonword occurrence, and
+# that was a problem in a few ways:
+# - `nonword` wasn't indexed, so every lookup scanned the whole table;
+# - only successful replacements were stored, so every recurring bit of
+#   garbage went back to model.wv.most_similar every time we saw it;
+# - every new word was its own INSERT, built with an f-string, which broke on
+#   words with quotes in them.
+#
+# Now `nonword` is the primary key, nonwords with no replacement are stored
+# with NO_REPLACEMENT as their good word, writes are parameterized and
+# committed WRITE_BATCH at a time, and the most recently used MEMORY_SIZE
+# entries (to begin with, whatever's on disk) are kept in memory. Lookups are
+# counted and timed, and log_stats() reports how it's going.
+#
+# Caches with the old table are converted the first time they're opened.
+
+from collections import Counter, OrderedDict
+import logging
+from pathlib import Path
+import sqlite3
+import time
+
+from .utilities import BASE_DIR
+
+DB_DIR = 'nonword_caches'
+DB_TABLE = 'words'
+DB_NONWORD = 'nonword'
+DB_GOOD_WORD = 'good_word'
+
+# The good word for nonwords we've looked into that have no replacement. (The
+# old cache code treats this as "not cached", so it does no harm there.)
+NO_REPLACEMENT = ''
+# How many entries to keep in memory. Nonwords are short, so this is on the
+# order of 100 MB.
+MEMORY_SIZE = 500_000
+# Commit new entries once we have this many (and on flush/close).
+WRITE_BATCH = 1000
+
+
+def cache_path(model_path):
+    # sqlite3 will not create the directory structure if it doesn't exist, so
+    # we need to make sure to do that.
+    db_path = Path(BASE_DIR, DB_DIR)
+    db_path.mkdir(parents=True, exist_ok=True)
+    filename = Path(model_path).with_suffix('.db').name
+    return db_path / filename
+
+
+class NonwordCache(object):
+    """
+    The cache at `path`. With read_only, new entries are only remembered in
+    memory; filter_nonwords_parallel's workers use this, and leave the writing
+    to the main process.
+    """
+
+    def __init__(self, path, memory_size=MEMORY_SIZE, read_only=False):
+        super(NonwordCache, self).__init__()
+        self.path = Path(path)
+        self.memory_size = memory_size
+        self.read_only = read_only
+        self.memory = OrderedDict()
+        self.pending = {}
+        self.stats = Counter()
+
+        self.db = sqlite3.connect(self.path, timeout=60)
+        if not read_only:
+            # With WAL, readers (like filter_nonwords_parallel's workers)
+            # don't have to wait for our commits.
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self._upgrade()
+
+        self._preload()
+
+
+    def _upgrade(self):
+        columns = self.db.execute(f'PRAGMA table_info({DB_TABLE})').fetchall()
+        # table_info rows are (cid, name, type, notnull, default, pk).
+        if any(column[1] == DB_NONWORD and column[5] for column in columns):
+            return
+
+        if columns:
+            logging.info(f'Adding an index to the nonword cache at {self.path}')
+            self.db.execute(f'ALTER TABLE {DB_TABLE} RENAME TO {DB_TABLE}_old')
+
+        self.db.execute(
+            f'CREATE TABLE {DB_TABLE} ({DB_NONWORD} TEXT PRIMARY KEY, '
+            f'{DB_GOOD_WORD} TEXT NOT NULL) WITHOUT ROWID'
+        )
+
+        if columns:
+            # The old table could have duplicates; keep one of each.
+            self.db.execute(
+                f'INSERT OR IGNORE INTO {DB_TABLE} '
+                f'SELECT {DB_NONWORD}, {DB_GOOD_WORD} FROM {DB_TABLE}_old '
+                f'WHERE {DB_NONWORD} IS NOT NULL AND {DB_GOOD_WORD} IS NOT NULL'
+            )
+            self.db.execute(f'DROP TABLE {DB_TABLE}_old')
+
+        self.db.commit()
+
+
+    def _preload(self):
+        if not self.memory_size:
+            return
+
+        rows = self.db.execute(
+            f'SELECT {DB_NONWORD}, {DB_GOOD_WORD} FROM {DB_TABLE} LIMIT ?',
+            (self.memory_size,)
+        )
+        self.memory.update(rows)
+
+
+    def get(self, word):
+        """
+        The cached replacement for `word`: a word, NO_REPLACEMENT, or None if
+        we don't know.
+        """
+        start = time.perf_counter()
+
+        if word in self.memory:
+            self.memory.move_to_end(word)
+            replacement = self.memory[word]
+            self.stats['memory hits'] += 1
+        else:
+            row = self.db.execute(
+                f'SELECT {DB_GOOD_WORD} FROM {DB_TABLE} WHERE {DB_NONWORD} = ?', (word,)
+            ).fetchone()
+            replacement = self.pending.get(word, row[0] if row else None)
+
+            if replacement is None:
+                self.stats['misses'] += 1
+            else:
+                self.stats['disk hits'] += 1
+                self.remember(word, replacement)
+
+        if replacement == NO_REPLACEMENT:
+            self.stats['no replacement'] += 1
+
+        self.stats['lookup seconds'] += time.perf_counter() - start
+        return replacement
+
+
+    def remember(self, word, replacement):
+        """Adds an entry to the in-memory cache only."""
+        self.memory[word] = replacement
+        self.memory.move_to_end(word)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+
+    def put(self, word, replacement):
+        """Adds an entry. `replacement` may be NO_REPLACEMENT."""
+        self.remember(word, replacement)
+        if self.read_only:
+            return
+
+        self.pending[word] = replacement
+        if len(self.pending) >= WRITE_BATCH:
+            self.flush()
+
+
+    def lookup(self, word, derive):
+        """
+        The replacement for `word`, or None if there isn't one. If we don't
+        know, derive(word) works it out (returning a falsy value if there's
+        no replacement), and we cache the answer.
+        """
+        replacement = self.get(word)
+
+        if replacement is None:
+            start = time.perf_counter()
+            replacement = derive(word) or NO_REPLACEMENT
+            self.stats['derive seconds'] += time.perf_counter() - start
+            self.put(word, replacement)
+
+        return replacement or None
+
+
+    def flush(self):
+        if self.read_only or not self.pending:
+            return
+
+        self.db.executemany(
+            f'INSERT OR REPLACE INTO {DB_TABLE} VALUES (?, ?)', self.pending.items()
+        )
+        self.db.commit()
+        self.pending.clear()
+
+
+    def log_stats(self):
+        hits = self.stats['memory hits'] + self.stats['disk hits']
+        lookups = hits + self.stats['misses']
+        if not lookups:
+            return
+
+        lookup_us = self.stats['lookup seconds'] / lookups * 1e6
+        derive_ms = self.stats['derive seconds'] / max(self.stats['misses'], 1) * 1e3
+        logging.info(
+            f'Nonword cache: {lookups} lookups, {hits / lookups:.1%} hits '
+            f'({self.stats["memory hits"]} in memory, {self.stats["disk hits"]} on disk, '
+            f'{self.stats["no replacement"]} with no replacement), '
+            f'{self.stats["misses"]} misses; {lookup_us:.1f}µs per lookup, '
+            f'{derive_ms:.1f}ms per miss'
+        )
+
+
+    def close(self):
+        self.flush()
+        self.db.close()
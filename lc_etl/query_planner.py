@@ -0,0 +1,107 @@
+# Splits big loc.gov searches into smaller ones that can be paginated side by
+# side.
+#
+# paginate_search walks a query one page at a time, and for something like
+# /books/?dates=1865/1877 that's hundreds of pages in a row, with the deep
+# pages being the slowest and flakiest. Instead, if a query has a dates= range
+# and more hits than we like in one go, we rewrite it into one query per year
+# (and, for years that are still too big, per month), using each candidate's
+# pagination.of to decide. The shards can overlap (an item dated 1865/1866
+# matches both years), so whoever paginates them needs to deduplicate; the
+# crawl journal takes care of that for harvest_texts. Because of that overlap,
+# the years' counts should add up to at least the whole query's; if they
+# don't, some items aren't in any year, and we don't split the query at all.
+#
+# This doesn't import utilities, since utilities imports us; callers pass in
+# their session.
+
+import calendar
+import logging
+import re
+
+from .response_cache import cached_get
+
+# Queries with more hits than this get split up. At 500 results per page,
+# that's 20 pages.
+MAX_SHARD_RESULTS = 10000
+
+# We only know how to split whole-year ranges, e.g. dates=1863/1877.
+dates_param = re.compile(r'([?&]dates=)(\d{4})(/|%2F)(\d{4})(?=&|$)', re.IGNORECASE)
+
+
+def with_dates(url, dates):
+    """Returns `url` with its dates= range replaced by `dates`, leaving the
+    rest of the query string exactly as it was."""
+    return dates_param.sub(lambda match: f'{match.group(1)}{dates}', url, count=1)
+
+
+def count_results(url, session, **kwargs):
+    response = cached_get(session, f'{url}&c=1', **kwargs).json()
+    return response['pagination']['of']
+
+
+def _month_shards(url, year, year_count, session, **kwargs):
+    shards = []
+    total = 0
+
+    for month in range(1, 13):
+        last_day = calendar.monthrange(year, month)[1]
+        month_url = with_dates(url, f'{year}-{month:02}-01/{year}-{month:02}-{last_day}')
+        count = count_results(month_url, session, **kwargs)
+        total += count
+        if count:
+            shards.append(month_url)
+
+    # Items dated only to the year don't match any month, so unless the
+    # months account for everything, stick with the whole year.
+    if total < year_count:
+        return None
+
+    return shards
+
+
+def plan(url, session, max_results=MAX_SHARD_RESULTS, **kwargs):
+    """
+    Returns a list of search URLs which together cover everything `url` does.
+    That's just [url] unless `url` has a whole-year dates= range and more
+    than `max_results` hits. Extra kwargs (e.g. timeout) are passed to
+    cached_get.
+    """
+    match = dates_param.search(url)
+    if not match:
+        return [url]
+
+    try:
+        total = count_results(url, session, **kwargs)
+        if total <= max_results:
+            return [url]
+
+        shards = []
+        years_total = 0
+        for year in range(int(match.group(2)), int(match.group(4)) + 1):
+            year_url = with_dates(url, f'{year}/{year}')
+            year_count = count_results(year_url, session, **kwargs)
+            years_total += year_count
+
+            if not year_count:
+                continue
+
+            if year_count > max_results:
+                shards.extend(
+                    _month_shards(url, year, year_count, session, **kwargs) or [year_url]
+                )
+            else:
+                shards.append(year_url)
+
+        if years_total < total:
+            logging.warning(
+                f'Years of {url} only have {years_total} of its {total} hits; not splitting it'
+            )
+            return [url]
+    except Exception:
+        # If we can't work out a plan, the query still works the slow way.
+        logging.exception(f'Could not plan shards for {url}; not splitting it')
+        return [url]
+
+    logging.info(f'Split {url} into {len(shards)} shards')
+    return shards
@@ -0,0 +1,198 @@
+# A persistent cache of HTTP responses from loc.gov and chroniclingamerica.
+#
+# Re-running dataset.run or fetch_metadata.run used to re-download exactly the
+# same JSON every time. Instead, responses are stored in a SQLite file keyed by
+# normalized URL (so that `?fo=json&sp=2` and `?sp=2&fo=json` are the same
+# entry). Entries younger than their TTL are served straight from disk; older
+# ones are revalidated with If-None-Match/If-Modified-Since, so an unchanged
+# page costs a 304 rather than a full download. If revalidating fails because
+# the server is having trouble (5xx, or 429 for too many requests), we serve
+# the stale entry rather than nothing. In cache-only mode we never
+# touch the network at all, which is handy for offline work and for replaying
+# tests.
+#
+# This is only meant for the API calls (search pages, item JSON, the ChronAm
+# catalog). Don't route batch tarballs through it!
+
+import hashlib
+import json
+import logging
+from pathlib import Path
+import sqlite3
+import threading
+import time
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
+
+# This is BASE_DIR/http_cache.db; we can't import BASE_DIR from utilities,
+# because utilities imports us.
+CACHE_PATH = 'lc_etl/data/http_cache.db'
+DB_TABLE = 'responses'
+
+ENABLED = True
+# Never go to the network; raise CacheMiss for anything we don't have.
+CACHE_ONLY = False
+# Search results and item records change rarely; a week is a reasonable
+# default before we bother revalidating.
+DEFAULT_TTL = 7 * 24 * 60 * 60
+# Statuses on revalidation for which we'd rather have the stale entry.
+SERVE_STALE_ON = {429, 500, 502, 503, 504}
+
+_local = threading.local()
+_write_lock = threading.Lock()
+
+
+class CacheMiss(Exception):
+    pass
+
+
+class CachedResponse(object):
+    """Just enough of the requests.Response interface for our callers."""
+
+    def __init__(self, url, status_code, content, headers, from_cache):
+        super(CachedResponse, self).__init__()
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers
+        self.from_cache = from_cache
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+def configure(enabled=None, cache_only=None, ttl=None, path=None):
+    """Values left as None are unchanged."""
+    global ENABLED, CACHE_ONLY, DEFAULT_TTL, CACHE_PATH
+
+    if enabled is not None:
+        ENABLED = enabled
+    if cache_only is not None:
+        CACHE_ONLY = cache_only
+    if ttl is not None:
+        DEFAULT_TTL = ttl
+    if path is not None:
+        CACHE_PATH = path
+
+
+def normalize_url(url):
+    parsed = urlparse(url)
+    query = urlencode(sorted(parse_qsl(parsed.query, keep_blank_values=True)))
+    return urlunparse((
+        parsed.scheme.lower(), parsed.netloc.lower(), parsed.path or '/',
+        parsed.params, query, ''
+    ))
+
+
+def cache_key(url):
+    return hashlib.sha256(normalize_url(url).encode('utf-8')).hexdigest()
+
+
+def _get_db():
+    # sqlite3 connections can't be shared across threads, and the harvesters
+    # are threaded, so each thread gets its own connection.
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+
+    if CACHE_PATH not in connections:
+        Path(CACHE_PATH).parent.mkdir(parents=True, exist_ok=True)
+        db = sqlite3.connect(CACHE_PATH, timeout=30)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute(
+            f'CREATE TABLE IF NOT EXISTS {DB_TABLE} ('
+            'key TEXT PRIMARY KEY, url TEXT, status INTEGER, body BLOB, '
+            'etag TEXT, last_modified TEXT, content_type TEXT, '
+            'fetched_at REAL)'
+        )
+        db.commit()
+        connections[CACHE_PATH] = db
+
+    return connections[CACHE_PATH]
+
+
+def _lookup(key):
+    return _get_db().execute(
+        f'SELECT url, status, body, etag, last_modified, content_type, fetched_at '
+        f'FROM {DB_TABLE} WHERE key = ?', (key,)
+    ).fetchone()
+
+
+def _store(key, url, response):
+    with _write_lock:
+        db = _get_db()
+        db.execute(
+            f'INSERT OR REPLACE INTO {DB_TABLE} VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (key, url, response.status_code, response.content,
+             response.headers.get('ETag'), response.headers.get('Last-Modified'),
+             response.headers.get('Content-Type'), time.time())
+        )
+        db.commit()
+
+
+def _touch(key):
+    with _write_lock:
+        db = _get_db()
+        db.execute(f'UPDATE {DB_TABLE} SET fetched_at = ? WHERE key = ?', (time.time(), key))
+        db.commit()
+
+
+def _from_row(row):
+    url, status, body, etag, last_modified, content_type, _ = row
+    headers = {
+        k: v for k, v in [('ETag', etag), ('Last-Modified', last_modified),
+                          ('Content-Type', content_type)] if v
+    }
+    return CachedResponse(url, status, body, headers, from_cache=True)
+
+
+def cached_get(session, url, ttl=None, **kwargs):
+    """
+    GETs `url` with `session`, going through the on-disk cache. Extra kwargs
+    (e.g. timeout) are passed through to session.get. Only 200 responses are
+    cached; anything else is returned as-is so callers can handle it the way
+    they always have, except that if we have a stale entry and revalidating
+    it gets one of SERVE_STALE_ON, we log that and serve the stale entry.
+
+    Our sessions pace themselves (see throttle), so responses served from the
+    cache don't count against the rate limit.
+    """
+    if not ENABLED:
+        return session.get(url, **kwargs)
+
+    ttl = DEFAULT_TTL if ttl is None else ttl
+    key = cache_key(url)
+    row = _lookup(key)
+
+    if row and (CACHE_ONLY or time.time() - row[-1] < ttl):
+        return _from_row(row)
+
+    if CACHE_ONLY:
+        raise CacheMiss(url)
+
+    headers = dict(kwargs.pop('headers', None) or {})
+    if row:
+        etag, last_modified = row[3], row[4]
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+
+    response = session.get(url, headers=headers, **kwargs)
+
+    if response.status_code == 304 and row:
+        _touch(key)
+        return _from_row(row)
+
+    if response.status_code in SERVE_STALE_ON and row:
+        # Don't touch it, so that we try again next time.
+        logging.warning(f'Got {response.status_code} revalidating {url}; serving the cached copy')
+        return _from_row(row)
+
+    if response.status_code == 200:
+        _store(key, url, response)
+
+    return response
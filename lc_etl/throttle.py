@@ -0,0 +1,265 @@
+# One place that decides how hard we lean on loc.gov and chroniclingamerica.
+#
+# Every shared session (see utilities.http_adapter) sends its requests through
+# ThrottledAdapter, which paces them with an AdaptiveRateLimiter per host.
+# That limiter does AIMD, like TCP: each success nudges the rate up a little,
+# and each 429 or 503 halves it. If the server says how long to wait (with
+# Retry-After), every thread talking to that host waits that long; otherwise
+# throttled and failed requests are retried after a jittered exponential
+# backoff. So we back off together when the server objects, rather than each
+# thread hammering away on its own schedule.
+#
+# By default a limiter never goes faster than it started, which is about the
+# pace the old fixed sleeps kept (0.3s a search page, 0.5s an item), so AIMD
+# only recovers from backoffs. Going faster is opt-in: probe_up_to (which is
+# what requests_per_second in fetch_metadata.run and dataset.run calls) lets
+# it climb as far as MAX_RATE.
+#
+# Like response_cache, this doesn't import utilities, since utilities imports
+# us.
+
+from collections import defaultdict
+from email.utils import parsedate_to_datetime
+import logging
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+
+# Where each host's rate starts out, in requests per second, and the bounds
+# AIMD keeps it within. MAX_RATE is only reached by opting in (see above).
+DEFAULT_RATE = 2
+MIN_RATE = 0.1
+MAX_RATE = 20
+# Each success adds about this much to the rate per second of requests at the
+# current rate...
+RATE_INCREASE = 0.2
+# ...and each throttling response multiplies it by this, at most once per
+# DECREASE_INTERVAL seconds (a burst of 429s to requests that were all in
+# flight at once is one signal, not several).
+RATE_DECREASE = 0.5
+DECREASE_INTERVAL = 2
+
+THROTTLE_STATUSES = {429, 503}
+RETRY_STATUSES = THROTTLE_STATUSES | {500, 502, 504}
+MAX_ATTEMPTS = 5
+BASE_BACKOFF = 1
+MAX_BACKOFF = 120
+
+
+def backoff_delay(attempt, base=BASE_BACKOFF, cap=MAX_BACKOFF):
+    """Full-jitter exponential backoff: a random delay of up to
+    base * 2**attempt seconds (capped), so that threads which failed together
+    don't all retry together."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def parse_retry_after(value):
+    """Retry-After is either a number of seconds or an HTTP date. Returns
+    seconds, or None if it's missing or unparseable."""
+    if not value:
+        return None
+
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def _format_rate(rate):
+    return f'{rate:.2f} requests/s' if rate else 'no rate limit'
+
+
+class RateLimiter(object):
+    """Token bucket shared by any number of threads. Tokens refill at `rate`
+    per second, up to `burst`; each call to wait() takes one, sleeping until
+    one is available. The default burst of 1 simply spaces calls 1/rate
+    seconds apart. A rate of 0 or None means no limit."""
+
+    def __init__(self, rate=DEFAULT_RATE, burst=1):
+        super(RateLimiter, self).__init__()
+        self.lock = threading.Lock()
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate = rate
+
+    def _delay(self):
+        # Called with the lock held.
+        if not self.rate:
+            return 0
+
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    def wait(self):
+        # Take our token while holding the lock -- going into debt if the
+        # bucket is empty -- but sleep outside of it, so that threads queue up
+        # behind one another rather than behind whoever is currently asleep.
+        with self.lock:
+            delay = self._delay()
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+class AdaptiveRateLimiter(RateLimiter):
+    """A RateLimiter whose rate follows the server's responses (see the top of
+    this module). Also keeps count of what's happened, for stats()."""
+
+    def __init__(self, name, rate=DEFAULT_RATE, min_rate=MIN_RATE, max_rate=None):
+        self.name = name
+        self.min_rate = min_rate
+        self.max_rate = rate if max_rate is None else max_rate
+        # Nobody may send before this (time.monotonic()) time.
+        self.paused_until = 0
+        self.last_decrease = 0
+        self.counts = defaultdict(int)
+        super(AdaptiveRateLimiter, self).__init__(rate)
+
+    def set_rate(self, rate, max_rate=None):
+        """Paces at `rate` from now on. AIMD may raise it as far as
+        `max_rate`; by default, no higher than `rate` itself."""
+        with self.lock:
+            self.rate = rate
+            self.max_rate = rate if max_rate is None else max_rate
+
+    def probe_up_to(self, requests_per_second):
+        """Opts in to going faster: from wherever the rate is now (or
+        `requests_per_second`, if that's lower), successes may raise it as
+        far as `requests_per_second`, capped at MAX_RATE."""
+        with self.lock:
+            self.max_rate = min(requests_per_second, MAX_RATE)
+            if self.rate:
+                self.rate = min(self.rate, self.max_rate)
+
+    def wait(self):
+        with self.lock:
+            pause = self.paused_until - time.monotonic()
+            delay = self._delay()
+
+        delay = max(delay, pause)
+        if delay > 0:
+            time.sleep(delay)
+
+    def succeeded(self):
+        with self.lock:
+            self.counts['requests'] += 1
+            if self.rate:
+                self.rate = min(self.max_rate, self.rate + RATE_INCREASE / self.rate)
+
+    def throttled(self, retry_after=None, attempt=0):
+        """Records a 429/503. Everyone waits `retry_after` seconds if the
+        server said so, or a backoff for this `attempt` otherwise."""
+        pause = retry_after if retry_after is not None else backoff_delay(attempt)
+
+        with self.lock:
+            now = time.monotonic()
+            self.counts['requests'] += 1
+            self.counts['throttled'] += 1
+            self.paused_until = max(self.paused_until, now + pause)
+
+            if self.rate and now - self.last_decrease > DECREASE_INTERVAL:
+                self.rate = max(self.min_rate, self.rate * RATE_DECREASE)
+                self.last_decrease = now
+            rate = self.rate
+
+        logging.warning(f'{self.name} is throttling us; pausing {pause:.1f}s, then {_format_rate(rate)}')
+
+    def failed(self):
+        """Records a server error or network failure (which doesn't change
+        the rate)."""
+        with self.lock:
+            self.counts['requests'] += 1
+            self.counts['failed'] += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'rate': self.rate,
+                'requests': self.counts['requests'],
+                'throttled': self.counts['throttled'],
+                'failed': self.counts['failed'],
+            }
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(host):
+    """Returns the shared AdaptiveRateLimiter for `host`, creating it on
+    first use."""
+    with _limiters_lock:
+        if host not in _limiters:
+            _limiters[host] = AdaptiveRateLimiter(host)
+        return _limiters[host]
+
+
+def log_throttle_stats():
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+
+    for limiter in limiters:
+        stats = limiter.stats()
+        logging.info(
+            f'{limiter.name}: {stats["requests"]} requests, {stats["throttled"]} '
+            f'throttled, {stats["failed"]} failed; ending at {_format_rate(stats["rate"])}'
+        )
+
+
+class ThrottledAdapter(requests.adapters.HTTPAdapter):
+    """
+    HTTPAdapter that paces requests with the host's AdaptiveRateLimiter and
+    retries throttled requests, server errors and network failures (up to
+    MAX_ATTEMPTS in all). Whatever the last attempt got is returned (or
+    raised), so callers see the same responses and exceptions as ever.
+    """
+
+    def send(self, request, **kwargs):
+        limiter = get_limiter(urlparse(request.url).hostname)
+
+        for attempt in range(MAX_ATTEMPTS):
+            last_attempt = attempt == MAX_ATTEMPTS - 1
+            limiter.wait()
+
+            try:
+                response = super(ThrottledAdapter, self).send(request, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                limiter.failed()
+                if last_attempt:
+                    raise
+                time.sleep(backoff_delay(attempt))
+                continue
+
+            if response.status_code not in RETRY_STATUSES:
+                limiter.succeeded()
+                return response
+
+            if response.status_code in THROTTLE_STATUSES:
+                limiter.throttled(
+                    parse_retry_after(response.headers.get('Retry-After')), attempt
+                )
+            else:
+                limiter.failed()
+
+            if last_attempt:
+                return response
+
+            response.close()
+            if response.status_code not in THROTTLE_STATUSES:
+                time.sleep(backoff_delay(attempt))
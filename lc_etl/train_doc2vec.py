@@ -1,6 +1,5 @@
 from argparse import ArgumentParser
 from collections import defaultdict
-import glob
 from importlib import import_module
 import logging
 from pathlib import Path
@@ -13,6 +12,7 @@ from gensim.models.doc2vec import Doc2Vec, TaggedDocument
 from gensim.models.callbacks import CallbackAny2Vec
 from gensim.parsing.preprocessing import remove_stopwords
 
+from .corpus_store import open_corpus
 from .utilities import make_timestamp, initialize_logger, BASE_DIR
 
 output_dir = f'{BASE_DIR}/gensim_outputs'
@@ -49,40 +49,38 @@ class EpochLogger(CallbackAny2Vec):
 
 
 # Iterates through all available LoC files, yielding (document, tag).
-# Document is unprocessed -- a straight read of the file.
+# Document is unprocessed -- a straight read of the file. The newspaper and
+# results dirs may be directories or packed stores (see corpus_store).
 class LocDiskIterator:
+    # Expected path format: 'lccn/yyyy/mm/dd/ed-x/seq-x/ocr.txt'
+    newspaper_path = re.compile(r'[\w/-]+/ocr.txt')
+
     def __init__(self, config):
         super(LocDiskIterator, self).__init__()
         self.newspaper_dir = config.newspaper_dir
         self.newspaper_dir_regex = config.newspaper_dir_regex
         self.results_dir = config.results_dir
-        self.newspaper_path = re.compile(f'{self.newspaper_dir}/([\w/-]+)/ocr.txt')
 
     def __iter__(self):
         # First do newspapers
-        for newspaper in glob.iglob(f'{self.newspaper_dir}/**/*.txt', recursive=True):
-            # Expected path format: 'newspapers/lccn/yyyy/mm/dd/ed-x/seq-x/ocr.txt'
-
-            # We can't use regular expressions in glob, so we'll perform some
-            # post hoc filtering to skip anything that doesn't match our
-            # desired path.
-            if not re.search(self.newspaper_path, newspaper):
+        newspapers = open_corpus(self.newspaper_dir)
+        for entry in newspapers.entries('ocr.txt'):
+            # The manifest (or scan) finds every ocr.txt; skip anything that
+            # doesn't match our desired path.
+            if not self.newspaper_path.fullmatch(entry.doc_id):
                 continue
 
-            tag = self.newspaper_path.search(newspaper).group(1)
-            with open(newspaper, 'r') as f:
-                document = f.read()
+            document = newspapers.read(entry.doc_id)
 
-            yield (document, tag)
+            yield (document, entry.tag)
 
         # Then do everything else
-        for result in glob.iglob(f'{self.results_dir}/*'):
+        results = open_corpus(self.results_dir)
+        for entry in results.entries(recursive=False):
             # Expected path: 'results/lccn'
-            tag = result.split('/')[-1]
-            with open(result, 'r') as f:
-                document = f.read()
+            document = results.read(entry.doc_id)
 
-            yield (document, tag)
+            yield (document, entry.tag)
 
 
 # Iterates through all available LoC files, yielding TaggedDocuments.
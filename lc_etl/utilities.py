@@ -1,10 +1,12 @@
-from collections import defaultdict
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import contextvars
 import json
 import logging
 from pathlib import Path
 import shutil
-import subprocess
 import sys
+import threading
 import time
 from urllib.parse import urlparse, urlunparse, parse_qs, urlencode
 
@@ -13,35 +15,156 @@ import requests
 from locr import Fetcher
 from locr.exceptions import AmbiguousText, ObjectNotOnline
 
+from .corpus_store import open_corpus
+from .crawl_journal import get_journal
+from .query_planner import plan
+from .response_cache import cached_get
+from .throttle import (get_limiter, log_throttle_stats, backoff_delay,
+                       ThrottledAdapter)
+
 def make_timestamp():
     return time.strftime('%Y%m%d_%H%M%S', time.localtime())
 
 
 PAGE_LENGTH = 500
 TIMEOUT = 3
+# Give up on a search after this many failures in a row on one page.
+MAX_PAGE_FAILURES = 5
+
+# Fulltext harvesting runs this many fetches at once. Each locr fetch is at
+# least two requests (the item page, then the text itself), so the rate limit
+# below is what actually keeps us polite; this just bounds how many requests
+# can be in flight.
+CONCURRENCY = 8
+# Global budget shared by every harvesting thread, in fulltext fetches per
+# second. It drops when loc.gov pushes back and recovers afterwards, but
+# only goes higher if configure_harvest is asked to (see throttle).
+REQUESTS_PER_SECOND = 4
+# Big searches are split up by query_planner, and this many of the pieces are
+# paginated at once (each with its own CONCURRENCY fulltext fetches).
+SHARD_WORKERS = 4
 BASE_DIR = 'lc_etl/data'
 
 DEFAULT_NEWSPAPER_DIR = 'newspapers'
 DEFAULT_RESULTS_DIR = 'results'
 
+# When set, harvest_texts also writes each search result it has text for to
+# RECORDS_DIR, so that fetch_metadata can build metadata from it rather than
+# requesting the item all over again. These live outside results/ because
+# everything in there is taken to be a fulltext.
+SAVE_RECORDS = False
+RECORDS_DIR = f'{BASE_DIR}/search_records'
+
+# When set, fulltexts are scored for OCR quality before they're written (by
+# harvest_texts and newspapers.extract_batch), and ones that filter_ocr would
+# delete anyway are never written at all. Off by default, since it needs the
+# spacy model.
+QUALITY_GATE = False
+
 (Path(BASE_DIR) / 'results').mkdir(exist_ok=True, parents=True)
 
-def http_adapter():
-    # Get around intermittent 500s or whatever. Unfortunately this opens a
-    # socket that stays open, throwing ResourceWarnings during test. If you call
-    # the adapter with a context manager, the session will close:
-    # with http as h:
-    #    response = h.get(whatever)
-    retry = requests.packages.urllib3.util.retry.Retry(
-        status=3, status_forcelist=[429, 500, 503]
-    )
-    adapter = requests.adapters.HTTPAdapter(max_retries=retry)
+# Sessions are shared process-wide, keyed by name, so that every loc.gov and
+# chroniclingamerica client reuses the same keep-alive connections rather than
+# paying for a fresh TCP+TLS handshake on every call.
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def _make_session():
+    # ThrottledAdapter paces everything and gets around intermittent 500s,
+    # 429s and so on (see throttle). One pool per host, with room for as many
+    # connections as we have requests in flight, so that concurrent
+    # harvesting threads don't end up opening (and then discarding)
+    # connections beyond the pool size.
+    adapter = ThrottledAdapter(pool_maxsize=CONCURRENCY)
     http = requests.Session()
     http.mount("https://", adapter)
     http.mount("http://", adapter)
     return http
 
 
+def http_adapter(name='default'):
+    """
+    Returns the shared session registered under `name`, creating it on first
+    use. Don't close it (e.g. with a context manager); other callers are using
+    its connections. Use close_sessions() if you really need to tear them down.
+    """
+    with _sessions_lock:
+        if name not in _sessions:
+            _sessions[name] = _make_session()
+        return _sessions[name]
+
+
+def close_sessions():
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def connection_stats():
+    """
+    Reports how many connections the shared sessions have opened, and how many
+    requests were served over an already-open connection. Once things are warm,
+    `reused` should dwarf `opened`.
+    """
+    opened = 0
+    requests_made = 0
+
+    with _sessions_lock:
+        adapters = {
+            id(adapter): adapter
+            for session in _sessions.values()
+            for adapter in session.adapters.values()
+        }
+
+        for adapter in adapters.values():
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                opened += pool.num_connections
+                requests_made += pool.num_requests
+
+    return {'opened': opened, 'reused': max(requests_made - opened, 0)}
+
+
+def log_connection_stats():
+    stats = connection_stats()
+    logging.info(f'HTTP connections: {stats["opened"]} opened, {stats["reused"]} reused')
+    log_throttle_stats()
+
+
+# Fulltexts are fetched by locr, which doesn't use our sessions, so it can't
+# see 429s for itself; instead, it shares the budget that our own loc.gov
+# requests adapt.
+rate_limiter = get_limiter('www.loc.gov')
+rate_limiter.set_rate(REQUESTS_PER_SECOND)
+
+
+def configure_harvest(concurrency=None, requests_per_second=None,
+                      save_records=None, quality_gate=None):
+    """
+    Adjusts the concurrency limit, global rate budget, record saving and
+    quality gate used by harvest_texts. Values left as None are unchanged.
+    """
+    global CONCURRENCY, SAVE_RECORDS, QUALITY_GATE
+
+    if save_records is not None:
+        SAVE_RECORDS = save_records
+
+    if quality_gate is not None:
+        QUALITY_GATE = quality_gate
+
+    if concurrency and concurrency != CONCURRENCY:
+        CONCURRENCY = concurrency
+        # Connection pools are sized at creation time, so start over with
+        # pools big enough for the new concurrency.
+        close_sessions()
+
+    if requests_per_second is not None:
+        rate_limiter.probe_up_to(requests_per_second)
+
+
 def initialize_logger(logfile):
     logging.basicConfig(filename=logfile,
                         filemode='a',
@@ -49,6 +172,33 @@ def initialize_logger(logfile):
                         level=logging.INFO)
 
 
+# Which group of sources (see dataset.run) we're currently harvesting for, so
+# that groups running side by side can keep their logs apart. Thread pools
+# don't pass this along by themselves; submit work with in_context if it
+# logs.
+source_group = contextvars.ContextVar('source_group', default=None)
+
+
+def in_context(fn):
+    """Wraps `fn` to run in a copy of the current context (and so the
+    current source_group), as in executor.submit(in_context(fn), ...). Each
+    copy can only be running in one thread at a time, so wrap once per
+    submit."""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(fn, *args, **kwargs)
+
+
+class SourceGroupFilter(logging.Filter):
+    """Passes only log records made while harvesting for `group`."""
+
+    def __init__(self, group):
+        super(SourceGroupFilter, self).__init__()
+        self.group = group
+
+    def filter(self, record):
+        return source_group.get() == self.group
+
+
 class LocUrl(object):
     """docstring for LocUrl."""
 
@@ -113,46 +263,59 @@ def filter_results(response):
     ]
 
 
-def paginate_search(url):
+def paginate_search(url, start_page=1):
     next_page = True
-    page = 1    # LC pagination is 1-indexed
+    page = start_page    # LC pagination is 1-indexed
     http = http_adapter()
-    emergency_exit = 0
+    # The session has already retried (and backed off) by the time we see a
+    # failure, so a few in a row on the same page means something is really
+    # wrong.
+    failures = 0
 
     while next_page:
         current_url = f'{url}&sp={page}&c={PAGE_LENGTH}'
         try:
-            response = http.get(current_url, timeout=TIMEOUT).json()
-        except json.decoder.JSONDecodeError as e:
-            logging.exception(f'Could not decode {current_url}')
-            # Sometimes this error is intermittent -- we get a 5xx page instead
-            # of JSON.
-            emergency_exit += 1
-            time.sleep(180)
-            continue
-        except requests.exceptions.ConnectionError:
-            logging.exception(f'Timeout for {current_url}; waiting')
-            time.sleep(180)
-            emergency_exit += 1
+            response = cached_get(http, current_url, timeout=TIMEOUT).json()
+        except (json.decoder.JSONDecodeError, requests.exceptions.RequestException):
+            # Sometimes we get a 5xx page instead of JSON, or time out.
+            logging.exception(f'Could not get {current_url}')
+            failures += 1
+            if failures >= MAX_PAGE_FAILURES:
+                logging.warning('Quit search early due to excessive failures')
+                break
+            time.sleep(backoff_delay(failures))
             continue
 
-        if emergency_exit >= 10:
-            logger.warning('Quit search early due to excessive failures')
-            break
-
+        failures = 0
         page += 1
         next_page = response['pagination']['next']  # Will be null when done
-        time.sleep(0.3)  # respect rate limit
 
         yield response
 
 
-def filenamify(result):
+def _result_name(result):
     name = result['id']
     name = name.split('/')
     # will strip null string after trailing slash if present
     name = [x for x in name if x]
-    return str(Path(BASE_DIR) / 'results' / name[-1])
+    return name[-1]
+
+
+def filenamify(result):
+    return str(Path(BASE_DIR) / 'results' / _result_name(result))
+
+
+def recordify(result):
+    """Where harvest_texts saves `result` itself, when SAVE_RECORDS is set."""
+    return str(Path(RECORDS_DIR) / f'{_result_name(result)}.json')
+
+
+def save_record(result):
+    path = Path(recordify(result))
+    if not path.is_file():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with path.open('w') as f:
+            json.dump(result, f)
 
 
 def jsonify(url):
@@ -168,25 +331,334 @@ def jsonify(url):
         return url
 
 
-# By recording the subjects of processed items, we'll be able to use unix
-# utilities later to see what the most common subjects are, and consider
+# By recording the subjects of processed items, we'll be able to see later
+# what the most common subjects are (most_common_subjects), and consider
 # expanding our search accordingly.
+#
+# Subjects are tallied in memory and merged into SUBJECTS_FILE, a
+# tab-separated table of subject and count, at the end of each query (or
+# sooner, once SUBJECTS_FLUSH_EVERY results have piled up).
+SUBJECTS_FILE = 'subjects.txt'
+SUBJECTS_FLUSH_EVERY = 10000
+
+_subjects = Counter()
+_subjects_pending = 0
+_subjects_lock = threading.Lock()
+
+
+def _read_subjects():
+    subjects = Counter()
+    try:
+        with open(SUBJECTS_FILE) as f:
+            for line in f:
+                line = line.rstrip('\n')
+                if not line:
+                    continue
+                subject, _, count = line.rpartition('\t')
+                if subject and count.isdigit():
+                    subjects[subject] += int(count)
+                else:
+                    # The file used to be one line per subject per result.
+                    subjects[line] += 1
+    except FileNotFoundError:
+        pass
+    return subjects
+
+
+def _flush_subjects():
+    # Called with _subjects_lock held.
+    global _subjects_pending
+
+    if not _subjects:
+        return
+
+    subjects = _read_subjects()
+    subjects.update(_subjects)
+
+    temp_file = f'{SUBJECTS_FILE}.tmp'
+    with open(temp_file, 'w') as f:
+        for subject, count in subjects.most_common():
+            f.write(f'{subject}\t{count}\n')
+    Path(temp_file).replace(SUBJECTS_FILE)
+
+    _subjects.clear()
+    _subjects_pending = 0
+
+
+def flush_subjects():
+    with _subjects_lock:
+        _flush_subjects()
+
+
 def record_subjects(result):
-    subjects_file = 'subjects.txt'
-    subprocess.call(f'touch {subjects_file}', shell=True)
+    global _subjects_pending
+
+    with _subjects_lock:
+        _subjects.update(result.get('subject') or [])
+        _subjects_pending += 1
+        if _subjects_pending >= SUBJECTS_FLUSH_EVERY:
+            _flush_subjects()
+
+
+def most_common_subjects(n=None):
+    """[(subject, count)] for everything recorded so far, most common first."""
+    with _subjects_lock:
+        subjects = _read_subjects()
+        subjects.update(_subjects)
+    return subjects.most_common(n)
+
+
+def _fetch_text(result):
+    rate_limiter.wait()
+    return Fetcher(result).full_text()
+
+
+def passes_quality_gate(text):
+    """True unless QUALITY_GATE is on and `text` fails filter_ocr's test."""
+    if not QUALITY_GATE:
+        return True
+
+    # filter_ocr imports us (and spacy), so import it only when we need it.
+    from .filter_ocr import passes_quality
+    return passes_quality(text)
+
+
+def harvest_texts(results, stats, concurrency=None, refresh=False, source=None):
+    """
+    Fetches the full texts of a list of search results, several at a time, and
+    writes each one found to filenamify(result).
+
+    Results whose text is already on disk, or which the crawl journal says
+    some source (`source` names this one; see log_overlaps) has already
+    handled or is handling right now, are skipped unless `refresh` is set.
+
+    With SAVE_RECORDS, every result with text on disk also has its search
+    record saved (see recordify), including ones harvested on earlier runs.
 
-    with open(subjects_file, 'a') as f:
-        for subject in (result.get('subject') or []):
-            f.write(f'{subject}\n')
+    With QUALITY_GATE, texts that fail passes_quality_gate are counted as
+    low_quality and not written (though they are journaled as done, so we
+    don't fetch them again next time).
+
+    Updates `stats` (a defaultdict(int)) in place with the same counters slurp
+    has always kept: processed, found, total_words, not_found, failed (plus
+    skipped, of which overlap were harvested by other sources, and
+    low_quality). Counters are only touched from the calling thread, so
+    callers can read them freely once this returns.
+    """
+    concurrency = concurrency or CONCURRENCY
+    journal = get_journal()
+
+    if SAVE_RECORDS:
+        for result in results:
+            if Path(filenamify(result)).is_file():
+                save_record(result)
+
+    if not refresh:
+        seen = journal.claim_items([result['id'] for result in results], source)
+        to_fetch = {}
+        on_disk = []
+        for result in results:
+            if result['id'] in seen:
+                if seen[result['id']] != source:
+                    stats['overlap'] += 1
+            elif Path(filenamify(result)).is_file():
+                # Harvested before we kept a journal; journal it now.
+                on_disk.append(result['id'])
+            else:
+                to_fetch.setdefault(result['id'], result)
+        journal.complete_items(on_disk)
+        stats['skipped'] += len(results) - len(to_fetch)
+        results = list(to_fetch.values())
+
+    completed = []
+    failed = []
+    results_corpus = open_corpus(Path(BASE_DIR) / DEFAULT_RESULTS_DIR)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {
+            executor.submit(_fetch_text, result): result for result in results
+        }
+
+        for future in as_completed(futures):
+            result = futures[future]
+            stats['processed'] += 1
+            if stats['processed'] % 100 == 0:
+                logging.info(f'...{stats["processed"]} processed')
+
+            try:
+                text = future.result()
+            except (AmbiguousText, ObjectNotOnline):
+                logging.exception(f'Could not get text for {result["id"]}')
+                stats['failed'] += 1
+                failed.append(result['id'])
+                continue
+            except Exception:
+                logging.exception(f'Failed on {result["id"]} with image_url {result.get("image_url")}')
+                stats['failed'] += 1
+                failed.append(result['id'])
+                continue
+
+            if text and not passes_quality_gate(text):
+                stats['low_quality'] += 1
+            elif text:
+                stats['found'] += 1
+                stats['total_words'] += len(text.split(' '))
+                # Through the corpus, so its manifest (if any) keeps up.
+                results_corpus.write(_result_name(result), text)
+                if SAVE_RECORDS:
+                    save_record(result)
+            else:
+                logging.warning(f'Could not locate text for {result["id"]}')
+                stats['not_found'] += 1
+
+            completed.append(result['id'])
+
+    results_corpus.flush()
+    journal.complete_items(completed, source)
+    journal.release_items(failed)
+
+    return stats
+
+
+def log_overlaps():
+    """Logs how many items each source turned up that another source had
+    already harvested (and so which dataset definition entries are mostly
+    redundant)."""
+    overlaps = get_journal().overlaps
+    if not overlaps:
+        return
+
+    logging.info(f'{sum(overlaps.values())} items were found by more than one source:')
+    for (source, other_source), count in overlaps.most_common():
+        logging.info(f'  {count} from {source} already harvested by {other_source or "an earlier run"}')
+
+
+def journaled_search(url, refresh=False):
+    """
+    Wraps paginate_search, resuming after the last page the crawl journal says
+    was finished. Yields (page, response); callers must call
+    get_journal().complete_page once they're done with each page (but not
+    for a page with items they'll want to retry, or any page after it).
+    Queries the
+    journal says are entirely finished yield nothing, unless `refresh` is set.
+    """
+    journal = get_journal()
+
+    if refresh:
+        journal.forget_query(url)
+
+    last_page, finished = journal.last_page(url)
+
+    if finished:
+        logging.info(f'{url} already fully harvested; skipping')
+        return
+
+    if last_page:
+        logging.info(f'Resuming {url} at page {last_page + 1}')
+
+    page = last_page + 1
+    for response in paginate_search(url, start_page=page):
+        yield page, response
+        page += 1
 
 
-def check_for_disk_space():
+def check_for_disk_space(stats=None):
+    """Exits if we're down to our last GB. `stats`, if given, are the
+    harvest_texts counters so far, which get logged on the way out."""
     if shutil.disk_usage('/')[-1] < 1000000000:
         logging.info('Quitting for disk space!')
-        logging.info(f'{stats["processed"]} processed, {stats["found"]} texts found with {stats["total_words"]} total words, {stats["not_found"]} not found, {stats["failed"]} failed, of {response["pagination"]["of"]} total')
+        if stats is not None:
+            logging.info(f'{stats["processed"]} processed, {stats["found"]} texts found with {stats["total_words"]} total words, {stats["not_found"]} not found, {stats["failed"]} failed, of {stats["of"]} total')
         sys.exit()
 
 
+def _harvest_pages(url, source, concurrency, refresh, subjects):
+    stats = defaultdict(int)
+    # Once a page has had failures, we stop moving the journal's last page
+    # forward, so that the next run comes back for them. (Items that did
+    # work are journaled individually, so they won't be fetched again.)
+    retry_from = None
+
+    for page, response in journaled_search(url, refresh):
+        results = filter_results(response)
+        logging.info(f'Processing {len(results)} usable results...')
+        if subjects:
+            for result in results:
+                record_subjects(result)
+
+        failed = stats['failed']
+        harvest_texts(results, stats, concurrency, refresh, source)
+        if stats['failed'] > failed and retry_from is None:
+            retry_from = page
+            logging.warning(f'Items failed on page {page} of {url}; will retry from there next run')
+
+        if retry_from is None:
+            get_journal().complete_page(url, page, not response['pagination']['next'])
+        stats['of'] = response['pagination']['of']
+
+        check_for_disk_space(stats)
+
+    return stats
+
+
+def harvest_query(url, source=None, concurrency=None, refresh=False,
+                  subjects=False, shard=True):
+    """
+    Harvests the fulltexts of every page of results for a search URL. With
+    `subjects`, also records each result's subjects.
+
+    If the search is big and has a dates= range, it's split into shards (see
+    query_planner) and SHARD_WORKERS of those are paginated at once, unless
+    `shard` is False. Items turned up by more than one shard are only
+    fetched once, thanks to the crawl journal.
+
+    Returns stats as harvest_texts keeps them, plus `of`, the number of hits
+    (which, for shards, counts items in overlapping shards more than once).
+    """
+    source = source or url
+    journal = get_journal()
+
+    if refresh:
+        journal.forget_query(url)
+
+    last_page, finished = journal.last_page(url)
+    if finished:
+        logging.info(f'{url} already fully harvested; skipping')
+        return defaultdict(int)
+
+    # If an earlier run got partway through this query unsplit, carry on the
+    # same way rather than starting over in shards.
+    if shard and not last_page:
+        shards = plan(url, http_adapter(), timeout=TIMEOUT)
+    else:
+        shards = [url]
+
+    if shards == [url]:
+        stats = _harvest_pages(url, source, concurrency, refresh, subjects)
+        flush_subjects()
+        return stats
+
+    stats = defaultdict(int)
+    with ThreadPoolExecutor(max_workers=SHARD_WORKERS) as executor:
+        futures = [
+            executor.submit(
+                in_context(_harvest_pages), shard, source, concurrency, refresh, subjects
+            )
+            for shard in shards
+        ]
+        for future in as_completed(futures):
+            for key, value in future.result().items():
+                stats[key] += value
+
+    # The shards are journaled individually; this just saves replanning. If
+    # anything failed, we need to replan so the shards get another go.
+    if not stats['failed']:
+        journal.complete_page(url, 0, finished=True)
+    flush_subjects()
+
+    return stats
+
+
 def slurp(**kwargs):
     '''
     Queries the Library of Congress for text documents matching an API query.
@@ -197,45 +669,32 @@ def slurp(**kwargs):
     When run with as_iterator=True, will yield the documents one by one (along
     with their LOC ID), as well as collecting summary statistics. When run with
     as_iterator=False (the default), will only collect summary statistics.
+
+    Fulltexts on each page of results are fetched concurrently; pass
+    `concurrency` to override CONCURRENCY for this call.
+
+    Progress is recorded in the crawl journal, so rerunning the same query
+    resumes where it stopped; pass `refresh=True` to start over and refetch
+    texts that are already on disk.
+
+    Big queries with a dates= range are split up and paginated in parallel
+    (see harvest_query); pass `shard=False` to walk them page by page.
     '''
     try:
         url = jsonify(kwargs['url'])
     except KeyError:
         url = LocUrl(**kwargs).construct()
-    stats = defaultdict(int)
 
-    progress = 0
-    for response in paginate_search(url):
-        results = filter_results(response)
-        logging.info(f'Processing {len(results)} usable results...')
-        for result in results:
-            record_subjects(result)
-            stats['processed'] += 1
-            if stats['processed'] % 100 == 0:
-                logging.info(f'...{stats["processed"]} processed')
-            try:
-                text = Fetcher(result).full_text()
-
-                if text:
-                    stats['found'] += 1
-                    stats['total_words'] += len(text.split(' '))
-                    # if kwargs.get('as_iterator'):
-                    #     yield (result["id"], text)
-                    with open(filenamify(result), 'w') as f:
-                        f.write(text)
+    stats = harvest_query(
+        url, concurrency=kwargs.get('concurrency'),
+        refresh=kwargs.get('refresh', False), subjects=True,
+        shard=kwargs.get('shard', True)
+    )
 
-                else:
-                    logging.warning(f'Could not locate text for {result["id"]}')
-                    stats['not_found'] += 1
-            except (AmbiguousText, ObjectNotOnline):
-                logging.exception(f'Could not get text for {url}')
-                stats['failed'] += 1
-            except Exception as err:
-                logging.exception(f'Failed on {result["id"]} with image_url {result["image_url"]}')
-                stats['failed'] += 1
+    if not stats:
+        return
 
-        check_for_disk_space()
-    logging.info(f'{stats["processed"]} processed, {stats["found"]} texts found with {stats["total_words"]} total words, {stats["not_found"]} not found, {stats["failed"]} failed, of {response["pagination"]["of"]} total')
+    logging.info(f'{stats["processed"]} processed, {stats["found"]} texts found with {stats["total_words"]} total words, {stats["not_found"]} not found, {stats["low_quality"]} too poorly OCRed to keep, {stats["failed"]} failed, {stats["skipped"]} already harvested ({stats["overlap"]} by other sources), of {stats["of"]} total')
 
 
 if __name__ == '__main__':
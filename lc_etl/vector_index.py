@@ -0,0 +1,378 @@
+# Nearest-neighbor indexes for word and document vectors.
+#
+# gensim's most_similar is brute force: every query is a dot product against
+# every vector in the model, which adds up fast with a vocabulary in the
+# millions (filter_nonwords does one per unfamiliar nonword). An index lets
+# us look at only part of the vocabulary per query, at the cost of
+# occasionally missing a neighbor.
+#
+# There are two kinds:
+# - 'exact': the same brute force search as gensim, but over vectors
+#   normalized once and saved, so that they can be mmapped and shared
+#   between processes.
+# - 'ivf' (an inverted file index): the vectors are clustered into `lists`
+#   groups with k-means. A query only looks at the vectors in the `probes`
+#   groups whose centers are most similar to it. More probes means better
+#   recall and slower queries; with probes == lists, it's exact.
+#
+# Indexes are saved next to the model (in gensim_outputs/, typically), as a
+# directory of .npy files that are loaded with mmap, and are rebuilt if the
+# model is newer than they are. `python -m lc_etl.vector_index` builds one
+# and reports its recall against exact search for various numbers of probes,
+# so that you can pick one.
+#
+# Usage:
+# index = vector_index.get_index(model_path, model.wv, kind='ivf')
+# index.most_similar('cautou')
+# or, to check recall:
+# python -m lc_etl.vector_index --model_path MODEL --probes 1,4,16,64
+
+from argparse import ArgumentParser
+import json
+import logging
+from math import sqrt
+from pathlib import Path
+import time
+
+import numpy as np
+
+SETTINGS_FILE = 'settings.json'
+DEFAULT_KIND = 'ivf'
+# Compare this many queries with exact search in recall().
+RECALL_SAMPLE = 1000
+# How many vectors to assign to lists at once when building an ivf index.
+BLOCK_SIZE = 1024
+
+# IVF parameters. About 4 * sqrt(vocabulary size) lists is the usual rule of
+# thumb, though lists shouldn't get too short.
+LISTS_PER_SQRT = 4
+MIN_LIST_SIZE = 8
+PROBES = 32
+KMEANS_ITERATIONS = 10
+# k-means is trained on a sample of this many vectors per list.
+TRAINING_PER_LIST = 64
+
+
+def _normalized(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, np.finfo(np.float32).tiny)
+
+
+def _top(similarities, topn):
+    """The indexes of the `topn` largest similarities, largest first."""
+    topn = min(topn, len(similarities))
+    if topn < 1:
+        return np.array([], dtype=np.int64)
+    best = np.argpartition(-similarities, topn - 1)[:topn]
+    return best[np.argsort(-similarities[best])]
+
+
+class VectorIndex(object):
+    """
+    A searchable set of vectors, labeled with `keys` (as in
+    KeyedVectors.index_to_key). Subclasses define search_vector.
+    """
+    kind = None
+
+    def __init__(self, vectors, keys):
+        super(VectorIndex, self).__init__()
+        if len(vectors) != len(keys):
+            raise ValueError(f'{len(vectors)} vectors but {len(keys)} keys')
+
+        self.vectors = vectors
+        self.keys = keys
+        self.key_to_index = {key: i for i, key in enumerate(keys)}
+
+
+    def search_vector(self, vector, topn):
+        """(indexes, similarities) of the `topn` vectors most similar to
+        `vector` (which must be normalized), most similar first."""
+        raise NotImplementedError
+
+
+    def most_similar(self, key, topn=10):
+        """Like KeyedVectors.most_similar(key, topn): a list of (key,
+        similarity), not including `key`. Raises KeyError for unknown
+        keys."""
+        index = self.key_to_index[key]
+        indexes, similarities = self.search_vector(self.vectors[index], topn + 1)
+        return [
+            (self.keys[i], float(similarity))
+            for i, similarity in zip(indexes, similarities) if i != index
+        ][:topn]
+
+
+    def _settings(self):
+        return {'kind': self.kind, 'count': len(self.keys)}
+
+
+    def save(self, path):
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        for name, array in self._arrays().items():
+            np.save(path / f'{name}.npy', array)
+
+        # Written last, so that its presence means the rest is there.
+        with open(path / SETTINGS_FILE, 'w') as f:
+            json.dump(self._settings(), f)
+
+
+    def _arrays(self):
+        return {'vectors': self.vectors}
+
+
+class ExactIndex(VectorIndex):
+    """Brute force, as gensim does it."""
+    kind = 'exact'
+
+    @classmethod
+    def build(cls, vectors, keys):
+        return cls(_normalized(vectors), keys)
+
+
+    @classmethod
+    def load(cls, path, keys, settings):
+        return cls(np.load(Path(path) / 'vectors.npy', mmap_mode='r'), keys)
+
+
+    def search_vector(self, vector, topn):
+        similarities = self.vectors @ vector
+        best = _top(similarities, topn)
+        return best, similarities[best]
+
+
+class IvfIndex(VectorIndex):
+    """An inverted file index: see the top of the file."""
+    kind = 'ivf'
+
+    def __init__(self, vectors, keys, centroids, order, offsets, probes=PROBES):
+        super(IvfIndex, self).__init__(vectors, keys)
+        self.centroids = centroids
+        # The vectors' indexes, grouped by list: list i is
+        # order[offsets[i]:offsets[i + 1]].
+        self.order = order
+        self.offsets = offsets
+        self.probes = probes
+
+
+    @property
+    def lists(self):
+        return len(self.centroids)
+
+
+    @staticmethod
+    def default_lists(count):
+        return max(1, min(round(LISTS_PER_SQRT * sqrt(count)), count // MIN_LIST_SIZE))
+
+
+    @classmethod
+    def build(cls, vectors, keys, lists=None, probes=PROBES, seed=0):
+        vectors = _normalized(vectors)
+        lists = min(lists or cls.default_lists(len(vectors)), len(vectors))
+        centroids = _kmeans(vectors, lists, seed)
+
+        assignments = _assign(vectors, centroids)
+        order = np.argsort(assignments, kind='stable')
+        offsets = np.searchsorted(assignments[order], np.arange(lists + 1))
+        return cls(vectors, keys, centroids, order, offsets, probes)
+
+
+    @classmethod
+    def load(cls, path, keys, settings):
+        path = Path(path)
+        arrays = {
+            name: np.load(path / f'{name}.npy', mmap_mode='r')
+            for name in ['vectors', 'centroids', 'order', 'offsets']
+        }
+        return cls(keys=keys, probes=settings['probes'], **arrays)
+
+
+    def _arrays(self):
+        return {
+            'vectors': self.vectors,
+            'centroids': self.centroids,
+            'order': self.order,
+            'offsets': self.offsets,
+        }
+
+
+    def _settings(self):
+        settings = super(IvfIndex, self)._settings()
+        settings.update(lists=self.lists, probes=self.probes)
+        return settings
+
+
+    def search_vector(self, vector, topn):
+        probed = _top(self.centroids @ vector, self.probes)
+        candidates = np.concatenate([
+            self.order[self.offsets[i]:self.offsets[i + 1]] for i in probed
+        ])
+        similarities = self.vectors[candidates] @ vector
+        best = _top(similarities, topn)
+        return candidates[best], similarities[best]
+
+
+def _assign(vectors, centroids):
+    """The index of each vector's most similar centroid."""
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), BLOCK_SIZE):
+        block = vectors[start:start + BLOCK_SIZE]
+        assignments[start:start + BLOCK_SIZE] = np.argmax(block @ centroids.T, axis=1)
+    return assignments
+
+
+def _kmeans(vectors, lists, seed):
+    """Spherical k-means (on a sample of `vectors`); returns the centroids."""
+    rng = np.random.default_rng(seed)
+    size = min(len(vectors), lists * TRAINING_PER_LIST)
+    sample = np.asarray(vectors[np.sort(rng.choice(len(vectors), size, replace=False))])
+    centroids = sample[rng.choice(size, lists, replace=False)].copy()
+
+    for _ in range(KMEANS_ITERATIONS):
+        assignments = _assign(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        # Lists that ended up empty keep their old centroid.
+        used = np.bincount(assignments, minlength=lists) > 0
+        centroids[used] = _normalized(sums[used])
+
+    return centroids
+
+
+BACKENDS = {
+    ExactIndex.kind: ExactIndex,
+    IvfIndex.kind: IvfIndex,
+}
+
+
+def index_path(model_path, which='wv', kind=DEFAULT_KIND):
+    """Where the index of a model's word (`wv`) or doc (`dv`) vectors goes."""
+    model_path = Path(model_path)
+    return model_path.with_name(f'{model_path.name}.{which}.{kind}-index')
+
+
+def load_index(path, keys):
+    path = Path(path)
+    with open(path / SETTINGS_FILE) as f:
+        settings = json.load(f)
+
+    if settings['count'] != len(keys):
+        raise ValueError(f'{path} has {settings["count"]} vectors, not {len(keys)}')
+
+    return BACKENDS[settings['kind']].load(path, keys, settings)
+
+
+def build_index(keyed_vectors, kind=DEFAULT_KIND, **params):
+    """Builds an index of `keyed_vectors` (a gensim KeyedVectors)."""
+    return BACKENDS[kind].build(keyed_vectors.vectors, keyed_vectors.index_to_key, **params)
+
+
+def get_index(model_path, keyed_vectors, which='wv', kind=DEFAULT_KIND, **params):
+    """
+    Loads the index of `keyed_vectors` (the model's `which` vectors) saved
+    next to the model, building and saving it first if there isn't one that's
+    at least as new as the model.
+    """
+    path = index_path(model_path, which, kind)
+    settings_file = path / SETTINGS_FILE
+
+    if not settings_file.is_file() or \
+            settings_file.stat().st_mtime < Path(model_path).stat().st_mtime:
+        logging.info(f'Building a {kind} index of {len(keyed_vectors)} vectors at {path}')
+        build_index(keyed_vectors, kind, **params).save(path)
+
+    index = load_index(path, keyed_vectors.index_to_key)
+    # Probes are a search setting, so they can change without a rebuild.
+    if params.get('probes') and isinstance(index, IvfIndex):
+        index.probes = params['probes']
+    return index
+
+
+class IndexedVectors(object):
+    """
+    A gensim KeyedVectors whose most_similar(key) goes through `index`.
+    Everything else (including other kinds of most_similar query) is passed
+    through to the KeyedVectors.
+    """
+
+    def __init__(self, keyed_vectors, index):
+        super(IndexedVectors, self).__init__()
+        self.keyed_vectors = keyed_vectors
+        self.index = index
+
+
+    def most_similar(self, positive=None, topn=10, **kwargs):
+        if isinstance(positive, str) and not kwargs:
+            return self.index.most_similar(positive, topn)
+
+        return self.keyed_vectors.most_similar(positive, topn=topn, **kwargs)
+
+
+    def __getattr__(self, name):
+        return getattr(self.keyed_vectors, name)
+
+
+    def __len__(self):
+        return len(self.keyed_vectors)
+
+
+    def __contains__(self, key):
+        return key in self.keyed_vectors
+
+
+def recall(index, topn=10, sample=RECALL_SAMPLE, seed=0):
+    """
+    Compares `index` with exact search for a sample of its own vectors.
+    Returns {'recall': the fraction of the true `topn` neighbors it found,
+    'index_qps'/'exact_qps': queries per second}.
+    """
+    exact = ExactIndex(index.vectors, index.keys)
+    rng = np.random.default_rng(seed)
+    queries = rng.choice(len(index.keys), min(sample, len(index.keys)), replace=False)
+
+    def neighbors(searcher):
+        start = time.perf_counter()
+        results = [set(searcher.search_vector(index.vectors[i], topn)[0]) for i in queries]
+        return results, len(queries) / max(time.perf_counter() - start, 1e-9)
+
+    expected, exact_qps = neighbors(exact)
+    found, index_qps = neighbors(index)
+    hits = sum(len(e & f) for e, f in zip(expected, found))
+
+    return {
+        'recall': hits / max(sum(len(e) for e in expected), 1),
+        'index_qps': index_qps,
+        'exact_qps': exact_qps,
+    }
+
+
+if __name__ == '__main__':
+    import gensim
+
+    parser = ArgumentParser()
+    parser.add_argument('--model_path', help='path to the Doc2Vec model', required=True)
+    parser.add_argument('--which', choices=['wv', 'dv'], default='wv',
+                        help='index word (wv) or document (dv) vectors')
+    parser.add_argument('--kind', choices=list(BACKENDS), default=DEFAULT_KIND)
+    parser.add_argument('--lists', type=int, help='ivf lists (default: about 4 * sqrt(vocabulary size))')
+    parser.add_argument('--probes', default=str(PROBES),
+                        help='comma-separated numbers of ivf probes to report recall for; the first is saved')
+    parser.add_argument('--topn', type=int, default=10)
+    options = parser.parse_args()
+
+    model = gensim.models.Doc2Vec.load(options.model_path)
+    keyed_vectors = getattr(model, options.which)
+    probes = [int(p) for p in options.probes.split(',')]
+    params = {'lists': options.lists, 'probes': probes[0]} if options.kind == 'ivf' else {}
+
+    index = get_index(options.model_path, keyed_vectors, options.which, options.kind, **params)
+    print(f'{options.kind} index of {len(index.keys)} vectors at '
+          f'{index_path(options.model_path, options.which, options.kind)}')
+
+    for probe in (probes if options.kind == 'ivf' else [None]):
+        if probe:
+            index.probes = probe
+        report = recall(index, options.topn)
+        print(f'probes={probe}: recall@{options.topn} {report["recall"]:.3f}, '
+              f'{report["index_qps"]:.0f} queries/s (exact: {report["exact_qps"]:.0f}/s)')
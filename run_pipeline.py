@@ -2,9 +2,9 @@ from pathlib import Path
 import shutil
 import subprocess
 
-from lc_etl import (dataset, fetch_metadata, filter_ocr, filter_nonwords,
-                    filter_newspaper_locations, train_doc2vec,
-                    assign_similarity_metadata, embedding, zip_csv)
+from lc_etl import (dataset, fetch_metadata, filter_chain, train_doc2vec,
+                    assign_similarity_metadata, embedding, zip_csv,
+                    corpus_store)
 from lc_etl.utilities import DEFAULT_NEWSPAPER_DIR, DEFAULT_RESULTS_DIR
 
 # Set defaults.
@@ -35,48 +35,32 @@ dataset.fetch(dataset_path=DATADEF, logfile=LOGFILE)
 shutil.copytree(Path(BASE_DIR) / DEFAULT_RESULTS_DIR, RESULTS_DIR)
 shutil.copytree(Path(BASE_DIR) / DEFAULT_NEWSPAPER_DIR, RESULTS_DIR)
 
-fetch_metadata.run(results_dir=RESULTS_DIR, newspaper_dir=FILTER_DIR, logfile=LOGFILE, overwrite=False)
-
-
-# ------------------------------ Filter bad OCR ------------------------------ #
-print("Filtering newspaper OCR...")
-filter_ocr.run(target_dir=FILTER_DIR, logfile=LOGFILE)
-
-print("Filtering result OCR...")
-filter_ocr.run(target_dir=RESULTS_DIR, logfile=LOGFILE)
-
-
-# ----------------------------- Remove frontmatter --------------------------- #
-print("Removing newspaper frontmatter...")
-subprocess.run(f'/lc_etl/bulk_scripts/remove_frontmatter.sh -p {FILTER_DIR}', shell=True)
-
-print("Removing archival notes gently...")
-subprocess.run(f'./lc_etl/bulk_scripts/remove_archival_notes_gentle.sh -p {RESULTS_DIR}', shell=True)
+# List both corpora once, so that later stages don't each have to walk them.
+corpus_store.build_manifest(FILTER_DIR)
+corpus_store.build_manifest(RESULTS_DIR)
 
-
-# ---------------------------- Remove attributions --------------------------- #
-print("Removing transcription attributions...")
-subprocess.run(f'./lc_etl/bulk_scripts/remove_transcription_attribution.sh -p {RESULTS_DIR}', shell=True)
-
-
-# ------------------------------ Filter nonwords ----------------------------- #
-print("Filtering newspaper nonwords...")
-filter_nonwords.run(target_dir=FILTER_DIR, model_path=BOOTSTRAP_MODEL_PATH, logfile=LOGFILE)
-
-print("Filtering result nonwords...")
-filter_nonwords.run(target_dir=RESULTS_DIR, model_path=BOOTSTRAP_MODEL_PATH, logfile=LOGFILE)
-
-
-# ----------------------------- Filter locations ----------------------------- #
-print("Filtering newspaper locations...")
-filter_newspaper_locations.run(target_dir=FILTER_DIR, metadata_dir=METADATA_DIR, logfile=LOGFILE)
+fetch_metadata.run(results_dir=RESULTS_DIR, newspaper_dir=FILTER_DIR, logfile=LOGFILE, overwrite=False)
 
 
-# ---------------------------- Remove empty files ---------------------------- #
-print("Removing empty files and directories...")
-subprocess.run(f'find {FILTER_DIR} -type f -empty -delete', shell=True)
+# ------------------------------ Clean the corpus ---------------------------- #
+# One pass per corpus runs, in this order: filter_ocr;
+# remove_archival_notes_gentle.sh and remove_transcription_attribution.sh
+# (non-newspapers only); filter_nonwords; filter_newspaper_locations
+# (newspapers only); and removing empty files. See filter_chain, including
+# for why remove_frontmatter.sh isn't on the list.
+print("Cleaning newspapers...")
+filter_chain.run(
+    FILTER_DIR, filter_chain.newspaper_steps(BOOTSTRAP_MODEL_PATH, METADATA_DIR),
+    logfile=LOGFILE
+)
+
+print("Cleaning results...")
+filter_chain.run(
+    RESULTS_DIR, filter_chain.results_steps(BOOTSTRAP_MODEL_PATH), logfile=LOGFILE
+)
+
+print("Removing empty directories...")
 subprocess.run(f'find {FILTER_DIR} -mindepth 1 -type d -empty -delete', shell=True)
-subprocess.run(f'find {RESULTS_DIR} -type f -empty -delete', shell=True)
 
 
 ----------------------------- Train neural net ----------------------------- #
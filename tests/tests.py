@@ -1,19 +1,36 @@
 import argparse
+import calendar
+from collections import defaultdict
 import csv
 from dataclasses import dataclass
+import io
 import json
+import logging
 from pathlib import Path
 import re
 import shutil
+import sqlite3
 import subprocess
+import tarfile
+import threading
+import time
+from types import SimpleNamespace
 import unittest
 
 import gensim
+import numpy as np
+import requests
 import responses
 
-from lc_etl import (assign_similarity_metadata, fetch_metadata,
-                    filter_collections, filter_newspaper_locations,
-                    filter_nonwords, filter_ocr, zip_csv)
+from lc_etl import (assign_similarity_metadata, batch_resolver, chronam_catalog,
+                    corpus_store, crawl_journal, dataset, deletion_index,
+                    fetch_metadata,
+                    filter_chain, filter_collections,
+                    filter_newspaper_locations, filter_nonwords,
+                    filter_nonwords_batch, filter_nonwords_parallel,
+                    filter_ocr, lc_items, newspapers, nonword_cache,
+                    query_planner, response_cache, throttle, utilities,
+                    vector_index, zip_csv)
 
 
 class TestMetadataFetching(unittest.TestCase):
@@ -30,6 +47,16 @@ class TestMetadataFetching(unittest.TestCase):
         self.addCleanup(self.responses.stop)
         self.addCleanup(self.responses.reset)
 
+        # Don't let mocked responses leak into (or out of) the on-disk cache.
+        cache_patch = unittest.mock.patch('lc_etl.response_cache.ENABLED', False)
+        cache_patch.start()
+        self.addCleanup(cache_patch.stop)
+
+        # These tests count item calls, so don't batch them via search.
+        batch_patch = unittest.mock.patch('lc_etl.fetch_metadata.BATCH_LOOKUPS', False)
+        batch_patch.start()
+        self.addCleanup(batch_patch.stop)
+
 
     def tearDown(self):
         from time import sleep
@@ -208,6 +235,207 @@ class TestMetadataFetching(unittest.TestCase):
         )
 
 
+class TestConcurrentMetadataFetching(unittest.TestCase):
+    def setUp(self):
+        self.test_directory = 'tests/data/temp'
+        Path(self.test_directory).mkdir(parents=True)
+
+        for patch in [
+            unittest.mock.patch('lc_etl.response_cache.ENABLED', False),
+            unittest.mock.patch('lc_etl.fetch_metadata.OUTPUT_DIR', f'{self.test_directory}/metadata'),
+            unittest.mock.patch('lc_etl.fetch_metadata.FAILED_CALLS', f'{self.test_directory}/failed_calls.txt'),
+            unittest.mock.patch.object(fetch_metadata.rate_limiter, 'rate', None),
+            unittest.mock.patch('lc_etl.fetch_metadata.BATCH_LOOKUPS', False),
+            unittest.mock.patch('lc_etl.utilities.RECORDS_DIR', f'{self.test_directory}/search_records'),
+            unittest.mock.patch('lc_etl.fetch_metadata._collection_urls_fetched', True),
+            unittest.mock.patch('lc_etl.fetch_metadata._collection_urls', {
+                'abraham lincoln papers at the library of congress':
+                    'https://www.loc.gov/collections/abraham-lincoln-papers/?fo=json'
+            }),
+        ]:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.test_directory)
+
+
+    def test_workers_write_outputs_and_failures(self):
+        with open('tests/mal3745600.json', 'r') as f:
+            item_json = json.load(f)
+
+        good = [f'good{i}' for i in range(20)]
+        bad = [f'bad{i}' for i in range(5)]
+
+        with responses.RequestsMock() as mock_responses:
+            for identifier in good:
+                mock_responses.add(responses.GET, fetch_metadata.ITEM_URL.format(identifier=identifier), json=item_json)
+            for identifier in bad:
+                mock_responses.add(responses.GET, fetch_metadata.ITEM_URL.format(identifier=identifier), status=404, json={})
+
+            fetch_metadata._inner_fetch(good + bad, overwrite=False, workers=4)
+
+        written = sorted(x.name for x in Path(self.test_directory, 'metadata').iterdir())
+        self.assertEqual(written, sorted(good))
+
+        with open(Path(self.test_directory) / 'failed_calls.txt') as f:
+            failed = f.read().split()
+        # Each failure is recorded when the call fails, and again when we give
+        # up on the identifier.
+        self.assertEqual(sorted(set(failed)), sorted(bad))
+        self.assertEqual(len(failed), 2 * len(bad))
+
+
+    def test_cache_only_misses_are_recorded(self):
+        with unittest.mock.patch('lc_etl.response_cache.ENABLED', True), \
+                unittest.mock.patch('lc_etl.response_cache.CACHE_ONLY', True), \
+                unittest.mock.patch('lc_etl.response_cache.CACHE_PATH', f'{self.test_directory}/cache.db'), \
+                responses.RequestsMock() as mock_responses:
+            fetch_metadata._inner_fetch(['uncached'], overwrite=False)
+            self.assertEqual(len(mock_responses.calls), 0)
+
+        assert not Path(self.test_directory, 'metadata', 'uncached').exists()
+        with open(Path(self.test_directory) / 'failed_calls.txt') as f:
+            self.assertEqual(set(f.read().split()), {'uncached'})
+
+
+    def test_search_record_saves_item_call(self):
+        with open('tests/mal3745600.json', 'r') as f:
+            item_json = json.load(f)['item']
+
+        # A search result with every field we read, including partof, which
+        # only has collection names.
+        search_result = {
+            key: item_json[key] for key in
+            ['title', 'date', 'url', 'image_url', 'subject_headings']
+        }
+        search_result['description'] = ['a letter']
+        search_result['location'] = ['washington, d.c.']
+        search_result['subject'] = ['civil war']
+        search_result['partof'] = ['abraham lincoln papers at the library of congress']
+        utilities.save_record(dict(search_result, id='http://www.loc.gov/item/searched/'))
+
+        with responses.RequestsMock() as mock_responses:
+            fetch_metadata._inner_fetch(['searched'], overwrite=False)
+            self.assertEqual(len(mock_responses.calls), 0)
+
+        with open(Path(self.test_directory) / 'metadata' / 'searched') as f:
+            searched = json.load(f)['searched']
+        self.assertEqual(searched['collections'], ['abraham lincoln papers at the library of congress'])
+
+
+    def test_metadata_from_saved_record(self):
+        with open('tests/mal3745600.json', 'r') as f:
+            item_json = json.load(f)['item']
+
+        records_dir = f'{self.test_directory}/search_records'
+        Path(records_dir).mkdir()
+        # A record with everything we need, as lc_items would save it...
+        with open(f'{records_dir}/complete.json', 'w') as f:
+            json.dump(item_json, f)
+        # ...and a search result, which lacks location.
+        search_result = {
+            key: item_json[key] for key in
+            ['title', 'location', 'description', 'date', 'url', 'image_url']
+            if key in item_json
+        }
+        search_result['subject'] = ['civil war']
+        search_result['subject_headings'] = item_json['subject_headings']
+        search_result['partof'] = [
+            'abraham lincoln papers at the library of congress', 'manuscript division'
+        ]
+        with open(f'{records_dir}/partial.json', 'w') as f:
+            json.dump(search_result, f)
+
+        with responses.RequestsMock() as mock_responses:
+            mock_responses.add(responses.GET, fetch_metadata.ITEM_URL.format(identifier='partial'), json={'item': item_json})
+            fetch_metadata._inner_fetch(['complete', 'partial'], overwrite=False)
+            self.assertEqual(len(mock_responses.calls), 1)
+            self.assertIn('partial', mock_responses.calls[0].request.url)
+
+        with open(Path(self.test_directory) / 'metadata' / 'complete') as f:
+            complete = json.load(f)['complete']
+        self.assertEqual(complete['title'], item_json['title'])
+        self.assertEqual(complete['date'], '1864-10-21')
+        self.assertTrue(complete['collections'])
+
+        with open(Path(self.test_directory) / 'metadata' / 'partial') as f:
+            partial = json.load(f)['partial']
+        self.assertEqual(partial['collections'], complete['collections'])
+        self.assertEqual(
+            partial['subjects'],
+            [{'civil war': 'https://www.loc.gov/search/?fa=subject:civil+war&fo=json'}]
+        )
+
+
+    def test_batch_lookups(self):
+        with open('tests/mal3745600.json', 'r') as f:
+            item_json = json.load(f)['item']
+
+        def search_result(identifier):
+            return {
+                'id': f'http://www.loc.gov/item/{identifier}/',
+                'title': identifier, 'location': [], 'description': [],
+                'date': '1864', 'url': f'https://www.loc.gov/item/{identifier}/',
+                'image_url': ['https://tile.loc.gov/image.jpg'], 'subject': [], 'subject_headings': [],
+                'partof': ['abraham lincoln papers at the library of congress'],
+            }
+
+        identifiers = ['one', 'two', 'three']
+        with unittest.mock.patch('lc_etl.fetch_metadata.BATCH_LOOKUPS', True), \
+                responses.RequestsMock() as mock_responses:
+            # The search finds two of our items, plus one we didn't ask for.
+            mock_responses.add(
+                responses.GET, re.compile(r'https://www\.loc\.gov/search/.*'),
+                json={'results': [search_result(x) for x in ['one', 'two', 'other']]}
+            )
+            mock_responses.add(responses.GET, fetch_metadata.ITEM_URL.format(identifier='three'), json={'item': item_json})
+
+            fetch_metadata._inner_fetch(identifiers, overwrite=False, workers=2)
+            self.assertEqual(len(mock_responses.calls), 2)
+
+        written = sorted(x.name for x in Path(self.test_directory, 'metadata').iterdir())
+        self.assertEqual(written, sorted(identifiers))
+        with open(Path(self.test_directory) / 'metadata' / 'two') as f:
+            two = json.load(f)['two']
+        self.assertEqual(two['title'], 'two')
+        self.assertEqual(two['collections'], ['abraham lincoln papers at the library of congress'])
+
+
+    def test_grouped_fetch_requests_each_lccn_once(self):
+        with open('tests/mal3745600.json', 'r') as f:
+            item_json = json.load(f)
+
+        pages = [
+            f'{self.test_directory}/newspapers/sn85025202/1865/01/{day:02}/ed-1/seq-{seq}/ocr.txt'
+            for day in (14, 21) for seq in (1, 2)
+        ]
+        # One of these is already done, so only the other three get written.
+        done = Path(fetch_metadata.OUTPUT_DIR) / 'sn85025202/1865/01/14/ed-1/seq-1/'
+        done.parent.mkdir(parents=True)
+        done.write_text('{}')
+
+        with responses.RequestsMock() as mock_responses:
+            mock_responses.add(responses.GET, fetch_metadata.ITEM_URL.format(identifier='sn85025202'), json=item_json)
+            fetch_metadata._fetch_grouped(pages, overwrite=False, workers=2)
+            self.assertEqual(len(mock_responses.calls), 1)
+
+            # Now everything is on disk, so we shouldn't make any calls.
+            fetch_metadata._fetch_grouped(pages, overwrite=False, workers=2)
+            self.assertEqual(len(mock_responses.calls), 1)
+
+        self.assertEqual(done.read_text(), '{}')
+        with open(Path(fetch_metadata.OUTPUT_DIR) / 'sn85025202/1865/01/21/ed-1/seq-2/') as f:
+            metadata = json.load(f)['sn85025202']
+        self.assertEqual(metadata['date'], '1865-01-21')
+        self.assertEqual(metadata['title'], item_json['item']['title'])
+        self.assertEqual(
+            metadata['url'],
+            'https://chroniclingamerica.loc.gov/lccn/sn85025202/1865-01-21/ed-1/seq-2/'
+        )
+
+
 class TestZipCSV(unittest.TestCase):
     def setUp(self):
         self.responses = responses.RequestsMock(
@@ -222,6 +450,16 @@ class TestZipCSV(unittest.TestCase):
         self.addCleanup(self.responses.stop)
         self.addCleanup(self.responses.reset)
 
+        # Don't let mocked responses leak into (or out of) the on-disk cache.
+        cache_patch = unittest.mock.patch('lc_etl.response_cache.ENABLED', False)
+        cache_patch.start()
+        self.addCleanup(cache_patch.stop)
+
+        # These tests count item calls, so don't batch them via search.
+        batch_patch = unittest.mock.patch('lc_etl.fetch_metadata.BATCH_LOOKUPS', False)
+        batch_patch.start()
+        self.addCleanup(batch_patch.stop)
+
         self.maxDiff = 6000
 
 
@@ -349,6 +587,20 @@ class TestFilters(unittest.TestCase):
         assert content.strip() == "slaves is a word that appears in the federal writers project corpus is not"
 
 
+    def test_nonwords_filtered_in_parallel(self):
+        shutil.copytree('tests/data/nonwords', self.test_directory)
+        for i in range(3):
+            shutil.copy(Path(self.test_directory) / 'testfile', Path(self.test_directory) / f'copy{i}')
+
+        filter_nonwords_parallel.run(self.test_directory, 'tests/data/gensim_outputs/test_model', processes=2)
+
+        for path in Path(self.test_directory).iterdir():
+            with open(path) as f:
+                content = f.read()
+
+            assert content.strip() == "slaves is a word that appears in the federal writers project corpus is not"
+
+
     def test_newspaper_locations(self):
         shutil.copytree('tests/data/locations', self.test_directory)
 
@@ -360,6 +612,43 @@ class TestFilters(unittest.TestCase):
         assert content.strip() == "once upon a time there was a congressman who had a peach from ireland"
 
 
+    def test_filter_chain(self):
+        shutil.copytree('tests/data/locations', self.test_directory)
+        corpus = corpus_store.DirectoryCorpus(self.test_directory)
+        page = 'sn78000873/1869/12/30/ed-1/seq-1/ocr.txt'
+        corpus.write(page, 'THE REPUBLICAN JOURNAL\n' + corpus.read(page))
+        corpus.write('sn78000873/1869/12/31/ed-1/seq-1/ocr.txt', 'tbe fieedmcn burcau')
+        corpus.write('sn78000873/1870/01/01/ed-1/seq-1/ocr.txt', 'masthead only')
+        corpus.write('mss11049004', 'a letter\nthe letter\nTranscribed and reviewed by contributors participating in the By The People project at crowd.loc.gov\n')
+        dictionary = set('once upon time there republican congressman peach journal from belfast ireland masthead only'.split())
+
+        steps = [
+            filter_chain.FilterOcr(),
+            filter_chain.RemoveFrontmatter(lines=1),
+            filter_chain.RemoveTranscriptionAttribution(),
+            filter_chain.RemoveLocations('tests/data/metadata'),
+            filter_chain.DropEmpty(),
+        ]
+        with unittest.mock.patch('lc_etl.filter_ocr._dictionary', dictionary):
+            stats = filter_chain.filter_corpus(corpus, steps)
+
+        self.assertEqual(corpus.read(page).strip(), "once upon a time there was a congressman who had a peach from ireland")
+        self.assertEqual(corpus.read('mss11049004'), 'the letter\n')
+        self.assertEqual(stats['dropped by FilterOcr'], 1)
+        self.assertEqual(stats['dropped by DropEmpty'], 1)
+        self.assertEqual(sorted(corpus.ids()), ['mss11049004', page])
+
+
+    def test_newspaper_chain_keeps_frontmatter_by_default(self):
+        Path(self.test_directory).mkdir(parents=True)
+        with unittest.mock.patch('lc_etl.filter_chain.ReplaceNonwords'):
+            default = filter_chain.newspaper_steps('model', 'metadata')
+            opted_in = filter_chain.newspaper_steps('model', 'metadata', frontmatter=True)
+
+        self.assertFalse(any(isinstance(x, filter_chain.RemoveFrontmatter) for x in default))
+        self.assertIsInstance(opted_in[1], filter_chain.RemoveFrontmatter)
+
+
     def test_collections_newspapers(self):
         shutil.copytree('tests/data/locations', self.test_directory)
 
@@ -393,6 +682,152 @@ class TestFilters(unittest.TestCase):
         assert len(os.listdir(self.test_directory)) == 1
 
 
+class TestNonwordResolution(unittest.TestCase):
+    def test_batch_matches_most_similar(self):
+        model = gensim.models.Doc2Vec.load('tests/data/gensim_outputs/test_model')
+        keys = model.wv.index_to_key
+        # Stand in for spaCy, which knows every other word.
+        nlp = SimpleNamespace(vocab=SimpleNamespace(strings=set(keys[::2])))
+        nonwords = [key for key in keys if key not in nlp.vocab.strings]
+
+        expected = {
+            word: filter_nonwords.derive_from_model(model, nlp, word)
+            for word in nonwords
+        }
+        expected = {word: alt for word, alt in expected.items() if alt}
+
+        assert expected
+        self.assertEqual(
+            filter_nonwords_batch.resolve_nonwords(model, nlp, nonwords, block_size=4),
+            expected
+        )
+
+
+    def test_candidate_filter_matches_most_similar(self):
+        model = gensim.models.Doc2Vec.load('tests/data/gensim_outputs/test_model')
+        keys = model.wv.index_to_key
+
+        for known in [keys[::2], keys[1::2]]:
+            nlp = SimpleNamespace(vocab=SimpleNamespace(strings=set(known)))
+            candidate_filter = filter_nonwords.CandidateFilter(model, nlp)
+            nonwords = [key for key in keys if key not in known] + ['skives', 'fdahlj']
+
+            for word in nonwords:
+                self.assertEqual(
+                    candidate_filter(word),
+                    filter_nonwords.derive_from_model(model, nlp, word),
+                    word
+                )
+            assert candidate_filter.stats['prefiltered']
+
+
+    def test_deletion_index(self):
+        index = deletion_index.DeletionIndex(['slaves', 'canton', 'suffrage', 'can'])
+
+        self.assertEqual(index.within('skives', 2), {0})
+        self.assertEqual(index.within('cautou', 2), {1})
+        self.assertEqual(index.within('cautou', 1), set())
+        self.assertEqual(index.containing('frage'), {2})
+        self.assertEqual(index.containing('an'), {1, 3})
+
+
+class TestVectorIndex(unittest.TestCase):
+    def setUp(self):
+        self.test_directory = Path('tests/data/temp')
+        self.test_directory.mkdir(parents=True)
+        self.model_path = self.test_directory / 'test_model'
+        shutil.copy('tests/data/gensim_outputs/test_model', self.model_path)
+        self.model = gensim.models.Doc2Vec.load(str(self.model_path))
+
+
+    def tearDown(self):
+        shutil.rmtree(self.test_directory)
+
+
+    def test_exact_matches_gensim(self):
+        index = vector_index.get_index(self.model_path, self.model.wv, kind='exact')
+
+        assert isinstance(index.vectors, np.memmap)
+        assert (self.test_directory / 'test_model.wv.exact-index').is_dir()
+        for word in ['slave', 'project', 'washington']:
+            self.assertEqual(
+                [key for key, _ in index.most_similar(word)],
+                [key for key, _ in self.model.wv.most_similar(word)]
+            )
+
+
+    def test_ivf(self):
+        index = vector_index.get_index(
+            self.model_path, self.model.wv, kind='ivf', lists=4, probes=4
+        )
+        self.assertEqual(index.lists, 4)
+        self.assertEqual(vector_index.recall(index)['recall'], 1)
+
+        index.probes = 1
+        assert 0 < vector_index.recall(index)['recall'] <= 1
+
+        vectors = vector_index.IndexedVectors(self.model.wv, index)
+        assert vectors.most_similar('slave', topn=3) == index.most_similar('slave', 3)
+        assert 'slave' in vectors
+        self.assertEqual(len(vectors), len(self.model.wv))
+
+
+class TestNonwordCache(unittest.TestCase):
+    def setUp(self):
+        self.test_directory = Path('tests/data/temp')
+        self.test_directory.mkdir(parents=True)
+        self.path = self.test_directory / 'cache.db'
+
+
+    def tearDown(self):
+        shutil.rmtree(self.test_directory)
+
+
+    def test_round_trip(self):
+        derived = []
+
+        def derive(word):
+            derived.append(word)
+            return 'slaves' if word == 'skives' else None
+
+        cache = nonword_cache.NonwordCache(self.path)
+        for _ in range(3):
+            assert cache.lookup('skives', derive) == 'slaves'
+            assert cache.lookup('fdahlj', derive) is None
+            assert cache.lookup('don"t\'', derive) is None
+        cache.close()
+
+        # Each word only went to the model once, including the ones without
+        # a replacement.
+        self.assertEqual(derived, ['skives', 'fdahlj', 'don"t\''])
+        self.assertEqual(cache.stats['misses'], 3)
+        self.assertEqual(cache.stats['memory hits'], 6)
+
+        cache = nonword_cache.NonwordCache(self.path, memory_size=1)
+        assert len(cache.memory) == 1
+        assert cache.get('skives') == 'slaves'
+        assert cache.get('fdahlj') == nonword_cache.NO_REPLACEMENT
+        assert cache.get('slaves') is None
+        assert len(cache.memory) == 1
+        cache.close()
+
+
+    def test_upgrades_old_caches(self):
+        db = sqlite3.connect(self.path)
+        db.execute('CREATE TABLE words (nonword, good_word)')
+        db.executemany('INSERT INTO words VALUES (?, ?)', [
+            ('skives', 'slaves'), ('skives', 'slaves'), ('cautou', 'canton')
+        ])
+        db.commit()
+        db.close()
+
+        cache = nonword_cache.NonwordCache(self.path)
+        assert cache.get('skives') == 'slaves'
+        assert cache.get('cautou') == 'canton'
+        self.assertEqual(cache.db.execute('SELECT COUNT(*) FROM words').fetchone()[0], 2)
+        cache.close()
+
+
 class TestBulkScripts(unittest.TestCase):
     def setUp(self):
         self.test_directory = 'tests/data/temp'
@@ -522,5 +957,896 @@ class TestSimilarityMetadata(unittest.TestCase):
         assert isinstance(item_metadata['keyword_scores']['federal'], int)
 
 
+class TestHarvesting(unittest.TestCase):
+    def setUp(self):
+        self.test_directory = 'tests/data/temp'
+        Path(self.test_directory, 'results').mkdir(parents=True)
+        journal_patch = unittest.mock.patch(
+            'lc_etl.crawl_journal.JOURNAL_PATH', f'{self.test_directory}/journal.db'
+        )
+        journal_patch.start()
+        self.addCleanup(journal_patch.stop)
+        self.addCleanup(crawl_journal.close_journals)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.test_directory)
+
+
+    def test_harvest_texts(self):
+        def fake_full_text(fetcher):
+            if 'missing' in fetcher.result['id']:
+                return None
+            if 'broken' in fetcher.result['id']:
+                raise ValueError
+            return f'text of {fetcher.result["id"]}'
+
+        results = [
+            {'id': 'http://www.loc.gov/item/one/'},
+            {'id': 'http://www.loc.gov/item/two/'},
+            {'id': 'http://www.loc.gov/item/missing/'},
+            {'id': 'http://www.loc.gov/item/broken/'},
+        ]
+
+        with unittest.mock.patch('lc_etl.utilities.BASE_DIR', self.test_directory), \
+                unittest.mock.patch('lc_etl.utilities.Fetcher.full_text', fake_full_text):
+            stats = utilities.harvest_texts(results, defaultdict(int), concurrency=4)
+
+        self.assertEqual(stats['processed'], 4)
+        self.assertEqual(stats['found'], 2)
+        self.assertEqual(stats['not_found'], 1)
+        self.assertEqual(stats['failed'], 1)
+
+        with open(Path(self.test_directory) / 'results' / 'two') as f:
+            assert f.read() == 'text of http://www.loc.gov/item/two/'
+        assert not (Path(self.test_directory) / 'results' / 'missing').is_file()
+
+
+    def test_harvest_saves_records(self):
+        results = [
+            {'id': 'http://www.loc.gov/item/one/', 'title': 'One'},
+            {'id': 'http://www.loc.gov/item/missing/', 'title': 'Missing'},
+        ]
+        Path(self.test_directory, 'results', 'old').write_text('harvested last time')
+        old = {'id': 'http://www.loc.gov/item/old/', 'title': 'Old'}
+
+        with unittest.mock.patch('lc_etl.utilities.BASE_DIR', self.test_directory), \
+                unittest.mock.patch('lc_etl.utilities.RECORDS_DIR', f'{self.test_directory}/search_records'), \
+                unittest.mock.patch('lc_etl.utilities.SAVE_RECORDS', True), \
+                unittest.mock.patch('lc_etl.utilities.Fetcher.full_text',
+                                    lambda fetcher: None if 'missing' in fetcher.result['id'] else 'text'):
+            utilities.harvest_texts(results + [old], defaultdict(int))
+
+        saved = sorted(x.name for x in Path(self.test_directory, 'search_records').iterdir())
+        self.assertEqual(saved, ['old.json', 'one.json'])
+        with open(Path(self.test_directory) / 'search_records' / 'one.json') as f:
+            self.assertEqual(json.load(f), results[0])
+
+
+    def test_harvest_skips_completed_items(self):
+        results = [{'id': 'http://www.loc.gov/item/one/'}]
+        fake_full_text = unittest.mock.Mock(return_value='some text')
+
+        with unittest.mock.patch('lc_etl.utilities.BASE_DIR', self.test_directory), \
+                unittest.mock.patch('lc_etl.utilities.Fetcher.full_text', fake_full_text):
+            utilities.harvest_texts(results, defaultdict(int))
+            stats = utilities.harvest_texts(results, defaultdict(int))
+            self.assertEqual(stats['skipped'], 1)
+            self.assertEqual(fake_full_text.call_count, 1)
+
+            utilities.harvest_texts(results, defaultdict(int), refresh=True)
+            self.assertEqual(fake_full_text.call_count, 2)
+
+
+    def test_harvest_skips_items_from_other_sources(self):
+        fake_full_text = unittest.mock.Mock(return_value='some text')
+        first = [{'id': f'http://www.loc.gov/item/{x}/'} for x in ['a', 'b']]
+        second = [{'id': f'http://www.loc.gov/item/{x}/'} for x in ['b', 'c', 'c']]
+
+        with unittest.mock.patch('lc_etl.utilities.BASE_DIR', self.test_directory), \
+                unittest.mock.patch('lc_etl.utilities.Fetcher.full_text', fake_full_text):
+            utilities.harvest_texts(first, defaultdict(int), source='first query')
+            stats = utilities.harvest_texts(second, defaultdict(int), source='second query')
+
+        # b was already harvested, and c is only fetched once.
+        self.assertEqual(fake_full_text.call_count, 3)
+        self.assertEqual(stats['overlap'], 1)
+        self.assertEqual(stats['skipped'], 2)
+        self.assertEqual(
+            crawl_journal.get_journal().overlaps,
+            {('second query', 'first query'): 1}
+        )
+
+
+    def test_journaled_search_resumes(self):
+        url = 'https://www.loc.gov/search/?q=reconstruction&fo=json'
+        journal = crawl_journal.get_journal()
+        journal.complete_page(url, 2)
+
+        with unittest.mock.patch('lc_etl.utilities.paginate_search') as paginate:
+            paginate.return_value = iter([{'pagination': {'next': None}}])
+            pages = [page for page, _ in utilities.journaled_search(url)]
+
+        paginate.assert_called_once_with(url, start_page=3)
+        self.assertEqual(pages, [3])
+
+        journal.complete_page(url, 3, finished=True)
+        self.assertEqual(list(utilities.journaled_search(url)), [])
+
+
+    def test_harvest_query_shards(self):
+        url = 'https://www.loc.gov/books/?dates=1865/1866&fo=json'
+        shards = [query_planner.with_dates(url, '1865/1865'), query_planner.with_dates(url, '1866/1866')]
+
+        def fake_paginate(shard_url, start_page=1):
+            # Item b is dated to both years, so both shards find it.
+            ids = ['a', 'b'] if '1865/1865' in shard_url else ['b', 'c']
+            yield {
+                'results': [{'id': f'http://www.loc.gov/item/{x}/'} for x in ids],
+                'pagination': {'next': None, 'of': 2},
+            }
+
+        fake_full_text = unittest.mock.Mock(return_value='some text')
+        with unittest.mock.patch('lc_etl.utilities.BASE_DIR', self.test_directory), \
+                unittest.mock.patch('lc_etl.utilities.plan', return_value=shards), \
+                unittest.mock.patch('lc_etl.utilities.paginate_search', fake_paginate), \
+                unittest.mock.patch('lc_etl.utilities.filter_results', lambda response: response['results']), \
+                unittest.mock.patch('lc_etl.utilities.Fetcher.full_text', fake_full_text):
+            stats = utilities.harvest_query(url)
+
+        self.assertEqual(fake_full_text.call_count, 3)
+        self.assertEqual(stats['found'], 3)
+        self.assertEqual(stats['of'], 4)
+        self.assertEqual(crawl_journal.get_journal().last_page(url), (0, True))
+        for shard in shards:
+            self.assertEqual(crawl_journal.get_journal().last_page(shard), (1, True))
+
+
+    def test_failed_items_are_retried_after_restart(self):
+        url = 'https://www.loc.gov/search/?q=reconstruction&fo=json'
+        pages = [
+            {'results': [{'id': 'http://www.loc.gov/item/flaky/'}],
+             'pagination': {'next': 'page 2', 'of': 2}},
+            {'results': [{'id': 'http://www.loc.gov/item/fine/'}],
+             'pagination': {'next': None, 'of': 2}},
+        ]
+
+        def fake_paginate(search_url, start_page=1):
+            yield from pages[start_page - 1:]
+
+        def flaky_full_text(fetcher):
+            if 'flaky' in fetcher.result['id']:
+                raise ValueError
+            return 'some text'
+
+        fake_full_text = unittest.mock.Mock(return_value='some text')
+        with unittest.mock.patch('lc_etl.utilities.BASE_DIR', self.test_directory), \
+                unittest.mock.patch('lc_etl.utilities.paginate_search', fake_paginate), \
+                unittest.mock.patch('lc_etl.utilities.filter_results', lambda response: response['results']):
+            with unittest.mock.patch('lc_etl.utilities.Fetcher.full_text', flaky_full_text):
+                stats = utilities.harvest_query(url, shard=False)
+            self.assertEqual(stats['failed'], 1)
+            self.assertEqual(crawl_journal.get_journal().last_page(url), (0, False))
+
+            with unittest.mock.patch('lc_etl.utilities.Fetcher.full_text', fake_full_text):
+                stats = utilities.harvest_query(url, shard=False)
+
+        # Only the item that failed is fetched again.
+        self.assertEqual(fake_full_text.call_count, 1)
+        self.assertEqual(stats['found'], 1)
+        self.assertEqual(stats['skipped'], 1)
+        self.assertEqual(crawl_journal.get_journal().last_page(url), (2, True))
+
+
+    def test_items_use_batch_lookups_only_when_asked(self):
+        items = ['https://www.loc.gov/item/one/', 'https://www.loc.gov/item/two/']
+
+        with unittest.mock.patch('lc_etl.response_cache.ENABLED', False), \
+                unittest.mock.patch('lc_etl.lc_items.record_subjects'), \
+                unittest.mock.patch('lc_etl.lc_items.flush_subjects'), \
+                unittest.mock.patch('lc_etl.lc_items.harvest_texts', return_value=defaultdict(int)), \
+                unittest.mock.patch('lc_etl.lc_items.batch_resolver.resolve', return_value={}) as resolve, \
+                responses.RequestsMock() as mock_responses:
+            for item in items:
+                mock_responses.add(responses.GET, f'{item}?fo=json', json={'item': {'id': item}})
+
+            lc_items.slurp_items(items)
+            resolve.assert_not_called()
+
+            lc_items.slurp_items(items, batch=True)
+            resolve.assert_called_once()
+
+
+    def test_subjects_are_tallied(self):
+        subjects_file = f'{self.test_directory}/subjects.txt'
+        # What the file used to look like: one line per subject per result.
+        with open(subjects_file, 'w') as f:
+            f.write('civil war\nslavery\ncivil war\n')
+
+        with unittest.mock.patch('lc_etl.utilities.SUBJECTS_FILE', subjects_file):
+            utilities.record_subjects({'subject': ['civil war', 'reconstruction']})
+            utilities.record_subjects({'subject': ['reconstruction']})
+            utilities.record_subjects({})
+            self.assertEqual(
+                utilities.most_common_subjects(2),
+                [('civil war', 3), ('reconstruction', 2)]
+            )
+            utilities.flush_subjects()
+            utilities.flush_subjects()
+            self.assertEqual(utilities.most_common_subjects()[-1], ('slavery', 1))
+
+        with open(subjects_file) as f:
+            self.assertEqual(f.read(), 'civil war\t3\nreconstruction\t2\nslavery\t1\n')
+
+
+    def test_quality_gate(self):
+        good = 'the freedmen bureau opened schools across the south'
+        results = [
+            {'id': 'http://www.loc.gov/item/good/'},
+            {'id': 'http://www.loc.gov/item/bad/'},
+        ]
+        texts = {'good': good, 'bad': 'tbe fieedmcn burcau opcncd schuols'}
+        dictionary = set(good.split())
+
+        with unittest.mock.patch('lc_etl.utilities.BASE_DIR', self.test_directory), \
+                unittest.mock.patch('lc_etl.utilities.QUALITY_GATE', True), \
+                unittest.mock.patch('lc_etl.filter_ocr._dictionary', dictionary), \
+                unittest.mock.patch('lc_etl.utilities.Fetcher.full_text',
+                                    lambda fetcher: texts[fetcher.result['id'].split('/')[-2]]):
+            stats = utilities.harvest_texts(results, defaultdict(int))
+            again = utilities.harvest_texts(results, defaultdict(int))
+
+        self.assertEqual(stats['found'], 1)
+        self.assertEqual(stats['low_quality'], 1)
+        self.assertEqual(again['skipped'], 2)
+        assert (Path(self.test_directory) / 'results' / 'good').is_file()
+        assert not (Path(self.test_directory) / 'results' / 'bad').is_file()
+
+
+    def test_sessions_are_shared(self):
+        assert utilities.http_adapter() is utilities.http_adapter()
+        assert utilities.http_adapter('chronam') is not utilities.http_adapter()
+
+
+class TestDataset(unittest.TestCase):
+    def setUp(self):
+        self.test_directory = 'tests/data/temp'
+        Path(self.test_directory).mkdir(parents=True)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.test_directory)
+
+
+    def test_source_groups_run_in_parallel(self):
+        def slow_harvester(data_def, refresh):
+            logging.info(f'harvesting {utilities.source_group.get()}')
+            time.sleep(0.5)
+
+        groups = [
+            ('queries', 'queries', slow_harvester),
+            ('items', 'items', slow_harvester),
+            ('newspapers', 'ChronAm', slow_harvester),
+        ]
+        data_def = argparse.Namespace(queries=[], items=[], newspapers=None)
+        logfile = f'{self.test_directory}/dataset.log'
+
+        logger = logging.getLogger()
+        old_level = logger.level
+        logger.setLevel(logging.INFO)
+        self.addCleanup(logger.setLevel, old_level)
+
+        start = time.monotonic()
+        with unittest.mock.patch('lc_etl.dataset.SOURCE_GROUPS', groups):
+            dataset._harvest_in_parallel(data_def, logfile, refresh=False)
+        self.assertLess(time.monotonic() - start, 1)
+
+        with open(f'{self.test_directory}/dataset.queries.log') as f:
+            queries_log = f.read()
+        self.assertIn('harvesting queries', queries_log)
+        self.assertNotIn('harvesting items', queries_log)
+
+        with open(f'{self.test_directory}/dataset.newspapers.log') as f:
+            self.assertIn('No ChronAm defined', f.read())
+
+
+class TestBatchResolver(unittest.TestCase):
+    def setUp(self):
+        cache_patch = unittest.mock.patch('lc_etl.response_cache.ENABLED', False)
+        cache_patch.start()
+        self.addCleanup(cache_patch.stop)
+
+
+    def test_missing_identifiers_fall_back_to_item_endpoint(self):
+        with responses.RequestsMock() as mock_responses:
+            # The search only finds one of the two, plus one we didn't ask for.
+            mock_responses.add(
+                responses.GET, re.compile(r'https://www\.loc\.gov/search/.*'),
+                json={'results': [{'id': f'http://www.loc.gov/item/{x}/'} for x in ['one', 'other']]}
+            )
+            mock_responses.add(
+                responses.GET, batch_resolver.ITEM_URL.format(identifier='two'),
+                json={'item': {'id': 'http://www.loc.gov/item/two/', 'title': 'Two'}}
+            )
+            found = batch_resolver.resolve(['one', 'two'])
+
+        self.assertEqual(set(found), {'one', 'two'})
+        self.assertEqual(found['two']['title'], 'Two')
+
+        with responses.RequestsMock() as mock_responses:
+            mock_responses.add(
+                responses.GET, re.compile(r'https://www\.loc\.gov/search/.*'),
+                json={'results': [{'id': 'http://www.loc.gov/item/one/'}]}
+            )
+            found = batch_resolver.resolve(['one', 'two'], fallback=False)
+
+        self.assertEqual(set(found), {'one'})
+
+
+class TestQueryPlanner(unittest.TestCase):
+    def setUp(self):
+        cache_patch = unittest.mock.patch('lc_etl.response_cache.ENABLED', False)
+        cache_patch.start()
+        self.addCleanup(cache_patch.stop)
+
+
+    def _session(self, counts):
+        """A fake session whose searches have the hit counts in `counts`,
+        keyed by dates= value."""
+        def get(url, **kwargs):
+            dates = re.search(r'dates=([^&]*)', url).group(1)
+            response = unittest.mock.Mock()
+            response.json.return_value = {'pagination': {'of': counts.get(dates, 0)}}
+            return response
+
+        session = unittest.mock.Mock()
+        session.get.side_effect = get
+        return session
+
+
+    def test_small_and_undated_queries_are_not_split(self):
+        url = 'https://www.loc.gov/books/?dates=1865/1877&fo=json'
+        session = self._session({'1865/1877': 500})
+        self.assertEqual(query_planner.plan(url, session), [url])
+
+        url = 'https://www.loc.gov/books/?q=reconstruction&fo=json'
+        self.assertEqual(query_planner.plan(url, session), [url])
+
+
+    def test_plan_splits_by_year_and_month(self):
+        url = 'https://www.loc.gov/books/?fa=online-format:online+text&dates=1865/1868&fo=json'
+        counts = {
+            '1865/1868': 44000,    # some items are in more than one year
+            '1865/1865': 20000,    # big, and the months cover all of it
+            '1866/1866': 5000,
+            '1867/1867': 0,
+            '1868/1868': 20000,    # big, but some items are dated to the year
+        }
+        for month in range(1, 13):
+            last_day = calendar.monthrange(1865, month)[1]
+            counts[f'1865-{month:02}-01/1865-{month:02}-{last_day}'] = 2000
+            counts[f'1868-{month:02}-01/1868-{month:02}-{last_day:02}'] = 1000
+
+        shards = query_planner.plan(url, self._session(counts), max_results=10000)
+
+        self.assertEqual(len(shards), 14)
+        self.assertIn(query_planner.with_dates(url, '1865-02-01/1865-02-28'), shards)
+        self.assertIn(query_planner.with_dates(url, '1866/1866'), shards)
+        self.assertIn(query_planner.with_dates(url, '1868/1868'), shards)
+        self.assertNotIn(query_planner.with_dates(url, '1865/1865'), shards)
+        # Everything but the dates is left alone.
+        self.assertTrue(all('fa=online-format:online+text&dates=' in x for x in shards))
+
+
+    def test_plan_checks_years_add_up(self):
+        url = 'https://www.loc.gov/books/?dates=1865/1866&fo=json'
+        # Items dated to, say, "186-" match the range but neither year.
+        session = self._session({'1865/1866': 30000,
+                                 '1865/1865': 8000, '1866/1866': 9000})
+
+        self.assertEqual(query_planner.plan(url, session, max_results=10000), [url])
+
+
+class TestThrottle(unittest.TestCase):
+    def setUp(self):
+        self.session = requests.Session()
+        self.session.mount('https://', throttle.ThrottledAdapter())
+        # A host of its own, so we get a fresh limiter.
+        host = f'{self._testMethodName.replace("_", "-")}.example.com'
+        self.url = f'https://{host}/item/'
+        self.limiter = throttle.get_limiter(host)
+
+        sleep_patch = unittest.mock.patch('lc_etl.throttle.time.sleep')
+        self.sleep = sleep_patch.start()
+        self.addCleanup(sleep_patch.stop)
+
+
+    def test_retry_after_is_honored(self):
+        with responses.RequestsMock() as mock_responses:
+            mock_responses.add(responses.GET, self.url, status=429, headers={'Retry-After': '30'})
+            mock_responses.add(responses.GET, self.url, json={})
+            response = self.session.get(self.url)
+
+        self.assertEqual(response.status_code, 200)
+        # We waited as long as we were told to before trying again...
+        self.assertAlmostEqual(max(call.args[0] for call in self.sleep.call_args_list), 30, delta=1)
+        # ...and slowed down.
+        stats = self.limiter.stats()
+        self.assertEqual(stats['throttled'], 1)
+        self.assertLess(stats['rate'], throttle.DEFAULT_RATE)
+
+
+    def test_gives_up_eventually(self):
+        with responses.RequestsMock() as mock_responses:
+            mock_responses.add(responses.GET, self.url, status=500)
+            response = self.session.get(self.url)
+            self.assertEqual(len(mock_responses.calls), throttle.MAX_ATTEMPTS)
+
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(self.limiter.stats()['failed'], throttle.MAX_ATTEMPTS)
+
+
+    def test_rate_increases_with_success(self):
+        self.limiter.set_rate(1, max_rate=1.5)
+        for _ in range(20):
+            self.limiter.succeeded()
+        self.assertEqual(self.limiter.stats()['rate'], 1.5)
+
+
+    def test_rate_stays_at_default_unless_asked(self):
+        for _ in range(20):
+            self.limiter.succeeded()
+        self.assertEqual(self.limiter.stats()['rate'], throttle.DEFAULT_RATE)
+
+        self.limiter.probe_up_to(100)
+        for _ in range(200):
+            self.limiter.succeeded()
+        self.assertGreater(self.limiter.stats()['rate'], throttle.DEFAULT_RATE)
+        self.assertLessEqual(self.limiter.stats()['rate'], throttle.MAX_RATE)
+
+
+    def test_parse_retry_after(self):
+        self.assertEqual(throttle.parse_retry_after('12'), 12)
+        self.assertIsNone(throttle.parse_retry_after(None))
+        self.assertIsNone(throttle.parse_retry_after('soon'))
+        self.assertEqual(throttle.parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT'), 0)
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.test_directory = 'tests/data/temp'
+        Path(self.test_directory).mkdir(parents=True)
+        cache_patch = unittest.mock.patch(
+            'lc_etl.response_cache.CACHE_PATH', f'{self.test_directory}/cache.db'
+        )
+        cache_patch.start()
+        self.addCleanup(cache_patch.stop)
+
+        self.url = 'https://www.loc.gov/item/mal3745600/?fo=json'
+        self.session = unittest.mock.Mock()
+        self.session.get.return_value = unittest.mock.Mock(
+            status_code=200, content=b'{"item": {}}', headers={'ETag': 'abc'}
+        )
+
+
+    def tearDown(self):
+        shutil.rmtree(self.test_directory)
+
+
+    def test_serves_fresh_entries_from_disk(self):
+        response_cache.cached_get(self.session, 'https://www.loc.gov/search/?q=lincoln&fo=json')
+        # Same URL with the query string in a different order.
+        response = response_cache.cached_get(
+            self.session, 'https://www.loc.gov/search/?fo=json&q=lincoln'
+        )
+
+        assert response.from_cache
+        assert response.json() == {'item': {}}
+        self.assertEqual(self.session.get.call_count, 1)
+
+
+    def test_revalidates_stale_entries(self):
+        response_cache.cached_get(self.session, self.url)
+        self.session.get.return_value = unittest.mock.Mock(status_code=304, headers={})
+
+        response = response_cache.cached_get(self.session, self.url, ttl=0)
+
+        assert response.from_cache
+        assert response.json() == {'item': {}}
+        _, kwargs = self.session.get.call_args
+        self.assertEqual(kwargs['headers']['If-None-Match'], 'abc')
+
+
+    def test_serves_stale_entries_on_server_errors(self):
+        response_cache.cached_get(self.session, self.url)
+        self.session.get.return_value = unittest.mock.Mock(status_code=503, headers={})
+
+        response = response_cache.cached_get(self.session, self.url, ttl=0)
+
+        assert response.from_cache
+        assert response.json() == {'item': {}}
+
+        # Without an entry to fall back on, callers get the error as before.
+        response = response_cache.cached_get(self.session, 'https://www.loc.gov/item/other/?fo=json')
+        self.assertEqual(response.status_code, 503)
+
+
+    def test_cache_only_mode(self):
+        with unittest.mock.patch('lc_etl.response_cache.CACHE_ONLY', True):
+            with self.assertRaises(response_cache.CacheMiss):
+                response_cache.cached_get(self.session, self.url)
+
+        self.session.get.assert_not_called()
+
+
+class TestNewspapers(unittest.TestCase):
+    def setUp(self):
+        self.test_directory = 'tests/data/temp'
+        Path(self.test_directory).mkdir(parents=True)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.test_directory)
+
+
+    def _make_batch(self, members):
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode='w:bz2') as tar:
+            for name, content in members.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                tar.addfile(info, io.BytesIO(content))
+
+        buffer.seek(0)
+        return buffer
+
+
+    def test_extract_batch_is_selective(self):
+        batch = self._make_batch({
+            'batch_dlc_one/sn78000873/1869/12/30/ed-1/seq-1/ocr.txt': b'wanted',
+            'batch_dlc_one/sn78000873/1869/12/30/ed-1/seq-1/ocr.xml': b'<xml/>',
+            'batch_dlc_one/sn78000873/1890/01/02/ed-1/seq-1/ocr.txt': b'too late',
+        })
+
+        # Simulate an HTTP body, which can't seek.
+        stream = unittest.mock.Mock(wraps=batch)
+        stream.seekable = lambda: False
+        del stream.seek
+
+        with unittest.mock.patch('lc_etl.newspapers.newspaper_dir', self.test_directory):
+            written = newspapers.extract_batch(stream, range(1865, 1878))
+
+        self.assertEqual(written, 1)
+        files = [x for x in Path(self.test_directory).rglob('*') if x.is_file()]
+        self.assertEqual(
+            files,
+            [Path(self.test_directory) / 'sn78000873/1869/12/30/ed-1/seq-1/ocr.txt']
+        )
+
+
+    @unittest.mock.patch('lc_etl.newspapers.sleep')
+    def test_download_batch_resumes(self, _):
+        url = 'https://chroniclingamerica.loc.gov/data/ocr/batch_dlc_one.tar.bz2'
+        content = b'0123456789'
+        with open(Path(self.test_directory) / 'batch_dlc_one.tar.bz2.part', 'wb') as f:
+            f.write(content[:4])
+
+        def ranged(request):
+            start = int(request.headers['Range'].split('=')[1].rstrip('-'))
+            headers = {'Content-Range': f'bytes {start}-9/10'}
+            return (206, headers, content[start:])
+
+        with responses.RequestsMock() as mock_responses, \
+                unittest.mock.patch('lc_etl.newspapers.download_dir', self.test_directory):
+            mock_responses.add_callback(responses.GET, url, callback=ranged)
+            path = newspapers.download_batch(url)
+
+        with path.open('rb') as f:
+            self.assertEqual(f.read(), content)
+        assert not (Path(self.test_directory) / 'batch_dlc_one.tar.bz2.part').exists()
+
+
+    def test_parallel_slurp_stops_cleanly(self):
+        urls = [f'https://chroniclingamerica.loc.gov/data/ocr/batch_{x}.tar.bz2' for x in range(6)]
+
+        def fake_download(url):
+            path = Path(self.test_directory) / url.split('/')[-1]
+            path.write_bytes(b'')
+            return path
+
+        outcome = []
+        def slurp():
+            try:
+                newspapers._slurp_in_parallel(urls, range(1865, 1878), workers=2)
+            except SystemExit:
+                outcome.append('exited')
+
+        # Running out of disk space after the first batch mustn't leave the
+        # download workers stuck on the full extraction queue.
+        with unittest.mock.patch('lc_etl.newspapers.download_batch', fake_download), \
+                unittest.mock.patch('lc_etl.newspapers.extract_batch', return_value=0), \
+                unittest.mock.patch('lc_etl.newspapers.check_for_disk_space', side_effect=SystemExit):
+            thread = threading.Thread(target=slurp, daemon=True)
+            thread.start()
+            thread.join(timeout=30)
+
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(outcome, ['exited'])
+
+
+class TestCorpusStore(unittest.TestCase):
+    def setUp(self):
+        self.test_directory = 'tests/data/temp'
+        Path(self.test_directory).mkdir(parents=True)
+
+
+    def tearDown(self):
+        corpus_store.close_corpora()
+        shutil.rmtree(self.test_directory)
+
+
+    def test_round_trip(self):
+        source = Path(self.test_directory, 'source')
+        shutil.copytree('tests/data/locations', source)
+        Path(source, 'mal3745600').write_bytes('caf\u00e9 au lait'.encode('utf-8'))
+        store = Path(self.test_directory, 'packed')
+
+        with unittest.mock.patch('lc_etl.corpus_store.SHARD_SIZE', 10):
+            self.assertEqual(corpus_store.import_directory(source, store), 2)
+        corpus_store.close_corpora()
+
+        corpus = corpus_store.open_corpus(store)
+        self.assertIsInstance(corpus, corpus_store.PackedCorpus)
+        self.assertEqual(list(corpus.ids('*.txt')), ['sn78000873/1869/12/30/ed-1/seq-1/ocr.txt'])
+        self.assertEqual(corpus.read('mal3745600'), 'caf\u00e9 au lait')
+
+        corpus_store.export_directory(store, Path(self.test_directory, 'exported'))
+        for doc_id in corpus_store.DirectoryCorpus(source).ids():
+            self.assertEqual(
+                Path(self.test_directory, 'exported', doc_id).read_bytes(),
+                Path(source, doc_id).read_bytes()
+            )
+
+
+    @unittest.skipIf(corpus_store.zstandard is None, 'zstandard is not installed')
+    def test_compression(self):
+        store = Path(self.test_directory, 'packed')
+        corpus = corpus_store.open_corpus(store, packed=True, compress=True)
+        corpus.write('mal3745600', 'caf\u00e9 au lait ' * 100)
+        corpus_store.close_corpora()
+
+        corpus = corpus_store.open_corpus(store)
+        self.assertTrue(corpus.compress)
+        self.assertEqual(corpus.read('mal3745600'), 'caf\u00e9 au lait ' * 100)
+        # It really is compressed on disk.
+        self.assertLess(sum(x.stat().st_size for x in store.glob('shard-*.dat')), 1000)
+
+
+    def test_rewrites_and_deletes(self):
+        corpus = corpus_store.open_corpus(Path(self.test_directory, 'packed'), packed=True)
+        corpus.write('one', 'first draft')
+        corpus.write('two', '')
+        self.assertEqual(corpus.read('one'), 'first draft')
+
+        corpus.write('one', 'second draft')
+        corpus.delete('two')
+        self.assertEqual(list(corpus), [('one', 'second draft')])
+        self.assertNotIn('two', corpus)
+        with self.assertRaises(KeyError):
+            corpus.read('two')
+
+
+    def test_manifest(self):
+        root = Path(self.test_directory, 'newspapers')
+        shutil.copytree('tests/data/locations', root)
+        corpus_store.DirectoryCorpus(root).write('sn83016555/1877/01/05/ed-1/seq-2/ocr.txt', 'later')
+
+        with unittest.mock.patch('lc_etl.corpus_manifest.MANIFEST_DIR', f'{self.test_directory}/manifests'):
+            self.assertIsNone(corpus_store.open_corpus(root).manifest)
+            manifest = corpus_store.build_manifest(root)
+            self.assertEqual(len(manifest), 2)
+
+            corpus = corpus_store.open_corpus(root)
+            [entry] = corpus.entries(year=1877)
+            self.assertEqual(entry.tag, 'sn83016555/1877/01/05/ed-1/seq-2')
+            self.assertEqual(entry.date, '1877-01-05')
+            self.assertEqual(entry.size, 5)
+            self.assertEqual(entry.metadata_key, 'sn83016555')
+            self.assertEqual(entry.metadata_path('meta'), Path('meta/sn83016555/1877/01/05/ed-1/seq-2'))
+            self.assertEqual(
+                list(corpus.ids(lccn='sn78000873')),
+                ['sn78000873/1869/12/30/ed-1/seq-1/ocr.txt']
+            )
+
+            # Writes through the corpus show up at once; other changes need
+            # another build.
+            corpus.delete(entry.doc_id)
+            corpus.write('mal3745600', 'a letter')
+            Path(root, 'stray').write_text('stray')
+            self.assertEqual(len(manifest), 2)
+            self.assertEqual([x.tag for x in corpus.entries(year=1877)], [])
+
+            self.assertEqual(manifest.sync(corpus._listing()), (1, 0))
+            self.assertEqual(len(manifest), 3)
+
+
+    def test_manifest_is_read_in_batches(self):
+        root = Path(self.test_directory, 'results')
+        corpus = corpus_store.DirectoryCorpus(root)
+        for i in range(7):
+            corpus.write(f'item{i}', 'text')
+
+        with unittest.mock.patch('lc_etl.corpus_manifest.MANIFEST_DIR', f'{self.test_directory}/manifests'), \
+                unittest.mock.patch('lc_etl.corpus_manifest.SELECT_BATCH', 3):
+            corpus_store.build_manifest(root)
+            corpus = corpus_store.open_corpus(root)
+            self.assertIsNotNone(corpus.manifest)
+
+            seen = []
+            for doc_id in corpus.ids():
+                seen.append(doc_id)
+                # Deleting as we go doesn't throw the batches off.
+                corpus.delete(doc_id)
+
+        self.assertEqual(seen, [f'item{i}' for i in range(7)])
+
+
+    def test_top_level_entries(self):
+        root = Path(self.test_directory, 'results')
+        corpus = corpus_store.DirectoryCorpus(root)
+        corpus.write('mal3745600', 'a letter')
+        corpus.write('stray/subdir/file', 'not a result')
+
+        self.assertEqual(list(corpus.ids(recursive=False)), ['mal3745600'])
+        with unittest.mock.patch('lc_etl.corpus_manifest.MANIFEST_DIR', f'{self.test_directory}/manifests'):
+            corpus_store.build_manifest(root)
+            corpus = corpus_store.open_corpus(root)
+            self.assertEqual(list(corpus.ids(recursive=False)), ['mal3745600'])
+            self.assertEqual(len(list(corpus.ids())), 2)
+
+
+    def test_filters_read_packed_corpora(self):
+        store = Path(self.test_directory, 'packed')
+        corpus_store.import_directory('tests/data/locations', store)
+
+        filter_newspaper_locations.run(str(store), 'tests/data/metadata')
+
+        corpus = corpus_store.open_corpus(store)
+        self.assertEqual(
+            corpus.read('sn78000873/1869/12/30/ed-1/seq-1/ocr.txt').strip(),
+            "once upon a time there was a congressman who had a peach from ireland"
+        )
+
+
+class TestChronAmCatalog(unittest.TestCase):
+    def setUp(self):
+        self.test_directory = 'tests/data/temp'
+        Path(self.test_directory).mkdir(parents=True)
+        self.catalog = chronam_catalog.ChronAmCatalog(f'{self.test_directory}/catalog.db')
+
+
+    def tearDown(self):
+        self.catalog.db.close()
+        shutil.rmtree(self.test_directory)
+
+
+    def test_batches_for_years(self):
+        self.catalog.add_batch('batch_one', ['sn1', 'sn2'], 'https://example.com/batch_one.tar.bz2')
+        self.catalog.add_batch('batch_two', ['sn3'], 'https://example.com/batch_two.tar.bz2')
+        self.catalog.add_batch('batch_three', ['sn1'])
+        self.catalog.add_titles([('sn1', 1860, 1866), ('sn3', 1880, 1890)])
+
+        self.assertEqual(
+            self.catalog.batches_for_years(1865, 1877),
+            [('batch_one', 'https://example.com/batch_one.tar.bz2'), ('batch_three', None)]
+        )
+        self.assertEqual(self.catalog.lccns_for_batch('batch_one'), {'sn1', 'sn2'})
+
+
+    def test_refresh_only_fetches_new_batches(self):
+        self.catalog.add_batch('old_batch', ['sn1'])
+        self.catalog.set_setting('batches_crawled', '1')
+        page_two = 'https://chroniclingamerica.loc.gov/batches/2.json'
+
+        with responses.RequestsMock() as mock_responses:
+            mock_responses.add(responses.GET, chronam_catalog.BATCHES_URL, json={
+                'batches': [{'name': 'new_batch', 'lccns': ['sn2']}],
+                'next': page_two,
+            })
+            mock_responses.add(responses.GET, page_two, json={
+                'batches': [{'name': 'old_batch', 'lccns': ['sn1']}],
+                'next': 'https://chroniclingamerica.loc.gov/batches/3.json',
+            })
+            new = self.catalog.refresh_batches()
+
+        self.assertEqual(new, 1)
+        self.assertEqual(self.catalog.known_batches(), {'old_batch', 'new_batch'})
+
+
+    def test_cache_only_skips_batches_json(self):
+        with unittest.mock.patch('lc_etl.response_cache.CACHE_ONLY', True), \
+                responses.RequestsMock() as mock_responses:
+            self.assertEqual(self.catalog.refresh_batches(), 0)
+            self.assertEqual(len(mock_responses.calls), 0)
+
+
+    def test_ocr_urls_are_revalidated(self):
+        with unittest.mock.patch.object(chronam_catalog, 'cached_get') as cached_get:
+            cached_get.return_value.json.return_value = {'ocr': [
+                {'name': 'batch_one.tar.bz2', 'url': 'https://example.com/batch_one.tar.bz2'}
+            ]}
+            self.catalog.add_batch('batch_one', ['sn1'])
+            self.catalog.refresh_ocr_urls()
+
+        self.assertEqual(cached_get.call_args.kwargs['ttl'], 0)
+        self.catalog.add_titles([('sn1', 1860, 1870)])
+        self.assertEqual(
+            self.catalog.batches_for_years(1865, 1877),
+            [('batch_one', 'https://example.com/batch_one.tar.bz2')]
+        )
+
+
+    def test_interrupted_crawl_resumes(self):
+        page_two = 'https://chroniclingamerica.loc.gov/batches/2.json'
+        page_three = 'https://chroniclingamerica.loc.gov/batches/3.json'
+        first_page = {
+            'batches': [{'name': 'batch_one', 'lccns': ['sn1']}],
+            'next': page_two,
+        }
+
+        with responses.RequestsMock() as mock_responses:
+            mock_responses.add(responses.GET, chronam_catalog.BATCHES_URL, json=first_page)
+            mock_responses.add(responses.GET, page_two, body=ConnectionError('interrupted'))
+            with self.assertRaises(ConnectionError):
+                self.catalog.refresh_batches()
+
+        self.assertEqual(self.catalog.known_batches(), {'batch_one'})
+
+        # Page two lists nothing new, which would have stopped a refresh of a
+        # finished crawl, but this one has to keep going.
+        with responses.RequestsMock() as mock_responses:
+            mock_responses.add(responses.GET, page_two, json={
+                'batches': [{'name': 'batch_one', 'lccns': ['sn1']}],
+                'next': page_three,
+            })
+            mock_responses.add(responses.GET, page_three, json={
+                'batches': [{'name': 'batch_three', 'lccns': ['sn3']}],
+                'next': None,
+            })
+            self.catalog.refresh_batches()
+
+        self.assertEqual(self.catalog.known_batches(), {'batch_one', 'batch_three'})
+        self.assertTrue(self.catalog.get_setting('batches_crawled'))
+
+
+    def test_title_search_recorded_after_last_page(self):
+        page = lambda n: chronam_catalog.TITLES_URL.format(year1=1865, year2=1877, page=n)
+
+        with unittest.mock.patch.object(chronam_catalog, 'cached_get') as cached_get:
+            cached_get.return_value.json.side_effect = [
+                {'items': [{'id': '/lccn/sn1/', 'start_year': 1860, 'end_year': 1870}],
+                 'endIndex': 1, 'totalItems': 2},
+                ConnectionError('interrupted'),
+            ]
+            with self.assertRaises(ConnectionError):
+                self.catalog.refresh_titles(1865, 1877)
+
+        self.assertEqual(self.catalog.lccns_for_years(1865, 1877), {'sn1'})
+        self.assertFalse(self.catalog.has_title_search(1865, 1877))
+
+        with unittest.mock.patch.object(chronam_catalog, 'cached_get') as cached_get:
+            cached_get.return_value.json.side_effect = [
+                {'items': [{'id': '/lccn/sn1/', 'start_year': 1860, 'end_year': 1870}],
+                 'endIndex': 1, 'totalItems': 2},
+                {'items': [{'id': '/lccn/sn2/', 'start_year': 1866, 'end_year': 1880}],
+                 'endIndex': 2, 'totalItems': 2},
+            ]
+            self.catalog.refresh_titles(1865, 1877)
+
+        self.assertEqual(cached_get.call_args.args[1], page(2))
+        self.assertEqual(self.catalog.lccns_for_years(1865, 1877), {'sn1', 'sn2'})
+        self.assertTrue(self.catalog.has_title_search(1865, 1877))
+
+
 if __name__ == '__main__':
     unittest.main()